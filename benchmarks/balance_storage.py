@@ -0,0 +1,122 @@
+import argparse
+import json
+import os
+import platform
+import time
+
+from sqlalchemy import text
+
+from benchmarks.run_benchmarks import create_offline_node, get_git_commit
+from benchmarks.synthetic_chain import SyntheticChain
+from models.balance_tracking.balance_indexer import BalanceIndexer, aggregate_balance_changes, copy_rows
+from node.node_utils import parse_block_data
+
+# balance_changes as it was created before the addresses dictionary
+LEGACY_BALANCE_CHANGES = [
+    """
+    CREATE TABLE balance_changes (
+        address VARCHAR NOT NULL,
+        block INTEGER NOT NULL,
+        d_balance BIGINT,
+        block_timestamp TIMESTAMP WITHOUT TIME ZONE,
+        CONSTRAINT balance_changes_pkey PRIMARY KEY (address, block)
+    )
+    """,
+    "CREATE INDEX idx_block_timestamp ON balance_changes (block_timestamp)",
+]
+
+
+def create_legacy_layout(balance_indexer, plain_tables):
+    with balance_indexer.engine.begin() as conn:
+        if conn.execute(text("SELECT EXISTS (SELECT 1 FROM balance_changes) OR EXISTS (SELECT 1 FROM addresses)")).scalar():
+            raise SystemExit("The database is not empty, run this against a scratch database")
+        conn.execute(text("DROP TABLE balance_changes"))
+        for statement in LEGACY_BALANCE_CHANGES:
+            conn.execute(text(statement))
+    if not plain_tables:
+        balance_indexer.setup_db()
+
+
+def load_legacy_rows(balance_indexer, chain):
+    # the rows the indexer wrote per block before the migration, streamed in with COPY
+    bitcoin_node = create_offline_node(chain)
+    num_rows = 0
+    connection = balance_indexer.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        for raw_block in chain.iter_blocks():
+            block_data = parse_block_data(raw_block)
+            balance_rows, _ = aggregate_balance_changes(bitcoin_node.create_deal_data(block_data), block_data.block_height)
+            copy_rows(cursor, "balance_changes", ("address", "block", "d_balance", "block_timestamp"), balance_rows)
+            num_rows += len(balance_rows)
+        connection.commit()
+    finally:
+        connection.close()
+    return num_rows
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Measure balance_changes storage before and after the address id migration.')
+    parser.add_argument('--db-url', type=str, default=os.environ.get("DB_CONNECTION_STRING"), help='An empty scratch database')
+    parser.add_argument('--blocks', type=int, default=2000, help='Blocks of the synthetic chain')
+    parser.add_argument('--profile', type=str, default='mixed', help='Block profile of the synthetic chain')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic chain')
+    parser.add_argument('--address-reuse', type=float, default=0.3, help='Share of outputs paying an address seen before')
+    parser.add_argument('--plain-tables', action='store_true', help='Skip TimescaleDB, for a PostgreSQL without the extension')
+    parser.add_argument('--output', type=str, help='Write the JSON report to this path instead of stdout')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if not args.db_url:
+        raise SystemExit("Pass --db-url or set DB_CONNECTION_STRING")
+
+    balance_indexer = BalanceIndexer(args.db_url)
+    if args.plain_tables:
+        balance_indexer._ensure_hypertable_exists = lambda: None
+    create_legacy_layout(balance_indexer, args.plain_tables)
+
+    chain = SyntheticChain(args.blocks, profile=args.profile, seed=args.seed, address_reuse=args.address_reuse)
+    num_rows = load_legacy_rows(balance_indexer, chain)
+    with balance_indexer.engine.begin() as conn:
+        conn.execute(text("ANALYZE balance_changes"))
+    storage_before = balance_indexer.get_storage_report()
+
+    start_time = time.perf_counter()
+    num_migrated_rows = balance_indexer.migrate_to_address_ids()
+    migration_seconds = time.perf_counter() - start_time
+    with balance_indexer.engine.begin() as conn:
+        conn.execute(text("ANALYZE balance_changes"))
+        num_addresses = conn.execute(text("SELECT COUNT(*) FROM addresses")).scalar()
+    storage_after = balance_indexer.get_storage_report()
+    balance_indexer.close()
+
+    before_bytes = storage_before["balance_changes"]["total_bytes"]
+    after_bytes = storage_after["balance_changes"]["total_bytes"] + storage_after["addresses"]["total_bytes"]
+    report = {
+        "commit": get_git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "blocks": args.blocks,
+        "profile": args.profile,
+        "seed": args.seed,
+        "address_reuse": args.address_reuse,
+        "plain_tables": args.plain_tables,
+        "rows": num_rows,
+        "migrated_rows": num_migrated_rows,
+        "addresses": num_addresses,
+        "migration_seconds": migration_seconds,
+        "storage_before": storage_before,
+        "storage_after": storage_after,
+        "bytes_per_row_before": before_bytes / num_rows if num_rows else None,
+        # the dictionary is counted against the new layout
+        "bytes_per_row_after": after_bytes / num_rows if num_rows else None,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output)
+    else:
+        print(output)
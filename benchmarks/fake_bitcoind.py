@@ -0,0 +1,235 @@
+import argparse
+import json
+import random
+import threading
+import time
+from collections import Counter
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks.synthetic_chain import SyntheticChain
+
+RPC_INVALID_PARAMETER = -8
+RPC_INVALID_ADDRESS_OR_KEY = -5
+RPC_METHOD_NOT_FOUND = -32601
+RPC_INTERNAL_ERROR = -32603
+
+
+class RPCError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class RecordedChain:
+    """Blocks recorded from a real node with getblock verbosity 2, one JSON object per line."""
+
+    def __init__(self, chain_file):
+        self.blocks = {}
+        self.block_hashes = {}
+        self.transactions = {}
+        with open(chain_file) as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                block = json.loads(line, parse_float=Decimal)
+                self.blocks[block["height"]] = block
+                self.block_hashes[block["hash"]] = block["height"]
+                for transaction in block["tx"]:
+                    self.transactions[transaction["txid"]] = (block["height"], transaction)
+
+    @property
+    def tip_height(self):
+        return max(self.blocks)
+
+
+def encode_raw(data):
+    # stand-in for the serialized hex of verbosity 0, it only has to be deterministic and of similar size
+    return json.dumps(data, default=str, sort_keys=True).encode().hex()
+
+
+class FakeBitcoindServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, chain, latency=0.0, jitter=0.0, call_latency=0.0, error_rate=0.0, max_concurrency=0, seed=0):
+        super().__init__(address, FakeBitcoindHandler)
+        self.chain = chain
+        self.latency = latency
+        self.jitter = jitter
+        self.call_latency = call_latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        # like bitcoind's -rpcworkqueue, requests beyond the limit are rejected instead of queued
+        self.slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency > 0 else None
+
+        self.stats_lock = threading.Lock()
+        self.stats = Counter()
+        self.method_stats = Counter()
+
+    def count(self, key, method=None):
+        with self.stats_lock:
+            self.stats[key] += 1
+            if method is not None:
+                self.method_stats[method] += 1
+
+    def sample(self):
+        with self.random_lock:
+            return self.random.random()
+
+    def getblockcount(self):
+        return self.chain.tip_height
+
+    def getblockhash(self, block_height):
+        block = self.chain.blocks.get(block_height)
+        if block is None:
+            raise RPCError(RPC_INVALID_PARAMETER, "Block height out of range")
+        return block["hash"]
+
+    def getblock(self, block_hash, verbosity=1):
+        block_height = self.chain.block_hashes.get(block_hash)
+        if block_height is None:
+            raise RPCError(RPC_INVALID_ADDRESS_OR_KEY, "Block not found")
+        block = dict(self.chain.blocks[block_height], confirmations=self.chain.tip_height - block_height + 1)
+        if verbosity == 0:
+            return encode_raw(block)
+        if verbosity == 1:
+            return dict(block, tx=[transaction["txid"] for transaction in block["tx"]])
+        return block
+
+    def getrawtransaction(self, txid, verbose=False, block_hash=None):
+        found = self.chain.transactions.get(txid)
+        if found is None:
+            raise RPCError(RPC_INVALID_ADDRESS_OR_KEY, "No such mempool or blockchain transaction. Use gettransaction for wallet transactions.")
+        block_height, transaction = found
+        if not verbose:
+            return encode_raw(transaction)
+        block = self.chain.blocks[block_height]
+        return dict(
+            transaction,
+            hex=encode_raw(transaction),
+            blockhash=block["hash"],
+            confirmations=self.chain.tip_height - block_height + 1,
+            time=block["time"],
+            blocktime=block["time"],
+        )
+
+    def call(self, request):
+        method = request.get("method")
+        params = request.get("params") or []
+        self.count("calls", method)
+        if self.call_latency:
+            time.sleep(self.call_latency)
+        if method not in ("getblockcount", "getblockhash", "getblock", "getrawtransaction"):
+            raise RPCError(RPC_METHOD_NOT_FOUND, "Method not found")
+        if self.error_rate and self.sample() < self.error_rate:
+            self.count("injected_errors")
+            raise RPCError(RPC_INTERNAL_ERROR, "Injected error")
+        try:
+            return getattr(self, method)(*params)
+        except TypeError:
+            raise RPCError(RPC_INVALID_PARAMETER, f"Invalid parameters for {method}")
+
+    def respond(self, request):
+        request_id = request.get("id") if isinstance(request, dict) else None
+        try:
+            if not isinstance(request, dict):
+                raise RPCError(RPC_INVALID_PARAMETER, "Invalid request object")
+            return {"result": self.call(request), "error": None, "id": request_id}
+        except RPCError as e:
+            return {"result": None, "error": {"code": e.code, "message": e.message}, "id": request_id}
+
+
+class FakeBitcoindHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        server.count("requests")
+
+        if server.slots is not None and not server.slots.acquire(blocking=False):
+            server.count("rejected")
+            self.send_body(503, b"Work queue depth exceeded", "text/html")
+            return
+
+        try:
+            if server.latency or server.jitter:
+                time.sleep(server.latency + server.jitter * server.sample())
+
+            try:
+                request = json.loads(body)
+            except ValueError:
+                self.send_body(500, json.dumps({"result": None, "error": {"code": -32700, "message": "Parse error"}, "id": None}).encode())
+                return
+
+            if isinstance(request, list):
+                server.count("batches")
+                response = [server.respond(item) for item in request]
+                status = 200
+            else:
+                response = server.respond(request)
+                # bitcoind answers failed JSON-RPC 1.x calls with HTTP 500 and the error in the body
+                status = 200 if response["error"] is None else 500
+            self.send_body(status, json.dumps(response, default=float).encode())
+        finally:
+            if server.slots is not None:
+                server.slots.release()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Serve a synthetic or recorded chain over the bitcoind JSON-RPC interface.')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18332)
+    parser.add_argument('--blocks', type=int, default=100, help='Blocks of the synthetic chain')
+    parser.add_argument('--profile', type=str, default='mixed', help='Block profile of the synthetic chain')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--start-height', type=int, default=1, help='Height of the first synthetic block')
+    parser.add_argument('--chain-file', type=str, help='Serve blocks recorded with getblock verbosity 2, one JSON object per line')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Delay of every HTTP request')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='Random extra delay of every HTTP request')
+    parser.add_argument('--call-latency-ms', type=float, default=0, help='Delay of every call, also inside batches')
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of calls answered with an RPC error')
+    parser.add_argument('--max-concurrency', type=int, default=0, help='Concurrent requests before answering 503, 0 is unlimited')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    if args.chain_file:
+        chain = RecordedChain(args.chain_file)
+    else:
+        print(f"Generating {args.blocks} {args.profile} blocks...")
+        chain = SyntheticChain(args.blocks, profile=args.profile, seed=args.seed, start_height=args.start_height)
+
+    server = FakeBitcoindServer(
+        (args.host, args.port),
+        chain,
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        call_latency=args.call_latency_ms / 1000,
+        error_rate=args.error_rate,
+        max_concurrency=args.max_concurrency,
+        seed=args.seed,
+    )
+    print(f"Serving blocks up to {chain.tip_height}, BITCOIN_NODE_RPC_URL=http://bitcoinrpc:rpcpassword@{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Requests: {dict(server.stats)}")
+        print(f"Calls by method: {dict(server.method_stats)}")
@@ -0,0 +1,247 @@
+import hashlib
+import random
+from decimal import Decimal
+
+from node.node_utils import pubkey_to_address, initialize_tx_out_hash_table
+
+COIN = 100000000
+MAX_SEQUENCE = 4294967295
+
+# script type mixes per block profile, weights sum to 1
+PROFILES = {
+    # P2PK-heavy blocks of the first years, few transactions, mostly coinbase-funded
+    "early": {
+        "txs_per_block": (5, 30),
+        "inputs_per_tx": (1, 2),
+        "outputs_per_tx": (1, 2),
+        "script_types": {"pubkey": 0.7, "pubkeyhash": 0.3},
+    },
+    # segwit and taproot heavy blocks
+    "modern": {
+        "txs_per_block": (300, 500),
+        "inputs_per_tx": (1, 3),
+        "outputs_per_tx": (1, 4),
+        "script_types": {
+            "witness_v0_keyhash": 0.45,
+            "witness_v1_taproot": 0.2,
+            "scripthash": 0.15,
+            "pubkeyhash": 0.12,
+            "witness_v0_scripthash": 0.05,
+            "nulldata": 0.03,
+        },
+    },
+    # exchange style consolidations, many inputs into one output
+    "consolidation": {
+        "txs_per_block": (5, 10),
+        "inputs_per_tx": (50, 200),
+        "outputs_per_tx": (1, 1),
+        "script_types": {"witness_v0_keyhash": 0.6, "pubkeyhash": 0.3, "scripthash": 0.1},
+    },
+}
+
+ADDRESS_PREFIXES = {
+    "pubkeyhash": ("1", 33),
+    "scripthash": ("3", 33),
+    "witness_v0_keyhash": ("bc1q", 38),
+    "witness_v0_scripthash": ("bc1q", 58),
+    "witness_v1_taproot": ("bc1p", 58),
+}
+
+BECH32_CHARS = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+BASE58_CHARS = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+
+
+def satoshi_to_btc(value_satoshi):
+    return Decimal(value_satoshi) / COIN
+
+
+class SyntheticChain:
+    """Deterministic chain in the getblock verbosity 2 layout, inputs always spend earlier outputs."""
+
+    def __init__(self, num_blocks, profile="mixed", seed=0, start_height=1, start_time=1231006505, address_reuse=0.3):
+        self.num_blocks = num_blocks
+        self.profile = profile
+        self.seed = seed
+        self.start_height = start_height
+        self.start_time = start_time
+        self.address_reuse = address_reuse
+        self.random = random.Random(seed)
+
+        self.blocks = {}
+        self.block_hashes = {}
+        self.transactions = {}
+        # (txid, str(n)) -> (address, value_satoshi) for every spendable output, the vout table layout
+        self.outputs = {}
+        self.pubkey_addresses = {}
+        self.addresses = []
+        self.utxos = []
+
+        # funding outputs live in the block before start_height, so every block can spend from the start
+        self._add_block(start_height - 1, self._funding_transactions())
+        for block_height in range(start_height, start_height + num_blocks):
+            self._add_block(block_height, self._block_transactions(block_height))
+
+    def block_profile(self, block_height):
+        if self.profile != "mixed":
+            return self.profile
+        offset = block_height - self.start_height
+        if offset % 10 == 9:
+            return "consolidation"
+        return "early" if offset < self.num_blocks // 3 else "modern"
+
+    @property
+    def tip_height(self):
+        return self.start_height + self.num_blocks - 1
+
+    def get_block(self, block_height):
+        return self.blocks[block_height]
+
+    def get_block_by_hash(self, block_hash):
+        return self.blocks.get(self.block_hashes.get(block_hash))
+
+    def iter_blocks(self):
+        for block_height in range(self.start_height, self.start_height + self.num_blocks):
+            yield self.blocks[block_height]
+
+    def build_tx_out_hash_table(self):
+        tx_out_hash_table = initialize_tx_out_hash_table()
+        for (txid, vout_id), (address, value_satoshi) in self.outputs.items():
+            tx_out_hash_table[txid[:3]][(txid, vout_id)] = (address, str(value_satoshi))
+        return tx_out_hash_table
+
+    def write_vout_csv(self, csv_path):
+        # the column layout read by node/btc-vout-hashtable-builder/utils.py
+        with open(csv_path, "w") as file:
+            for (txid, vout_id), (address, value_satoshi) in self.outputs.items():
+                file.write(f"{txid};{vout_id};{value_satoshi};0;{address}\n")
+
+    def _hash(self, *parts):
+        return hashlib.sha256(":".join(str(part) for part in (self.seed,) + parts).encode()).hexdigest()
+
+    def _random_script_type(self, profile):
+        script_types = PROFILES[profile]["script_types"]
+        return self.random.choices(list(script_types), weights=list(script_types.values()))[0]
+
+    def _new_address(self, script_type):
+        prefix, length = ADDRESS_PREFIXES[script_type]
+        chars = BECH32_CHARS if prefix.startswith("bc1") else BASE58_CHARS
+        return prefix + "".join(self.random.choices(chars, k=length))
+
+    def _script_pub_key(self, script_type):
+        if script_type == "nulldata":
+            data = self._hash("nulldata", self.random.random())[:40]
+            return {"asm": f"OP_RETURN {data}", "hex": f"6a14{data}", "type": "nulldata"}, None
+
+        if script_type == "pubkey":
+            pubkey = "04" + self._hash("pubkey", self.random.random()) + self._hash("pubkey-y", self.random.random())
+            address = self.pubkey_addresses[pubkey] = pubkey_to_address(pubkey)
+            return {"asm": f"{pubkey} OP_CHECKSIG", "hex": f"41{pubkey}ac", "type": "pubkey"}, address
+
+        if self.addresses and self.random.random() < self.address_reuse:
+            address = self.random.choice(self.addresses)
+        else:
+            address = self._new_address(script_type)
+            self.addresses.append(address)
+        return {"asm": "", "hex": "", "type": script_type, "address": address}, address
+
+    def _vout(self, n, value_satoshi, script_type):
+        script_pub_key, address = self._script_pub_key(script_type)
+        return {"value": satoshi_to_btc(value_satoshi), "n": n, "scriptPubKey": script_pub_key}, address
+
+    def _transaction(self, txid, vins, vouts):
+        return {"txid": txid, "hash": txid, "version": 2, "locktime": 0, "vin": vins, "vout": vouts}
+
+    def _funding_transactions(self):
+        # about as many outputs as the chain spends on average
+        num_outputs = sum(
+            PROFILES[profile]["txs_per_block"][1] * PROFILES[profile]["inputs_per_tx"][1] // 2
+            for profile in map(self.block_profile, range(self.start_height, self.start_height + self.num_blocks))
+        )
+        transactions = []
+        for tx_index in range(max(1, min(num_outputs, 200000) // 500)):
+            txid = self._hash("funding", tx_index)
+            vouts = []
+            for n in range(500):
+                vout, address = self._vout(n, self.random.randint(10000, 5 * COIN), "pubkeyhash")
+                vouts.append(vout)
+            transactions.append(self._transaction(txid, [{"coinbase": "00", "sequence": MAX_SEQUENCE}], vouts))
+        return transactions
+
+    def _block_transactions(self, block_height):
+        profile = self.block_profile(block_height)
+        settings = PROFILES[profile]
+
+        coinbase_txid = self._hash("coinbase", block_height)
+        coinbase_script_type = self._random_script_type(profile)
+        coinbase_vout, _ = self._vout(0, 50 * COIN, "pubkeyhash" if coinbase_script_type == "nulldata" else coinbase_script_type)
+        transactions = [self._transaction(coinbase_txid, [{"coinbase": self._hash("extranonce", block_height)[:16], "sequence": MAX_SEQUENCE}], [coinbase_vout])]
+
+        for tx_index in range(self.random.randint(*settings["txs_per_block"])):
+            num_inputs = min(self.random.randint(*settings["inputs_per_tx"]), len(self.utxos))
+            if num_inputs == 0:
+                break
+
+            vins = []
+            in_total_satoshi = 0
+            for _ in range(num_inputs):
+                txid, n, value_satoshi = self.utxos.pop(self.random.randrange(len(self.utxos)))
+                in_total_satoshi += value_satoshi
+                vins.append({
+                    "txid": txid,
+                    "vout": n,
+                    "scriptSig": {"asm": "", "hex": ""},
+                    "txinwitness": [self._hash("sig", txid, n)[:64]],
+                    "sequence": MAX_SEQUENCE - 2,
+                })
+
+            fee_satoshi = min(in_total_satoshi // 100, 200 * num_inputs + 1000)
+            num_outputs = self.random.randint(*settings["outputs_per_tx"])
+            remaining_satoshi = in_total_satoshi - fee_satoshi
+            vouts = []
+            for n in range(num_outputs):
+                script_type = self._random_script_type(profile)
+                if script_type == "nulldata":
+                    value_satoshi = 0
+                elif n == num_outputs - 1:
+                    value_satoshi = remaining_satoshi
+                else:
+                    value_satoshi = self.random.randint(0, remaining_satoshi)
+                remaining_satoshi -= value_satoshi
+                vout, _ = self._vout(n, value_satoshi, script_type)
+                vouts.append(vout)
+
+            transaction = self._transaction(self._hash("tx", block_height, tx_index), vins, vouts)
+            transaction["fee"] = satoshi_to_btc(fee_satoshi)
+            transactions.append(transaction)
+
+        return transactions
+
+    def _add_block(self, block_height, transactions):
+        block_hash = self._hash("block", block_height)
+        block_time = self.start_time + (block_height - self.start_height) * 600
+        block = {
+            "hash": block_hash,
+            "height": block_height,
+            "version": 536870912,
+            "time": block_time,
+            "mediantime": block_time,
+            "nonce": self.random.randint(0, MAX_SEQUENCE),
+            "difficulty": 1,
+            "nTx": len(transactions),
+            "previousblockhash": self.blocks[block_height - 1]["hash"] if block_height - 1 in self.blocks else "0" * 64,
+            "tx": transactions,
+        }
+        self.blocks[block_height] = block
+        self.block_hashes[block_hash] = block_height
+
+        # outputs become spendable from the next block on
+        for transaction in transactions:
+            self.transactions[transaction["txid"]] = (block_height, transaction)
+            for vout in transaction["vout"]:
+                script_pub_key = vout["scriptPubKey"]
+                if script_pub_key["type"] == "nulldata":
+                    continue
+                value_satoshi = int(vout["value"] * COIN)
+                address = script_pub_key.get("address") or self.pubkey_addresses[script_pub_key["asm"].split()[0]]
+                self.outputs[(transaction["txid"], str(vout["n"]))] = (address, value_satoshi)
+                self.utxos.append((transaction["txid"], vout["n"], value_satoshi))
@@ -0,0 +1,315 @@
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from setup_logger import setup_logger
+from setup_logger import logger_extra_data
+
+logger = setup_logger("Metrics")
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    metric_type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label_name, "")) for label_name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.extend(self._render_value(label_values, value))
+        return lines
+
+    def _render_value(self, label_values, value):
+        return [f"{self.name}{_format_labels(self.label_names, label_values)} {_format_value(value)}"]
+
+    def snapshot(self):
+        with self._lock:
+            return {key: self._copy_value(value) for key, value in self._values.items()}
+
+    @staticmethod
+    def _copy_value(value):
+        return value
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def labels(self, **labels):
+        return BoundCounter(self, self._key(labels))
+
+    def delta(self, snapshot):
+        # the increments since snapshot(), only the series that moved
+        with self._lock:
+            return {key: value - snapshot.get(key, 0) for key, value in self._values.items() if value != snapshot.get(key, 0)}
+
+    def merge(self, delta):
+        with self._lock:
+            for key, amount in delta.items():
+                self._values[key] = self._values.get(key, 0) + amount
+
+
+class BoundCounter:
+    # a counter with its labels resolved once, for call sites on the per-input hot path
+    def __init__(self, counter, key):
+        self._lock = counter._lock
+        self._values = counter._values
+        self._key = key
+        with self._lock:
+            self._values.setdefault(key, 0)
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._values[self._key] += amount
+
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels))
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    @staticmethod
+    def _copy_value(value):
+        return [list(value[0]), value[1], value[2]]
+
+    def delta(self, snapshot):
+        # the observations since snapshot(), only the series that moved
+        with self._lock:
+            delta = {}
+            for key, (bucket_counts, total, count) in self._values.items():
+                before_counts, before_total, before_count = snapshot.get(key, ([0] * len(self.buckets), 0.0, 0))
+                if count != before_count:
+                    delta[key] = [[after - before for after, before in zip(bucket_counts, before_counts)],
+                                  total - before_total, count - before_count]
+            return delta
+
+    def merge(self, delta):
+        with self._lock:
+            for key, (bucket_counts, total, count) in delta.items():
+                state = self._values.get(key)
+                if state is None:
+                    state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+                state[0] = [current + added for current, added in zip(state[0], bucket_counts)]
+                state[1] += total
+                state[2] += count
+
+    def _render_value(self, label_values, value):
+        bucket_counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bucket, bucket_count in zip(self.buckets, bucket_counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.label_names, label_values, [("le", _format_value(bucket))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.label_names, label_values)
+        lines.append(f"{self.name}_sum{labels} {repr(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        # called before every scrape, for values that are read rather than reported
+        self._collectors.append(collector)
+
+    def render(self):
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.error("Metrics collector failed", extra=logger_extra_data(
+                    error={'exception_type': e.__class__.__name__, 'exception_message': str(e), 'exception_args': e.args}))
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+rpc_calls = REGISTRY.register(Counter(
+    "bitcoin_rpc_calls_total", "Bitcoin node RPC calls by method and status.", ("method", "status")))
+rpc_latency = REGISTRY.register(Histogram(
+    "bitcoin_rpc_latency_seconds", "Bitcoin node RPC latency by method.", ("method",)))
+vout_lookups = REGISTRY.register(Counter(
+    "vout_lookups_total", "Spent output lookups by source, the vout table or an RPC fallback.", ("source",)))
+vout_table_hits = vout_lookups.labels(source="table")
+vout_rpc_fallbacks = vout_lookups.labels(source="rpc")
+block_stage_seconds = REGISTRY.register(Histogram(
+    "block_stage_seconds", "Time per block spent in each stage (fetch, parse, resolve, prepare, write).", ("indexer", "stage")))
+db_commit_seconds = REGISTRY.register(Histogram(
+    "db_commit_seconds", "Latency of committing one write to the graph or Postgres database.", ("db",)))
+blocks_indexed = REGISTRY.register(Counter(
+    "blocks_indexed_total", "Blocks written by each indexer.", ("indexer",)))
+queue_depth = REGISTRY.register(Gauge(
+    "queue_depth", "Items waiting in an in-process queue.", ("indexer", "queue")))
+indexed_block_height = REGISTRY.register(Gauge(
+    "indexed_block_height", "Highest block height written by each indexer.", ("indexer",)))
+node_block_height = REGISTRY.register(Gauge(
+    "node_block_height", "Latest block height reported by the Bitcoin node.", ("indexer",)))
+indexer_lag_blocks = REGISTRY.register(Gauge(
+    "indexer_lag_blocks", "Node tip height minus the highest indexed height.", ("indexer",)))
+process_resident_memory = REGISTRY.register(Gauge(
+    "process_resident_memory_bytes", "Resident set size of the process."))
+
+# incremented by BitcoinNode, a forked worker sends these back with its result
+NODE_METRICS = (rpc_calls, rpc_latency, vout_lookups)
+
+
+def snapshot_metrics(metrics):
+    return [metric.snapshot() for metric in metrics]
+
+
+def metric_deltas(metrics, snapshots):
+    return [metric.delta(snapshot) for metric, snapshot in zip(metrics, snapshots)]
+
+
+def merge_metric_deltas(metrics, deltas):
+    for metric, delta in zip(metrics, deltas):
+        metric.merge(delta)
+
+
+def report_block_heights(indexer, indexed_height=None, node_height=None):
+    # backfills and gap filling write below the tip, the gauge only ever moves up
+    if indexed_height is not None:
+        highest_height = indexed_block_height.get(indexer=indexer)
+        if highest_height is None or indexed_height > highest_height:
+            indexed_block_height.set(indexed_height, indexer=indexer)
+    if node_height is not None:
+        node_block_height.set(node_height, indexer=indexer)
+    indexed_height = indexed_block_height.get(indexer=indexer)
+    node_height = node_block_height.get(indexer=indexer)
+    if indexed_height is not None and node_height is not None:
+        indexer_lag_blocks.set(node_height - indexed_height, indexer=indexer)
+
+
+@contextmanager
+def time_rpc(method):
+    start_time = time.perf_counter()
+    status = "error"
+    try:
+        yield
+        status = "ok"
+    finally:
+        rpc_latency.observe(time.perf_counter() - start_time, method=method)
+        rpc_calls.inc(method=method, status=status)
+
+
+def _collect_process_metrics():
+    try:
+        with open("/proc/self/statm") as file:
+            process_resident_memory.set(int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE"))
+    except OSError:
+        # peak rather than current RSS where /proc is not available (kilobytes on Linux, bytes on macOS)
+        process_resident_memory.set(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+
+
+REGISTRY.add_collector(_collect_process_metrics)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(port: int = None, host: str = None):
+    # serves /metrics from a daemon thread, disabled unless METRICS_PORT (or port) is set
+    if port is None:
+        port = int(os.environ.get("METRICS_PORT") or 0)
+    if host is None:
+        host = os.environ.get("METRICS_HOST") or "0.0.0.0"
+    if not port:
+        return None
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info("Serving metrics", extra=logger_extra_data(host=host, port=port))
+    return server
@@ -1,19 +1,69 @@
+import io
 import os
+import time
+from collections import OrderedDict
 from datetime import datetime
 
 from setup_logger import setup_logger
 from setup_logger import logger_extra_data
+from metrics import block_stage_seconds, db_commit_seconds
+from profiling import span
+from node.deal_encoding import EncodedBlock
 
-from sqlalchemy import create_engine, inspect, text
-from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy import String, bindparam, create_engine, func, inspect, text
+from sqlalchemy.dialects.postgresql import ARRAY, insert
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.sql import select
 
-from .balance_model import Base, BalanceChange, Block
+from .balance_model import (
+    Base, Address, BalanceChange, Block, CurrentBalance, BalanceSnapshot, BalanceSnapshotBlock, TopHolder, TopHolderSnapshot
+)
 
 logger = setup_logger("BalanceIndexer")
 
+# pg_advisory_xact_lock key serializing top_holders refreshes of concurrent writers
+TOP_HOLDERS_LOCK_ID = 7061
+
+
+def aggregate_balance_changes(deal_data, block_height):
+    # one (address, block, d_balance, block_timestamp) row per address changed in the block
+    if isinstance(deal_data, EncodedBlock):
+        block_timestamp = datetime.utcfromtimestamp(deal_data.timestamp) if len(deal_data) else None
+        balance_changes_by_address = deal_data.balance_changes()
+    else:
+        block_timestamp = None
+        balance_changes_by_address = {}
+
+        for value in deal_data.values():
+            in_amount_by_address = value['in_amount_by_address']
+            out_amount_by_address = value['out_amount_by_address']
+            tx_info = value['tx_info']
+            if block_timestamp is None:
+                block_timestamp = datetime.utcfromtimestamp(tx_info['timestamp'])
+
+            for address in value['input_addresses']:
+                balance_changes_by_address[address] = balance_changes_by_address.get(address, 0) - in_amount_by_address[address]
+
+            for address in value['output_addresses']:
+                balance_changes_by_address[address] = balance_changes_by_address.get(address, 0) + out_amount_by_address[address]
+
+    balance_rows = [(address, block_height, d_balance, block_timestamp) for address, d_balance in balance_changes_by_address.items()]
+    return balance_rows, block_timestamp
+
+
+def copy_rows(cursor, table, columns, rows):
+    # stream rows through COPY ... FROM STDIN using PostgreSQL's text format
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(
+            "\\N" if value is None else str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+            for value in row
+        ))
+        buffer.write("\n")
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+
 
 class BalanceIndexer:
     def __init__(self, db_url: str = None):
@@ -26,6 +76,20 @@ class BalanceIndexer:
         self.engine = create_engine(self.db_url)
         self.Session = sessionmaker(bind=self.engine)
 
+        # bulk write path, COPY needs the psycopg2 driver
+        self.use_copy = (os.environ.get("BALANCE_INDEXER_USE_COPY") or "1") == "1"
+        self.last_write_stats = None
+
+        # snapshot heights end a hypertable chunk (chunk_time_interval => 12960), 0 disables snapshots
+        self.snapshot_interval = int(os.environ.get("BALANCE_INDEXER_SNAPSHOT_INTERVAL") or 12960)
+
+        # size of the top_holders leaderboard, 0 disables it
+        self.top_holders_size = int(os.environ.get("BALANCE_INDEXER_TOP_HOLDERS") or 1000)
+
+        # bounded LRU cache in front of the addresses dictionary
+        self.address_cache_size = int(os.environ.get("BALANCE_INDEXER_ADDRESS_CACHE_SIZE") or 1000000)
+        self.address_ids = OrderedDict()
+
         # check if table exists and create if not
         connection = self.engine.connect()
 
@@ -33,10 +97,12 @@ class BalanceIndexer:
         inspector = inspect(self.engine)
 
         # Check if the table already exists
-        if (not inspector.has_table('balance_changes')) or (not inspector.has_table('blocks')):
-            # Create the table in the database
+        if not all(inspector.has_table(table_name) for table_name in Base.metadata.tables):
+            if inspector.has_table('balance_changes') and not inspector.has_table('current_balances'):
+                logger.warning("Table `current_balances` is new, rebuild it before serving balances from it")
+            # Create the missing tables in the database
             Base.metadata.create_all(self.engine)
-            logger.info("Created 3 tables: `balance_changes`, `blocks`")
+            logger.info(f"Created tables: {', '.join(f'`{table_name}`' for table_name in Base.metadata.tables)}")
 
         # Close the connection
         connection.close()
@@ -53,6 +119,7 @@ class BalanceIndexer:
                 conn.execute(text(
                     "SELECT create_hypertable('balance_changes', 'block', chunk_time_interval => 12960, migrate_data => true);"
                 ))
+                conn.commit()
 
     def setup_db(self):
         with self.engine.connect() as conn:
@@ -86,77 +153,521 @@ class BalanceIndexer:
             conn.execute(text(
                 "DO $$ BEGIN IF NOT EXISTS (SELECT 1 FROM pg_class WHERE relname = 'idx_block_timestamp') THEN CREATE INDEX idx_block_timestamp ON balance_changes (block_timestamp); END IF; END $$;"))
 
+            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_current_balances_balance ON current_balances (balance);"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_balance_snapshots_block_balance ON balance_snapshots (block, balance);"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_balance_snapshots_balance ON balance_snapshots (balance);"))
+
+            # blocks indexed before reorg support have no recorded hash
+            conn.execute(text("ALTER TABLE blocks ADD COLUMN IF NOT EXISTS block_hash VARCHAR;"))
+            conn.commit()
+
     def get_latest_block_number(self):
+        # a primary key lookup on blocks, errors propagate instead of restarting from genesis
         with self.Session() as session:
-            try:
-                latest_balance_change = session.query(BalanceChange).order_by(BalanceChange.block.desc()).first()
-                latest_block = latest_balance_change.block
-            except Exception as e:
-                latest_block = 0
-            return latest_block
+            latest_block = session.scalar(select(func.max(Block.block_height)))
+            return 0 if latest_block is None else latest_block
 
     from decimal import getcontext
 
     # Set the precision high enough to handle satoshis for Bitcoin transactions
     getcontext().prec = 28
 
-    def create_rows_focused_on_balance_changes(self, deal_data, block_height):
-        # block_height = block_data.block_height
-
-        block_timestamp = None
-        # transactions = block_data.transactions
-
-        balance_changes_by_address = {}
-        changed_addresses = []
-
-        for value in deal_data.values():
-            # in_amount_by_address, out_amount_by_address, input_addresses, output_addresses, in_total_amount, _ = _bitcoin_node.process_in_memory_txn_for_indexing(
-            #     tx)
-            in_amount_by_address = value['in_amount_by_address']
-            out_amount_by_address = value['out_amount_by_address']
-            input_addresses = value['input_addresses']
-            output_addresses = value['output_addresses']
-            # in_total_amount = value['in_total_amount']
-            # out_total_amount = value['out_total_amount']
-            tx_info = value['tx_info']
-            if block_timestamp is None:
-                block_timestamp = datetime.utcfromtimestamp(tx_info['timestamp'])
-
-            for address in input_addresses:
-                if address not in balance_changes_by_address:
-                    balance_changes_by_address[address] = 0
-                    changed_addresses.append(address)
-                balance_changes_by_address[address] -= in_amount_by_address[address]
-
-            for address in output_addresses:
-                if address not in balance_changes_by_address:
-                    balance_changes_by_address[address] = 0
-                    changed_addresses.append(address)
-                balance_changes_by_address[address] += out_amount_by_address[address]
-
-        logger.info(f"Adding row(s)...", extra=logger_extra_data(add_rows=len(changed_addresses)))
-
-        new_rows = [BalanceChange(address=address, d_balance=balance_changes_by_address[address], block=block_height,
-                                  block_timestamp=block_timestamp) for address in changed_addresses]
+    def get_indexed_block_hash(self, block_height):
+        with self.Session() as session:
+            block = session.get(Block, block_height)
+            return block.block_hash if block else None
 
+    def delete_block(self, block_height):
+        # balance_changes is chunked on block, so both deletes only touch the block's own rows
         with self.Session() as session:
             try:
-                # Add the new rows to the balance_changes table
-                session.add_all(new_rows)
-
-                # Add new row to blocks table
-                session.add(Block(block_height=block_height, timestamp=block_timestamp))
-
-                # Commit the session to save the changes to the database
+                updated = session.execute(text("""
+                    WITH deleted AS (
+                        DELETE FROM balance_changes WHERE block = :block_height
+                        RETURNING address_id, d_balance
+                    )
+                    UPDATE current_balances c
+                    SET balance = c.balance - d.d_balance,
+                        last_block = (
+                            SELECT MAX(b.block) FROM balance_changes b
+                            WHERE b.address_id = d.address_id AND b.block < :block_height
+                        )
+                    FROM deleted d
+                    JOIN addresses a ON a.id = d.address_id
+                    WHERE c.address = a.address
+                    RETURNING c.address, c.last_block
+                """), {"block_height": block_height}).all()
+                # addresses that first appeared in the block
+                session.query(CurrentBalance).filter(CurrentBalance.address.in_(
+                    [address for address, last_block in updated if last_block is None]
+                )).delete(synchronize_session=False)
+                session.query(BalanceSnapshot).filter(BalanceSnapshot.block >= block_height).delete(synchronize_session=False)
+                session.query(TopHolderSnapshot).filter(TopHolderSnapshot.block >= block_height).delete(synchronize_session=False)
+                session.query(BalanceSnapshotBlock).filter(BalanceSnapshotBlock.block_height >= block_height).delete(synchronize_session=False)
+                session.query(Block).filter(Block.block_height == block_height).delete(synchronize_session=False)
+                self._refresh_top_holders(session.connection())
                 session.commit()
-
                 return True
 
             except SQLAlchemyError as e:
-                # Rollback the session in case of an error
                 session.rollback()
-                logger.error(f"An exception occurred", extra=logger_extra_data(
+                logger.error(f"An exception occurred while deleting block", extra=logger_extra_data(
+                    block_height=block_height,
                     error={'exception_type': e.__class__.__name__, 'exception_message': str(e),
                            'exception_args': e.args}))
 
                 return False
+
+    def rebuild_current_balances(self):
+        # the balance indexer must be stopped while rebuilding
+        with self.engine.connect() as conn:
+            conn.execute(text("TRUNCATE current_balances"))
+            result = conn.execute(text("""
+                INSERT INTO current_balances (address, balance, last_block)
+                SELECT a.address, SUM(b.d_balance), MAX(b.block)
+                FROM balance_changes b
+                JOIN addresses a ON a.id = b.address_id
+                GROUP BY a.address
+            """))
+            self._refresh_top_holders(conn)
+            conn.commit()
+            return result.rowcount
+
+    def _refresh_top_holders(self, conn, changed_balances=None):
+        # re-ranks from the balance index only when a changed address is on the leaderboard or can enter it
+        if not self.top_holders_size:
+            return
+
+        conn.execute(text("SELECT pg_advisory_xact_lock(:lock_id)"), {"lock_id": TOP_HOLDERS_LOCK_ID})
+        if changed_balances is not None:
+            top_holders = dict(conn.execute(select(TopHolder.address, TopHolder.balance)).all())
+            if len(top_holders) >= self.top_holders_size:
+                min_balance = min(top_holders.values())
+                if not any(address in top_holders or balance >= min_balance for address, balance in changed_balances):
+                    return
+
+        conn.execute(text("DELETE FROM top_holders"))
+        conn.execute(text("""
+            INSERT INTO top_holders (address, balance)
+            SELECT address, balance FROM current_balances
+            ORDER BY balance DESC
+            LIMIT :top_holders_size
+        """), {"top_holders_size": self.top_holders_size})
+
+    def needs_address_migration(self):
+        # balance_changes created before the addresses dictionary is keyed on the address text
+        return "address" in {column["name"] for column in inspect(self.engine).get_columns("balance_changes")}
+
+    def migrate_to_address_ids(self, blocks_per_batch=12960):
+        # moves balance_changes(address, ...) to balance_changes_v1 and copies it over batch by batch,
+        # the balance indexer must be stopped, an interrupted migration resumes from the last batch
+        inspector = inspect(self.engine)
+        if self.needs_address_migration():
+            if inspector.has_table("balance_changes_v1"):
+                raise RuntimeError("Both balance_changes and balance_changes_v1 are keyed on the address text")
+            with self.engine.begin() as conn:
+                conn.execute(text("ALTER TABLE balance_changes RENAME TO balance_changes_v1"))
+                conn.execute(text("ALTER INDEX balance_changes_pkey RENAME TO balance_changes_v1_pkey"))
+                conn.execute(text("ALTER INDEX idx_block_timestamp RENAME TO idx_v1_block_timestamp"))
+            Base.metadata.create_all(self.engine, tables=[Address.__table__, BalanceChange.__table__])
+            self._ensure_hypertable_exists()
+            logger.info("Renamed `balance_changes` to `balance_changes_v1`")
+        elif not inspector.has_table("balance_changes_v1"):
+            logger.info("Nothing to migrate")
+            return 0
+
+        with self.engine.connect() as conn:
+            min_block, max_block = conn.execute(text("SELECT MIN(block), MAX(block) FROM balance_changes_v1")).one()
+            migrated_block = conn.execute(text("SELECT MAX(block) FROM balance_changes")).scalar()
+        if min_block is None:
+            return 0
+
+        num_rows = 0
+        start_block = min_block if migrated_block is None else migrated_block
+        for batch_start in range(start_block, max_block + 1, blocks_per_batch):
+            batch_end = batch_start + blocks_per_batch - 1
+            start_time = time.time()
+            with self.engine.begin() as conn:
+                conn.execute(text("""
+                    INSERT INTO addresses (address)
+                    SELECT DISTINCT address FROM balance_changes_v1
+                    WHERE block BETWEEN :batch_start AND :batch_end
+                    ORDER BY address
+                    ON CONFLICT DO NOTHING
+                """), {"batch_start": batch_start, "batch_end": batch_end})
+                result = conn.execute(text("""
+                    INSERT INTO balance_changes (address_id, block, d_balance, block_timestamp)
+                    SELECT a.id, b.block, b.d_balance, b.block_timestamp
+                    FROM balance_changes_v1 b
+                    JOIN addresses a ON a.address = b.address
+                    WHERE b.block BETWEEN :batch_start AND :batch_end
+                    ON CONFLICT DO NOTHING
+                """), {"batch_start": batch_start, "batch_end": batch_end})
+            num_rows += result.rowcount
+            logger.info("Migrated balance changes", extra=logger_extra_data(
+                batch_start=batch_start, batch_end=batch_end, num_rows=result.rowcount, time_taken=time.time() - start_time))
+
+        return num_rows
+
+    def get_storage_report(self):
+        storage_report = {}
+        with self.engine.connect() as conn:
+            has_timescaledb = conn.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'timescaledb'")).fetchone() is not None
+            for table_name in ("balance_changes", "balance_changes_v1"):
+                if not inspect(conn).has_table(table_name):
+                    continue
+                is_hypertable = has_timescaledb and conn.execute(text(
+                    "SELECT 1 FROM timescaledb_information.hypertables WHERE hypertable_name = :table_name"
+                ), {"table_name": table_name}).fetchone() is not None
+                if is_hypertable:
+                    table_bytes, index_bytes, toast_bytes, total_bytes = conn.execute(text(
+                        "SELECT table_bytes, index_bytes, toast_bytes, total_bytes FROM hypertable_detailed_size(CAST(:table_name AS regclass))"
+                    ), {"table_name": table_name}).one()
+                else:
+                    # a plain table, as on a PostgreSQL without TimescaleDB
+                    table_bytes, index_bytes, toast_bytes, total_bytes = conn.execute(text("""
+                        SELECT pg_relation_size(c.oid), pg_indexes_size(c.oid),
+                               COALESCE(pg_total_relation_size(NULLIF(c.reltoastrelid, 0)), 0), pg_total_relation_size(c.oid)
+                        FROM pg_class c WHERE c.oid = CAST(:table_name AS regclass)
+                    """), {"table_name": table_name}).one()
+                storage_report[table_name] = {
+                    "table_bytes": table_bytes, "index_bytes": index_bytes,
+                    "toast_bytes": toast_bytes, "total_bytes": total_bytes,
+                }
+            table_bytes, index_bytes, total_bytes = conn.execute(text(
+                "SELECT pg_table_size('addresses'), pg_indexes_size('addresses'), pg_total_relation_size('addresses')"
+            )).one()
+            storage_report["addresses"] = {"table_bytes": table_bytes, "index_bytes": index_bytes, "total_bytes": total_bytes}
+        return storage_report
+
+    def get_latest_snapshot_height(self):
+        with self.Session() as session:
+            latest_snapshot_height = session.scalar(select(func.max(BalanceSnapshotBlock.block_height)))
+            return -1 if latest_snapshot_height is None else latest_snapshot_height
+
+    def create_balance_snapshots(self):
+        # snapshots every complete window after the latest snapshot, returns the number of snapshots created
+        if not self.snapshot_interval:
+            return 0
+
+        num_snapshots = 0
+        latest_snapshot_height = self.get_latest_snapshot_height()
+        while True:
+            start_height = latest_snapshot_height + 1
+            snapshot_height = (start_height // self.snapshot_interval + 1) * self.snapshot_interval - 1
+
+            with self.Session() as session:
+                try:
+                    # the genesis block is never indexed
+                    num_blocks = session.scalar(select(func.count()).select_from(Block).where(
+                        Block.block_height.between(start_height, snapshot_height)))
+                    if num_blocks < snapshot_height - max(start_height, 1) + 1:
+                        return num_snapshots
+
+                    start_time = time.time()
+                    result = session.execute(text("""
+                        INSERT INTO balance_snapshots (address, block, balance)
+                        SELECT w.address, :snapshot_height, COALESCE(p.balance, 0) + w.d_balance
+                        FROM (
+                            SELECT a.address, SUM(b.d_balance) AS d_balance
+                            FROM balance_changes b
+                            JOIN addresses a ON a.id = b.address_id
+                            WHERE b.block BETWEEN :start_height AND :snapshot_height
+                            GROUP BY a.address
+                        ) w
+                        LEFT JOIN LATERAL (
+                            SELECT s.balance FROM balance_snapshots s
+                            WHERE s.address = w.address AND s.block < :start_height
+                            ORDER BY s.block DESC
+                            LIMIT 1
+                        ) p ON true
+                        ON CONFLICT DO NOTHING
+                    """), {"start_height": start_height, "snapshot_height": snapshot_height})
+                    self._create_top_holder_snapshot(session, latest_snapshot_height, snapshot_height)
+                    session.add(BalanceSnapshotBlock(block_height=snapshot_height, num_addresses=result.rowcount))
+                    session.commit()
+
+                except SQLAlchemyError as e:
+                    session.rollback()
+                    logger.error(f"An exception occurred while creating balance snapshot", extra=logger_extra_data(
+                        snapshot_height=snapshot_height,
+                        error={'exception_type': e.__class__.__name__, 'exception_message': str(e),
+                               'exception_args': e.args}))
+
+                    return num_snapshots
+
+            logger.info(f"Created balance snapshot", extra=logger_extra_data(
+                snapshot_height=snapshot_height, num_addresses=result.rowcount, time_taken=time.time() - start_time))
+            num_snapshots += 1
+            latest_snapshot_height = snapshot_height
+
+    def _create_top_holder_snapshot(self, session, previous_snapshot_height, snapshot_height):
+        if not self.top_holders_size:
+            return
+
+        previous_top_holders = dict(session.execute(
+            select(TopHolderSnapshot.address, TopHolderSnapshot.balance).where(TopHolderSnapshot.block == previous_snapshot_height)
+        ).all())
+
+        # addresses changed in the window plus the previous leaders that did not change
+        candidates = dict(session.execute(text("""
+            SELECT address, balance FROM (
+                SELECT address, balance FROM balance_snapshots WHERE block = :snapshot_height
+                UNION ALL
+                SELECT t.address, t.balance FROM top_holder_snapshots t
+                WHERE t.block = :previous_snapshot_height AND NOT EXISTS (
+                    SELECT 1 FROM balance_snapshots s WHERE s.address = t.address AND s.block = :snapshot_height
+                )
+            ) c
+            ORDER BY balance DESC
+            LIMIT :top_holders_size
+        """), {
+            "snapshot_height": snapshot_height,
+            "previous_snapshot_height": previous_snapshot_height,
+            "top_holders_size": self.top_holders_size,
+        }).all())
+
+        # previous leaders dropped below the old threshold, unchanged outsiders above the new one can enter
+        if len(previous_top_holders) >= self.top_holders_size and candidates:
+            threshold = min(candidates.values())
+            if threshold < min(previous_top_holders.values()):
+                candidates.update(session.execute(text("""
+                    SELECT s.address, s.balance FROM balance_snapshots s
+                    WHERE s.balance >= :threshold AND s.block <= :previous_snapshot_height
+                    AND NOT EXISTS (
+                        SELECT 1 FROM balance_snapshots l
+                        WHERE l.address = s.address AND l.block > s.block AND l.block <= :snapshot_height
+                    )
+                """), {
+                    "threshold": threshold,
+                    "previous_snapshot_height": previous_snapshot_height,
+                    "snapshot_height": snapshot_height,
+                }).all())
+
+        top_holders = sorted(candidates.items(), key=lambda item: item[1], reverse=True)[:self.top_holders_size]
+        if top_holders:
+            session.execute(insert(TopHolderSnapshot), [
+                {"block": snapshot_height, "address": address, "balance": balance}
+                for address, balance in top_holders
+            ])
+
+    def get_indexed_block_heights(self, start_height, end_height):
+        with self.Session() as session:
+            return set(session.scalars(
+                select(Block.block_height).where(Block.block_height.between(start_height, end_height))
+            ))
+
+    @span("create_rows_focused_on_balance_changes")
+    def create_rows_focused_on_balance_changes(self, deal_data, block_height, block_hash=None):
+        with block_stage_seconds.time(indexer="balance_tracking", stage="prepare"):
+            balance_rows, block_timestamp = aggregate_balance_changes(deal_data, block_height)
+
+        logger.info(f"Adding row(s)...", extra=logger_extra_data(add_rows=len(balance_rows)))
+
+        with block_stage_seconds.time(indexer="balance_tracking", stage="write"):
+            return self.write_balance_rows(balance_rows, [(block_height, block_timestamp, block_hash)])
+
+    def create_rows_for_blocks(self, blocks):
+        # blocks is a list of (block_height, block_hash, deal_data), all written in a single transaction
+        balance_rows = []
+        block_rows = []
+        for block_height, block_hash, deal_data in blocks:
+            rows, block_timestamp = aggregate_balance_changes(deal_data, block_height)
+            balance_rows.extend(rows)
+            block_rows.append((block_height, block_timestamp, block_hash))
+
+        logger.info(f"Adding row(s)...", extra=logger_extra_data(add_rows=len(balance_rows), num_blocks=len(block_rows)))
+
+        return self.write_balance_rows(balance_rows, block_rows)
+
+    def get_address_ids(self, addresses):
+        # returns ({address: address_id}, number of newly assigned ids)
+        address_ids = {}
+        missing_addresses = []
+        for address in addresses:
+            address_id = self.address_ids.get(address)
+            if address_id is None:
+                missing_addresses.append(address)
+            else:
+                self.address_ids.move_to_end(address)
+                address_ids[address] = address_id
+
+        num_new_addresses = 0
+        if missing_addresses:
+            # sorted, so concurrent writers take the unique index locks in the same order
+            missing_addresses.sort()
+            select_address_ids = text(
+                "SELECT address, id FROM addresses WHERE address = ANY(:addresses)"
+            ).bindparams(bindparam("addresses", type_=ARRAY(String)))
+
+            # ids are assigned in their own transaction, so cached ids always refer to committed rows
+            with self.engine.begin() as conn:
+                found_address_ids = dict(conn.execute(select_address_ids, {"addresses": missing_addresses}).all())
+                new_addresses = [address for address in missing_addresses if address not in found_address_ids]
+                if new_addresses:
+                    inserted_address_ids = dict(conn.execute(text("""
+                        INSERT INTO addresses (address)
+                        SELECT address FROM unnest(:addresses) AS a(address)
+                        ON CONFLICT DO NOTHING
+                        RETURNING address, id
+                    """).bindparams(bindparam("addresses", type_=ARRAY(String))), {"addresses": new_addresses}).all())
+                    num_new_addresses = len(inserted_address_ids)
+                    found_address_ids.update(inserted_address_ids)
+
+                    # assigned by a concurrent writer in the meantime
+                    raced_addresses = [address for address in new_addresses if address not in inserted_address_ids]
+                    if raced_addresses:
+                        found_address_ids.update(conn.execute(select_address_ids, {"addresses": raced_addresses}).all())
+
+            address_ids.update(found_address_ids)
+            self.address_ids.update(found_address_ids)
+            while len(self.address_ids) > self.address_cache_size:
+                self.address_ids.popitem(last=False)
+
+        return address_ids, num_new_addresses
+
+    def write_balance_rows(self, balance_rows, block_rows):
+        start_time = time.time()
+        write_method = "copy" if self.use_copy else "executemany"
+        try:
+            address_ids, num_new_addresses = self.get_address_ids({address for address, _, _, _ in balance_rows})
+            balance_rows = [
+                (address_ids[address], address, block, d_balance, block_timestamp)
+                for address, block, d_balance, block_timestamp in balance_rows
+            ]
+
+            if self.use_copy:
+                try:
+                    self._write_rows_with_copy(balance_rows, block_rows)
+                except AttributeError:
+                    # the DBAPI driver has no copy_expert (not psycopg2), stay on executemany from now on
+                    logger.info("COPY is not supported by the database driver, falling back to executemany")
+                    self.use_copy = False
+                    write_method = "executemany"
+                    self._write_rows_with_executemany(balance_rows, block_rows)
+            else:
+                self._write_rows_with_executemany(balance_rows, block_rows)
+
+        except Exception as e:
+            logger.error(f"An exception occurred", extra=logger_extra_data(
+                error={'exception_type': e.__class__.__name__, 'exception_message': str(e),
+                       'exception_args': e.args}))
+
+            return False
+
+        write_time = time.time() - start_time
+        self.last_write_stats = {
+            "rows": len(balance_rows),
+            "new_addresses": num_new_addresses,
+            "write_method": write_method,
+            "write_time": write_time,
+            "rows_per_sec": len(balance_rows) / write_time if write_time > 0 else float("inf"),
+        }
+        return True
+
+    def _write_rows_with_copy(self, balance_rows, block_rows):
+        # the statements run on the DBAPI cursor, the transaction is begun explicitly so its commit reaches the
+        # driver; conn.commit() alone does nothing when no SQLAlchemy statement began one
+        with self.engine.connect() as conn:
+            transaction = conn.begin()
+            try:
+                changed_balances = self._copy_balance_rows(conn.connection.cursor(), balance_rows, block_rows)
+                self._refresh_top_holders(conn, changed_balances)
+                with db_commit_seconds.time(db="postgres"):
+                    transaction.commit()
+            except Exception:
+                transaction.rollback()
+                raise
+
+    @staticmethod
+    def _copy_balance_rows(cursor, balance_rows, block_rows):
+        # COPY has no ON CONFLICT, so stage the rows and move them over with INSERT ... SELECT
+        cursor.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS balance_changes_staging "
+            "(address_id BIGINT, address VARCHAR, block INTEGER, d_balance BIGINT, block_timestamp TIMESTAMP) "
+            "ON COMMIT DELETE ROWS"
+        )
+        cursor.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS blocks_staging "
+            "(LIKE blocks INCLUDING DEFAULTS) ON COMMIT DELETE ROWS"
+        )
+        copy_rows(cursor, "balance_changes_staging", ("address_id", "address", "block", "d_balance", "block_timestamp"), balance_rows)
+        copy_rows(cursor, "blocks_staging", ("block_height", "timestamp", "block_hash"), block_rows)
+        # only rows that were actually inserted move current_balances, so replays stay idempotent
+        cursor.execute("""
+            WITH inserted AS (
+                INSERT INTO balance_changes (address_id, block, d_balance, block_timestamp)
+                SELECT address_id, block, d_balance, block_timestamp FROM balance_changes_staging
+                ON CONFLICT DO NOTHING
+                RETURNING address_id, block, d_balance
+            )
+            INSERT INTO current_balances (address, balance, last_block)
+            SELECT s.address, SUM(i.d_balance), MAX(i.block)
+            FROM inserted i
+            JOIN balance_changes_staging s ON s.address_id = i.address_id AND s.block = i.block
+            GROUP BY s.address
+            ORDER BY s.address
+            ON CONFLICT (address) DO UPDATE
+            SET balance = current_balances.balance + EXCLUDED.balance,
+                last_block = GREATEST(current_balances.last_block, EXCLUDED.last_block)
+            RETURNING address, balance
+        """)
+        changed_balances = cursor.fetchall()
+        cursor.execute(
+            "INSERT INTO blocks (block_height, timestamp, block_hash) "
+            "SELECT block_height, timestamp, block_hash FROM blocks_staging "
+            "ON CONFLICT DO NOTHING"
+        )
+        return changed_balances
+
+    def _write_rows_with_executemany(self, balance_rows, block_rows):
+        with self.Session() as session:
+            try:
+                changed_balances = []
+                if balance_rows:
+                    addresses = {address_id: address for address_id, address, _, _, _ in balance_rows}
+                    inserted = session.execute(
+                        insert(BalanceChange).on_conflict_do_nothing().returning(
+                            BalanceChange.address_id, BalanceChange.block, BalanceChange.d_balance),
+                        [
+                            {"address_id": address_id, "block": block, "d_balance": d_balance, "block_timestamp": block_timestamp}
+                            for address_id, _, block, d_balance, block_timestamp in balance_rows
+                        ]
+                    ).all()
+                    changed_balances = self._upsert_current_balances(session, [
+                        (addresses[address_id], block, d_balance) for address_id, block, d_balance in inserted
+                    ])
+                session.execute(insert(Block).on_conflict_do_nothing(), [
+                    {"block_height": block_height, "timestamp": timestamp, "block_hash": block_hash}
+                    for block_height, timestamp, block_hash in block_rows
+                ])
+                self._refresh_top_holders(session.connection(), changed_balances)
+                with db_commit_seconds.time(db="postgres"):
+                    session.commit()
+            except SQLAlchemyError:
+                session.rollback()
+                raise
+
+    @staticmethod
+    def _upsert_current_balances(session, inserted_rows):
+        current_balances = {}
+        for address, block, d_balance in inserted_rows:
+            balance, last_block = current_balances.get(address, (0, block))
+            current_balances[address] = (balance + d_balance, max(last_block, block))
+        if not current_balances:
+            return []
+
+        statement = insert(CurrentBalance)
+        return session.execute(
+            statement.on_conflict_do_update(
+                index_elements=[CurrentBalance.address],
+                set_={
+                    "balance": CurrentBalance.balance + statement.excluded.balance,
+                    "last_block": func.greatest(CurrentBalance.last_block, statement.excluded.last_block),
+                }
+            ).returning(CurrentBalance.address, CurrentBalance.balance),
+            [
+                {"address": address, "balance": balance, "last_block": last_block}
+                for address, (balance, last_block) in sorted(current_balances.items())
+            ]
+        ).all()
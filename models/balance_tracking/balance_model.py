@@ -4,16 +4,23 @@ from sqlalchemy.ext.declarative import declarative_base
 Base = declarative_base()
 
 
+class Address(Base):
+    __tablename__   = 'addresses'
+
+    id          = Column(BigInteger, primary_key=True, autoincrement=True)
+    address     = Column(String, nullable=False, unique=True)
+
+
 class BalanceChange(Base):
     __tablename__   = 'balance_changes'
 
-    address     = Column(String, primary_key=True)
+    address_id  = Column(BigInteger, primary_key=True)
     block       = Column(Integer, primary_key=True)
     d_balance   = Column(BigInteger)
     block_timestamp = Column(TIMESTAMP)
     
     __table_args__ = (
-        PrimaryKeyConstraint('address', 'block'),
+        PrimaryKeyConstraint('address_id', 'block'),
         Index('idx_block_timestamp', 'block_timestamp'),
     )
 
@@ -23,8 +30,70 @@ class Block(Base):
     
     block_height     = Column(Integer, primary_key=True)
     timestamp        = Column(TIMESTAMP)
+    block_hash       = Column(String)
     
     __table_args__ = (
         PrimaryKeyConstraint('block_height'),
         Index('idx_timestamp', 'timestamp'),
     )
+
+
+class CurrentBalance(Base):
+    __tablename__   = 'current_balances'
+
+    address     = Column(String, primary_key=True)
+    balance     = Column(BigInteger)
+    last_block  = Column(Integer)
+
+    __table_args__ = (
+        PrimaryKeyConstraint('address'),
+        Index('idx_current_balances_balance', 'balance'),
+    )
+
+
+class BalanceSnapshot(Base):
+    __tablename__   = 'balance_snapshots'
+
+    address     = Column(String, primary_key=True)
+    block       = Column(Integer, primary_key=True)
+    balance     = Column(BigInteger)
+
+    __table_args__ = (
+        PrimaryKeyConstraint('address', 'block'),
+        Index('idx_balance_snapshots_block_balance', 'block', 'balance'),
+        Index('idx_balance_snapshots_balance', 'balance'),
+    )
+
+
+class BalanceSnapshotBlock(Base):
+    __tablename__   = 'balance_snapshot_blocks'
+
+    block_height     = Column(Integer, primary_key=True)
+    num_addresses    = Column(Integer)
+
+    __table_args__ = (
+        PrimaryKeyConstraint('block_height'),
+    )
+
+
+class TopHolder(Base):
+    __tablename__   = 'top_holders'
+
+    address     = Column(String, primary_key=True)
+    balance     = Column(BigInteger)
+
+    __table_args__ = (
+        PrimaryKeyConstraint('address'),
+    )
+
+
+class TopHolderSnapshot(Base):
+    __tablename__   = 'top_holder_snapshots'
+
+    block       = Column(Integer, primary_key=True)
+    address     = Column(String, primary_key=True)
+    balance     = Column(BigInteger)
+
+    __table_args__ = (
+        PrimaryKeyConstraint('block', 'address'),
+    )
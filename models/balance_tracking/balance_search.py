@@ -1,9 +1,12 @@
 import os
 
 from setup_logger import setup_logger
-from sqlalchemy import create_engine, text
+from sqlalchemy import String, bindparam, create_engine, func, select, text
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.orm import sessionmaker
 
+from .balance_model import CurrentBalance, BalanceSnapshotBlock, TopHolder, TopHolderSnapshot
+
 logger = setup_logger("BalanceSearch")
 
 
@@ -42,3 +45,124 @@ class BalanceSearch:
             """)
             ranges = session.execute(ranges_query).fetchall()
             return ranges
+
+    def get_balance(self, address):
+        # None for an address that never appeared on chain
+        with self.Session() as session:
+            current_balance = session.get(CurrentBalance, address)
+            return current_balance.balance if current_balance else None
+
+    def get_balances(self, addresses):
+        with self.Session() as session:
+            rows = session.execute(
+                select(CurrentBalance.address, CurrentBalance.balance).where(CurrentBalance.address.in_(list(addresses)))
+            ).all()
+            return {address: balance for address, balance in rows}
+
+    @staticmethod
+    def _get_snapshot_height(session, block_height):
+        snapshot_height = session.scalar(
+            select(func.max(BalanceSnapshotBlock.block_height)).where(BalanceSnapshotBlock.block_height <= block_height)
+        )
+        return -1 if snapshot_height is None else snapshot_height
+
+    def get_balance_at(self, address, block_height):
+        return self.get_balances_at([address], block_height)[address]
+
+    def get_balances_at(self, addresses, block_height):
+        # balance after block_height: the latest snapshot at or below it plus the deltas since
+        addresses = list(addresses)
+        with self.Session() as session:
+            snapshot_height = self._get_snapshot_height(session, block_height)
+            rows = session.execute(text("""
+                SELECT a.address, COALESCE(s.balance, 0) + COALESCE(d.d_balance, 0)
+                FROM unnest(:addresses) AS a(address)
+                LEFT JOIN LATERAL (
+                    SELECT balance FROM balance_snapshots
+                    WHERE address = a.address AND block <= :snapshot_height
+                    ORDER BY block DESC
+                    LIMIT 1
+                ) s ON true
+                LEFT JOIN (
+                    SELECT ad.address, SUM(b.d_balance) AS d_balance
+                    FROM balance_changes b
+                    JOIN addresses ad ON ad.id = b.address_id
+                    WHERE ad.address = ANY(:addresses) AND b.block > :snapshot_height AND b.block <= :block_height
+                    GROUP BY ad.address
+                ) d ON d.address = a.address
+            """).bindparams(bindparam("addresses", type_=ARRAY(String))), {
+                "addresses": addresses,
+                "snapshot_height": snapshot_height,
+                "block_height": block_height,
+            }).all()
+            return {address: balance for address, balance in rows}
+
+    def get_top_holders(self, n, at_height=None):
+        with self.Session() as session:
+            if at_height is None:
+                rows = session.execute(
+                    select(TopHolder.address, TopHolder.balance).order_by(TopHolder.balance.desc()).limit(n)
+                ).all()
+                if len(rows) < n:
+                    # beyond the leaderboard size, still served by the balance index
+                    rows = session.execute(
+                        select(CurrentBalance.address, CurrentBalance.balance).order_by(CurrentBalance.balance.desc()).limit(n)
+                    ).all()
+                return [{"address": address, "balance": balance} for address, balance in rows]
+
+            # the leaderboard of the latest snapshot at or below at_height, adjusted by the deltas since;
+            # at most the leaderboard size is served
+            snapshot_height = self._get_snapshot_height(session, at_height)
+            snapshot_top_holders = dict(session.execute(
+                select(TopHolderSnapshot.address, TopHolderSnapshot.balance).where(TopHolderSnapshot.block == snapshot_height)
+            ).all())
+            candidates = dict(snapshot_top_holders)
+
+            if at_height > snapshot_height:
+                # addresses outside the snapshot leaderboard can only enter it by receiving coins
+                candidates.update(session.execute(text("""
+                    SELECT d.address, COALESCE(p.balance, 0) + d.d_balance
+                    FROM (
+                        SELECT ad.address, SUM(b.d_balance) AS d_balance
+                        FROM balance_changes b
+                        JOIN addresses ad ON ad.id = b.address_id
+                        WHERE b.block > :snapshot_height AND b.block <= :at_height
+                        GROUP BY ad.address
+                    ) d
+                    LEFT JOIN LATERAL (
+                        SELECT balance FROM balance_snapshots
+                        WHERE address = d.address AND block <= :snapshot_height
+                        ORDER BY block DESC
+                        LIMIT 1
+                    ) p ON true
+                    WHERE d.d_balance > 0 OR d.address = ANY(:top_holders)
+                """).bindparams(bindparam("top_holders", type_=ARRAY(String))), {
+                    "snapshot_height": snapshot_height,
+                    "at_height": at_height,
+                    "top_holders": list(snapshot_top_holders),
+                }).all())
+
+                # snapshot leaders lost coins, unchanged outsiders above the new threshold can enter
+                top_balances = sorted(candidates.values(), reverse=True)[:len(snapshot_top_holders)]
+                if snapshot_top_holders and top_balances[-1] < min(snapshot_top_holders.values()):
+                    for address, balance in session.execute(text("""
+                        SELECT s.address, s.balance + COALESCE((
+                            SELECT SUM(b.d_balance) FROM balance_changes b
+                            WHERE b.address_id = (SELECT id FROM addresses WHERE address = s.address)
+                            AND b.block > :snapshot_height AND b.block <= :at_height
+                        ), 0)
+                        FROM balance_snapshots s
+                        WHERE s.balance >= :threshold AND s.block <= :snapshot_height
+                        AND NOT EXISTS (
+                            SELECT 1 FROM balance_snapshots l
+                            WHERE l.address = s.address AND l.block > s.block AND l.block <= :snapshot_height
+                        )
+                    """), {
+                        "threshold": top_balances[-1],
+                        "snapshot_height": snapshot_height,
+                        "at_height": at_height,
+                    }).all():
+                        candidates.setdefault(address, balance)
+
+            top_holders = sorted(candidates.items(), key=lambda item: item[1], reverse=True)[:n]
+            return [{"address": address, "balance": balance} for address, balance in top_holders]
@@ -1,14 +1,25 @@
+import gc
+import os
 import time
 import signal
+import sys
+import multiprocessing
 from node.node import BitcoinNode
 from setup_logger import setup_logger
 from setup_logger import logger_extra_data
-from node.node_utils import parse_block_data
+from setup_logger import configure_logging
 from models.balance_tracking.balance_indexer import BalanceIndexer
+from models.balance_tracking.balance_search import BalanceSearch
+from metrics import blocks_indexed, report_block_heights, start_metrics_server
+from profiling import BlockProfiler, setup_profiling
+from node.pipeline import FLUSH, Pipeline, Stage, StopPipeline
+from models.reorg import RecentBlockHashes, get_confirmations, rollback_reorged_blocks
 
 
 # Global flag to signal shutdown
 shutdown_flag = False
+# replaced in __main__ once .env is loaded, SIGUSR1 starts a capture
+block_profiler = BlockProfiler("balance_tracking")
 logger = setup_logger("Indexer")
 
 
@@ -20,24 +31,17 @@ def shutdown_handler(signum, frame):
     shutdown_flag = True
 
 
-def index_block(_bitcoin_node, _balance_indexer, block_height):
-    start_time = time.time()
-    # block = _bitcoin_node.get_block_by_height(block_height)
-    deal_data = _bitcoin_node.get_deal_data_by_block(block_height)
-    if deal_data is None:
-        shutdown_handler(None, None)
-        return False
-    num_transactions = len(deal_data)
-    # block_data = parse_block_data(block)
-    success = _balance_indexer.create_rows_focused_on_balance_changes(deal_data, block_height)
-    end_time = time.time()
-    time_taken = end_time - start_time
+def log_indexed_block(_balance_indexer, block_height, num_transactions, time_taken):
+    blocks_indexed.inc(indexer="balance_tracking")
+    report_block_heights("balance_tracking", indexed_height=block_height)
     formatted_num_transactions = "{:>4}".format(num_transactions)
     formatted_time_taken = "{:6.2f}".format(time_taken)
     formatted_tps = "{:8.2f}".format(
         num_transactions / time_taken if time_taken > 0 else float("inf")
     )
 
+    write_stats = _balance_indexer.last_write_stats or {}
+
     if time_taken > 0:
         logger.info(
             "Block Processed transactions",
@@ -46,6 +50,10 @@ def index_block(_bitcoin_node, _balance_indexer, block_height):
                 num_transactions = formatted_num_transactions,
                 time_taken = formatted_time_taken,
                 tps = formatted_tps,
+                num_rows = write_stats.get("rows"),
+                new_addresses = write_stats.get("new_addresses"),
+                write_method = write_stats.get("write_method"),
+                rows_per_sec = "{:10.2f}".format(write_stats.get("rows_per_sec", 0)),
             )
         )
     else:
@@ -56,30 +64,223 @@ def index_block(_bitcoin_node, _balance_indexer, block_height):
                 num_transactions = formatted_num_transactions
             )
         )
-        
-    return success
 
 
-def move_forward(_bitcoin_node, _balance_indexer, start_block_height = 1):
-    global shutdown_flag
+def create_block_pipeline(_bitcoin_node, _balance_indexer, pipeline_depth: int, create_snapshots: bool = True):
+    # depth 0 fetches and writes each block in turn in the calling thread
+    if pipeline_depth > 0:
+        fetch_workers = int(os.getenv('BITCOIN_INDEXER_FETCH_WORKERS', '1') or '1')
+    else:
+        fetch_workers = 0
+    block_hashes = RecentBlockHashes(_bitcoin_node)
+
+    def fetch(block_height):
+        # the writer counts the block, this only adds the fetch's share to the capture
+        with block_profiler.block(count=False):
+            start_time = time.time()
+            block_hash = block_hashes.get(block_height)
+            deal_data = _bitcoin_node.get_deal_data_by_block(block_height, block_hash)
+        if deal_data is None:
+            raise StopPipeline("missing_deal_data")
+        return block_height, block_hash, deal_data, time.time() - start_time
+
+    def write(block):
+        block_height, block_hash, deal_data, fetch_time = block
+
+        start_time = time.time()
+        with block_profiler.block():
+            success = _balance_indexer.create_rows_focused_on_balance_changes(deal_data, block_height, block_hash)
+        while not success and not shutdown_flag:
+            logger.error(f"Failed to index block.", extra = logger_extra_data(block_height = block_height))
+            time.sleep(30)
+            start_time = time.time()
+            success = _balance_indexer.create_rows_focused_on_balance_changes(deal_data, block_height, block_hash)
+        if not success:
+            raise StopPipeline("shutdown")
+
+        log_indexed_block(_balance_indexer, block_height, len(deal_data), fetch_time + time.time() - start_time)
+        if create_snapshots and _balance_indexer.snapshot_interval and (block_height + 1) % _balance_indexer.snapshot_interval == 0:
+            _balance_indexer.create_balance_snapshots()
+
+    # create_rows_focused_on_balance_changes times its own prepare and write stages
+    return Pipeline(
+        "balance_tracking",
+        [Stage("fetch", fetch, workers=fetch_workers)],
+        write,
+        queue_size=pipeline_depth,
+        stop_condition=lambda: shutdown_flag,
+        sink_name="index",
+    )
+
 
-    skip_blocks = 6
+def run_pipelined(_bitcoin_node, _balance_indexer, block_heights, pipeline_depth: int, create_snapshots: bool = True):
+    # on shutdown the blocks already fetched are still written, nothing new is started
+    end_reason = create_block_pipeline(_bitcoin_node, _balance_indexer, pipeline_depth, create_snapshots).run(block_heights)
+
+    if end_reason == "missing_deal_data":
+        shutdown_handler(None, None)
+
+    return end_reason is None
+
+
+def find_block_height_gaps(indexed_block_height_ranges):
+    # the holes between consecutive indexed ranges, as (start_block_height, end_block_height)
+    return [
+        (previous_range[1] + 1, next_range[0] - 1)
+        for previous_range, next_range in zip(indexed_block_height_ranges, indexed_block_height_ranges[1:])
+    ]
+
+
+def gap_block_heights(block_height_gaps):
+    for start_block_height, end_block_height in block_height_gaps:
+        logger.info(f"Filling block height gap.", extra = logger_extra_data(start_block_height = start_block_height, end_block_height = end_block_height))
+        for block_height in range(start_block_height, end_block_height + 1):
+            if shutdown_flag:
+                return
+            yield block_height
+
+
+def fill_block_height_gaps(_bitcoin_node, _balance_indexer, block_height_gaps, pipeline_depth: int = 0):
+    completed = run_pipelined(_bitcoin_node, _balance_indexer, gap_block_heights(block_height_gaps), pipeline_depth, create_snapshots=False)
+    if not completed or shutdown_flag:
+        return
+
+    # snapshots wait for their windows to be complete
+    if block_height_gaps:
+        _balance_indexer.create_balance_snapshots()
+
+
+def forward_block_heights(_bitcoin_node, _balance_indexer, start_block_height):
+    skip_blocks = get_confirmations()
     block_height = start_block_height
-    
+    current_block_height = -1
+
+    # only poll the node and check for reorgs once the known tip has been handed out
     while not shutdown_flag:
-        current_block_height = _bitcoin_node.get_current_block_height() - skip_blocks
         if block_height > current_block_height:
-            logger.info(f"Waiting for new blocks.", extra = logger_extra_data(current_block_height = current_block_height))
-            time.sleep(10)
+            # wait for the writer to commit everything handed out, then compare it with the node's chain
+            yield FLUSH
+            if shutdown_flag:
+                return
+            block_height = rollback_reorged_blocks(_bitcoin_node, _balance_indexer.get_indexed_block_hash, _balance_indexer.delete_block, block_height)
+            current_block_height = _bitcoin_node.get_current_block_height() - skip_blocks
+            report_block_heights("balance_tracking", node_height=current_block_height + skip_blocks)
+            if block_height > current_block_height:
+                logger.info(f"Waiting for new blocks.", extra = logger_extra_data(current_block_height = current_block_height))
+                time.sleep(10)
+                continue
+
+        yield block_height
+        block_height += 1
+
+
+def move_forward(_bitcoin_node, _balance_indexer, start_block_height = 1, pipeline_depth: int = 0):
+    run_pipelined(_bitcoin_node, _balance_indexer, forward_block_heights(_bitcoin_node, _balance_indexer, start_block_height), pipeline_depth)
+
+
+# catch-up workers are forked, so they share the parent's loaded deal tables copy-on-write
+_catch_up_bitcoin_node = None
+_catch_up_balance_indexer = None
+_catch_up_block_hashes = None
+
+
+def init_catch_up_worker():
+    global _catch_up_balance_indexer, _catch_up_block_hashes
+    # the parent coordinates shutdown, Pool.terminate still stops workers with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    _catch_up_balance_indexer = BalanceIndexer()
+    _catch_up_block_hashes = RecentBlockHashes(_catch_up_bitcoin_node)
+
+
+def index_block_batch(block_range):
+    start_height, end_height = block_range
+    start_time = time.time()
+    indexed_block_heights = _catch_up_balance_indexer.get_indexed_block_heights(start_height, end_height)
+
+    blocks = []
+    missing_block_height = None
+    for block_height in range(start_height, end_height + 1):
+        if block_height in indexed_block_heights:
             continue
-        
-        success = index_block(_bitcoin_node, _balance_indexer, block_height)
-        
-        if success:
-            block_height += 1
-        else:
-            logger.error(f"Failed to index block.", extra = logger_extra_data(block_height = block_height))
-            time.sleep(30)
+        block_hash = _catch_up_block_hashes.get(block_height)
+        deal_data = _catch_up_bitcoin_node.get_deal_data_by_block(block_height, block_hash)
+        if deal_data is None:
+            missing_block_height = block_height
+            break
+        blocks.append((block_height, block_hash, deal_data))
+
+    # blocks before a missing one are still written, they are complete on their own
+    success = _catch_up_balance_indexer.create_rows_for_blocks(blocks) if blocks else True
+    write_stats = (_catch_up_balance_indexer.last_write_stats or {}) if blocks and success else {}
+
+    return {
+        "start_height": start_height,
+        "end_height": end_height,
+        "num_blocks": len(blocks),
+        "skipped_blocks": len(indexed_block_heights),
+        "num_rows": write_stats.get("rows", 0),
+        "missing_block_height": missing_block_height,
+        "success": success and missing_block_height is None,
+        "time_taken": time.time() - start_time,
+    }
+
+
+def catch_up(_bitcoin_node, _balance_indexer, start_block_height, end_block_height, num_workers, batch_blocks):
+    # returns the lowest height in the range that is not recorded in the blocks table
+    global _catch_up_bitcoin_node
+    _catch_up_bitcoin_node = _bitcoin_node
+
+    batches = [
+        (block_height, min(block_height + batch_blocks - 1, end_block_height))
+        for block_height in range(start_block_height, end_block_height + 1, batch_blocks)
+    ]
+    logger.info(f"Starting catch-up", extra = logger_extra_data(
+        start_block_height = start_block_height, end_block_height = end_block_height,
+        num_workers = num_workers, batch_blocks = batch_blocks, num_batches = len(batches)))
+
+    # pooled connections must not be shared with the forked workers
+    _balance_indexer.engine.dispose()
+
+    start_time = time.time()
+    num_blocks = 0
+    with multiprocessing.get_context("fork").Pool(num_workers, initializer=init_catch_up_worker) as pool:
+        for result in pool.imap_unordered(index_block_batch, batches):
+            num_blocks += result["num_blocks"]
+            # the workers' own metrics stay in their processes, only the totals reach this one
+            if result["success"]:
+                blocks_indexed.inc(result["num_blocks"], indexer="balance_tracking")
+            time_taken = time.time() - start_time
+            logger.info(
+                "Block batch processed",
+                extra = logger_extra_data(
+                    start_block_height = result["start_height"],
+                    end_block_height = result["end_height"],
+                    num_blocks = result["num_blocks"],
+                    skipped_blocks = result["skipped_blocks"],
+                    num_rows = result["num_rows"],
+                    time_taken = "{:6.2f}".format(result["time_taken"]),
+                    blocks_per_sec = "{:8.2f}".format(num_blocks / time_taken if time_taken > 0 else float("inf")),
+                )
+            )
+            if result["missing_block_height"] is not None:
+                logger.info(f"No deal data for block, stopping catch-up.", extra = logger_extra_data(block_height = result["missing_block_height"]))
+                break
+            if not result["success"]:
+                logger.error(f"Failed to index block batch.", extra = logger_extra_data(
+                    start_block_height = result["start_height"], end_block_height = result["end_height"]))
+            if shutdown_flag:
+                break
+        # leaving the pool terminates the workers, their open transactions roll back
+
+    indexed_block_heights = _balance_indexer.get_indexed_block_heights(start_block_height, end_block_height)
+    block_height = start_block_height
+    while block_height in indexed_block_heights:
+        block_height += 1
+
+    logger.info(f"Catch-up stopped", extra = logger_extra_data(next_block_height = block_height, num_blocks = num_blocks))
+    return block_height
+
 
 # Register the shutdown handler for SIGINT and SIGTERM
 signal.signal(signal.SIGINT, shutdown_handler)
@@ -88,17 +289,48 @@ signal.signal(signal.SIGTERM, shutdown_handler)
 if __name__ == "__main__":
     from dotenv import load_dotenv
     load_dotenv()
+    configure_logging()
+    start_metrics_server()
+    block_profiler = setup_profiling("balance_tracking")
 
     bitcoin_node = BitcoinNode()
+    # the pickled tables are kept for the life of the process, later collections and the forked catch-up
+    # workers leave them untouched
+    gc.freeze()
     balance_indexer = BalanceIndexer()
     balance_indexer.setup_db()
+    if balance_indexer.needs_address_migration():
+        logger.error("balance_changes is keyed on the address text, run scripts/balancetracking_migrate_address_ids.sh first")
+        balance_indexer.close()
+        sys.exit(1)
     logger.info("Starting indexer")
 
+    pipeline_depth = int(os.getenv('BITCOIN_INDEXER_PIPELINE_DEPTH', '0') or '0')
+    catch_up_workers = int(os.getenv('BITCOIN_INDEXER_CATCHUP_WORKERS', '0') or '0')
+    if catch_up_workers > 0:
+        catch_up_batch_blocks = int(os.getenv('BITCOIN_INDEXER_CATCHUP_BATCH_BLOCKS', '100') or '100')
+        catch_up_start_block_height = int(os.getenv('BITCOIN_INDEXER_CATCHUP_START_HEIGHT', '1') or '1')
+        catch_up_end_block_height = bitcoin_node.get_current_block_height() - get_confirmations()
+        report_block_heights("balance_tracking", node_height=catch_up_end_block_height + get_confirmations())
+        if catch_up_end_block_height >= catch_up_start_block_height:
+            catch_up(bitcoin_node, balance_indexer, catch_up_start_block_height, catch_up_end_block_height,
+                     catch_up_workers, catch_up_batch_blocks)
+            balance_indexer.create_balance_snapshots()
+
+    if not shutdown_flag:
+        logger.info("Finding block height gaps...")
+        balance_search = BalanceSearch()
+        block_height_gaps = find_block_height_gaps(balance_search.find_indexed_block_height_ranges())
+        balance_search.close()
+        logger.info(f"Found block height gaps", extra=logger_extra_data(block_height_gaps = block_height_gaps))
+        fill_block_height_gaps(bitcoin_node, balance_indexer, block_height_gaps, pipeline_depth)
+
     logger.info("Getting latest block number...")
     latest_block_height = balance_indexer.get_latest_block_number()
     logger.info(f"Latest block number", extra=logger_extra_data(latest_block_height = latest_block_height))
-    
-    move_forward(bitcoin_node, balance_indexer, latest_block_height + 1)
+    report_block_heights("balance_tracking", indexed_height=latest_block_height)
+
+    move_forward(bitcoin_node, balance_indexer, latest_block_height + 1, pipeline_depth)
 
     balance_indexer.close()
     logger.info("Indexer stopped")
@@ -0,0 +1,19 @@
+from models.balance_tracking.balance_indexer import BalanceIndexer
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    # the balance indexer must be stopped while migrating
+    balance_indexer = BalanceIndexer()
+
+    print(f"Storage before migration: {balance_indexer.get_storage_report()}")
+
+    print("Migrating balance changes to address ids...")
+    num_rows = balance_indexer.migrate_to_address_ids()
+    print(f"Migrated {num_rows} balance changes")
+
+    print(f"Storage after migration: {balance_indexer.get_storage_report()}")
+    print("Drop `balance_changes_v1` once the migrated data is verified")
+
+    balance_indexer.close()
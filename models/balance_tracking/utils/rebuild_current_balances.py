@@ -0,0 +1,14 @@
+from models.balance_tracking.balance_indexer import BalanceIndexer
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    # the balance indexer must be stopped while rebuilding, or its blocks are counted twice
+    balance_indexer = BalanceIndexer()
+
+    print("Rebuilding current balances...")
+    num_addresses = balance_indexer.rebuild_current_balances()
+    print(f"Rebuilt current balances for {num_addresses} addresses")
+
+    balance_indexer.close()
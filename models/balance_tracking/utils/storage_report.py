@@ -0,0 +1,14 @@
+from models.balance_tracking.balance_indexer import BalanceIndexer
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    balance_indexer = BalanceIndexer()
+
+    print("Executing sql query...")
+    storage_report = balance_indexer.get_storage_report()
+    for table_name, sizes in storage_report.items():
+        print(f"{table_name}: {sizes}")
+
+    balance_indexer.close()
@@ -0,0 +1,281 @@
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+
+from node.node import BitcoinNode
+from setup_logger import setup_logger
+from setup_logger import logger_extra_data
+from setup_logger import configure_logging
+from models.funds_flow.graph_indexer import GraphIndexer
+from models.funds_flow.graph_search import GraphSearch
+from models.funds_flow.graph_connection_pool import GraphConnectionPool
+from models.funds_flow import indexer as funds_flow_indexer
+from models.balance_tracking.balance_indexer import BalanceIndexer
+from models.balance_tracking import indexer as balance_tracking_indexer
+from models import reorg
+from metrics import queue_depth, report_block_heights, start_metrics_server
+from profiling import BlockProfiler, setup_profiling
+from node.pipeline import FLUSH, Pipeline, Stage, StopPipeline
+
+# Global flag to signal shutdown
+shutdown_flag = False
+# replaced in __main__ once .env is loaded, SIGUSR1 starts a capture
+block_profiler = BlockProfiler("combined")
+logger = setup_logger("Indexer")
+
+_END = object()
+
+
+def shutdown_handler(signum, frame):
+    global shutdown_flag
+    logger.info(
+        "Shutdown signal received. Waiting for current indexing to complete before shutting down."
+    )
+    shutdown_flag = True
+
+
+class SinkWorker:
+    """Writes the blocks fanned out to it into one store, from its own thread and behind a bounded buffer.
+
+    next_height is the sink's watermark, blocks below it are already in the store and skipped.
+    """
+
+    def __init__(self, name: str, write_block, next_height: int, buffer_size: int):
+        self.name = name
+        self.write_block = write_block
+        self.next_height = next_height
+        self.buffer = queue.Queue(maxsize=max(buffer_size, 1))
+        # a block that could not be written, nothing after it is written either
+        self.failed_height = None
+        self._thread = threading.Thread(target=self._run, name=f"sink-{name}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def put(self, block):
+        # blocks while the buffer is full, a slow sink holds the reader back but never the other sink's buffered blocks
+        self.buffer.put(block)
+        queue_depth.set(self.buffer.qsize(), indexer="combined", queue=self.name)
+
+    def wait_until_written(self):
+        self.buffer.join()
+
+    def close(self):
+        self.buffer.put(_END)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            block = self.buffer.get()
+            try:
+                if block is _END:
+                    return
+                if self.failed_height is None and block["block_height"] >= self.next_height:
+                    self._write(block)
+            except Exception as e:
+                self.failed_height = block["block_height"]
+                logger.error(f"Sink failed", extra = logger_extra_data(sink = self.name, block_height = block["block_height"], error = {'exception_type': e.__class__.__name__,'exception_message': str(e),'exception_args': e.args}))
+            finally:
+                self.buffer.task_done()
+
+    def _write(self, block):
+        block_height = block["block_height"]
+        success = self.write_block(block)
+        while not success and not shutdown_flag:
+            logger.error(f"Failed to index block.", extra = logger_extra_data(sink = self.name, block_height = block_height))
+            time.sleep(30)
+            success = self.write_block(block)
+
+        if success:
+            self.next_height = block_height + 1
+        else:
+            self.failed_height = block_height
+            logger.info(f"Sink stopped before block", extra = logger_extra_data(sink = self.name, block_height = block_height))
+
+
+def create_funds_flow_writer(_graph_indexer):
+    def write_block(block):
+        with block_profiler.block(count=False):
+            start_time = time.time()
+            payload = _graph_indexer.prepare_money_flow_payload(block["deal_data"])
+            prepare_time = time.time() - start_time
+
+            queue_wait = time.time() - block["fetched_at"]
+            start_time = time.time()
+            success = _graph_indexer.write_money_flow_payload(payload, block["block_height"], block["block_hash"])
+            write_time = time.time() - start_time
+        if success:
+            funds_flow_indexer.log_pipelined_block(block["block_height"], len(block["deal_data"]), block["fetch_time"], prepare_time, queue_wait, write_time)
+        return success
+
+    return write_block
+
+
+def create_balance_tracking_writer(_balance_indexer):
+    def write_block(block):
+        block_height = block["block_height"]
+        with block_profiler.block(count=False):
+            start_time = time.time()
+            success = _balance_indexer.create_rows_focused_on_balance_changes(block["deal_data"], block_height, block["block_hash"])
+        if success:
+            balance_tracking_indexer.log_indexed_block(_balance_indexer, block_height, len(block["deal_data"]), block["fetch_time"] + time.time() - start_time)
+            if _balance_indexer.snapshot_interval and (block_height + 1) % _balance_indexer.snapshot_interval == 0:
+                _balance_indexer.create_balance_snapshots()
+        return success
+
+    return write_block
+
+
+def rollback_reorged_blocks(_bitcoin_node, _graph_indexer, _balance_indexer, sinks, block_height):
+    # every sink has written what it was handed, each store is checked from its own watermark
+    funds_flow_sink, balance_tracking_sink = sinks["funds_flow"], sinks["balance_tracking"]
+    funds_flow_sink.next_height = reorg.rollback_reorged_blocks(_bitcoin_node, _graph_indexer.get_indexed_block_hash, _graph_indexer.delete_block, funds_flow_sink.next_height)
+    balance_tracking_sink.next_height = reorg.rollback_reorged_blocks(_bitcoin_node, _balance_indexer.get_indexed_block_hash, _balance_indexer.delete_block, balance_tracking_sink.next_height)
+    return min(block_height, funds_flow_sink.next_height, balance_tracking_sink.next_height)
+
+
+def forward_block_heights(_bitcoin_node, _graph_indexer, _balance_indexer, sinks, start_height: int):
+    skip_blocks = reorg.get_confirmations()
+    block_height = start_height
+    current_block_height = -1
+
+    # only poll the node again once the known tip has been handed out
+    while not shutdown_flag:
+        if block_height > current_block_height:
+            # wait until both sinks have written everything handed out, then compare the stores with the node's chain
+            yield FLUSH
+            for sink in sinks.values():
+                sink.wait_until_written()
+            if shutdown_flag or any(sink.failed_height is not None for sink in sinks.values()):
+                return
+            block_height = rollback_reorged_blocks(_bitcoin_node, _graph_indexer, _balance_indexer, sinks, block_height)
+
+            current_block_height = _bitcoin_node.get_current_block_height() - skip_blocks
+            for indexer in sinks:
+                report_block_heights(indexer, node_height=current_block_height + skip_blocks)
+            if block_height > current_block_height:
+                logger.info(
+                    f"Waiting for new blocks.",
+                    extra = logger_extra_data(block_height = current_block_height)
+                )
+                time.sleep(10)
+                continue
+
+        yield block_height
+        block_height += 1
+
+
+def move_forward(_bitcoin_node, _graph_indexer, _balance_indexer, funds_flow_next_height: int, balance_next_height: int, pipeline_depth: int, buffer_size: int):
+    # a single reader fetches each block's deal data once and hands it to both sinks
+    sinks = {
+        "funds_flow": SinkWorker("funds_flow", create_funds_flow_writer(_graph_indexer), funds_flow_next_height, buffer_size),
+        "balance_tracking": SinkWorker("balance_tracking", create_balance_tracking_writer(_balance_indexer), balance_next_height, buffer_size),
+    }
+    for sink in sinks.values():
+        sink.start()
+    block_hashes = reorg.RecentBlockHashes(_bitcoin_node)
+
+    def fetch(block_height):
+        with block_profiler.block():
+            start_time = time.time()
+            block_hash = block_hashes.get(block_height)
+            deal_data = _bitcoin_node.get_deal_data_by_block(block_height, block_hash)
+        if deal_data is None:
+            raise StopPipeline("missing_deal_data")
+        return {
+            "block_height": block_height,
+            "block_hash": block_hash,
+            "deal_data": deal_data,
+            "fetch_time": time.time() - start_time,
+            "fetched_at": time.time(),
+        }
+
+    def fan_out(block):
+        if any(sink.failed_height is not None for sink in sinks.values()):
+            raise StopPipeline("sink_failed")
+        for sink in sinks.values():
+            sink.put(block)
+
+    # depth 0 fetches each block in the calling thread, the sinks still write in their own threads
+    fetch_workers = int(os.getenv('BITCOIN_INDEXER_FETCH_WORKERS', '1') or '1') if pipeline_depth > 0 else 0
+    pipeline = Pipeline(
+        "combined",
+        [Stage("fetch", fetch, workers=fetch_workers)],
+        fan_out,
+        queue_size=pipeline_depth,
+        stop_condition=lambda: shutdown_flag,
+        sink_name="fan_out",
+    )
+    start_height = min(funds_flow_next_height, balance_next_height)
+    end_reason = pipeline.run(forward_block_heights(_bitcoin_node, _graph_indexer, _balance_indexer, sinks, start_height))
+
+    # the blocks already buffered are still written by each sink
+    for sink in sinks.values():
+        sink.close()
+    logger.info(f"Sinks stopped", extra = logger_extra_data(
+        end_reason = end_reason,
+        funds_flow_next_height = sinks["funds_flow"].next_height,
+        balance_tracking_next_height = sinks["balance_tracking"].next_height,
+    ))
+
+    if end_reason == "missing_deal_data":
+        shutdown_handler(None, None)
+
+
+# Register the shutdown handler for SIGINT and SIGTERM
+signal.signal(signal.SIGINT, shutdown_handler)
+signal.signal(signal.SIGTERM, shutdown_handler)
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    configure_logging()
+    start_metrics_server()
+    block_profiler = setup_profiling("combined")
+
+    # one node, so the deal pickles are loaded once for both stores
+    bitcoin_node = BitcoinNode()
+    graph_pool = GraphConnectionPool()
+    graph_indexer = GraphIndexer(graph_pool=graph_pool)
+    graph_search = GraphSearch(graph_pool=graph_pool)
+    balance_indexer = BalanceIndexer()
+
+    balance_indexer.setup_db()
+    if balance_indexer.needs_address_migration():
+        logger.error("balance_changes is keyed on the address text, run scripts/balancetracking_migrate_address_ids.sh first")
+        balance_indexer.close()
+        graph_indexer.close()
+        graph_search.close()
+        graph_pool.close()
+        sys.exit(1)
+
+    logger.info("Starting indexer")
+
+    logger.info("Creating indexes...")
+    graph_indexer.create_indexes()
+
+    logger.info("Syncing block range caches...")
+    indexed_min_block_height, indexed_max_block_height = graph_search.get_min_max_block_height()
+    graph_indexer.set_min_max_block_height_cache(indexed_min_block_height, indexed_max_block_height)
+    latest_block_height = balance_indexer.get_latest_block_number()
+    logger.info(f"Indexed block heights", extra=logger_extra_data(funds_flow_max_block_height=indexed_max_block_height, balance_tracking_latest_block_height=latest_block_height))
+    report_block_heights("funds_flow", indexed_height=indexed_max_block_height)
+    report_block_heights("balance_tracking", indexed_height=latest_block_height)
+
+    # each store continues from its own watermark, the one behind catches up while the other skips
+    funds_flow_next_height = (indexed_max_block_height or 0) + 1
+    balance_next_height = latest_block_height + 1
+    pipeline_depth = int(os.getenv('BITCOIN_INDEXER_PIPELINE_DEPTH', '0') or '0')
+    sink_buffer_blocks = int(os.getenv('BITCOIN_INDEXER_SINK_BUFFER_BLOCKS', '16') or '16')
+
+    move_forward(bitcoin_node, graph_indexer, balance_indexer, funds_flow_next_height, balance_next_height, pipeline_depth, sink_buffer_blocks)
+
+    graph_pool.log_metrics()
+    balance_indexer.close()
+    graph_indexer.close()
+    graph_search.close()
+    graph_pool.close()
+    logger.info("Indexer stopped")
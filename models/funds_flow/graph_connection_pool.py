@@ -0,0 +1,161 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from neo4j import GraphDatabase
+
+from setup_logger import setup_logger
+from setup_logger import logger_extra_data
+
+logger = setup_logger("GraphConnectionPool")
+
+
+class GraphConnectionPool:
+    def __init__(
+        self,
+        graph_db_url: str = None,
+        graph_db_user: str = None,
+        graph_db_password: str = None,
+        max_pool_size: int = None,
+        acquisition_timeout: float = None,
+        keep_alive: bool = None,
+    ):
+        if graph_db_url is None:
+            self.graph_db_url = (
+                os.environ.get("GRAPH_DB_URL") or "bolt://localhost:7687"
+            )
+        else:
+            self.graph_db_url = graph_db_url
+
+        if graph_db_user is None:
+            self.graph_db_user = os.environ.get("GRAPH_DB_USER") or ""
+        else:
+            self.graph_db_user = graph_db_user
+
+        if graph_db_password is None:
+            self.graph_db_password = os.environ.get("GRAPH_DB_PASSWORD") or ""
+        else:
+            self.graph_db_password = graph_db_password
+
+        if max_pool_size is None:
+            self.max_pool_size = int(os.environ.get("GRAPH_DB_MAX_POOL_SIZE") or 100)
+        else:
+            self.max_pool_size = max_pool_size
+
+        if acquisition_timeout is None:
+            self.acquisition_timeout = float(os.environ.get("GRAPH_DB_CONNECTION_ACQUISITION_TIMEOUT") or 60)
+        else:
+            self.acquisition_timeout = acquisition_timeout
+
+        if keep_alive is None:
+            self.keep_alive = (os.environ.get("GRAPH_DB_KEEP_ALIVE") or "1") == "1"
+        else:
+            self.keep_alive = keep_alive
+
+        self.driver = GraphDatabase.driver(
+            self.graph_db_url,
+            auth=(self.graph_db_user, self.graph_db_password),
+            max_connection_pool_size=self.max_pool_size,
+            connection_acquisition_timeout=self.acquisition_timeout,
+            keep_alive=self.keep_alive,
+        )
+
+        # one long-lived session per worker thread
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._thread_sessions = {}
+
+        self._sessions_created = 0
+        self._sessions_reused = 0
+        self._sessions_discarded = 0
+        self._borrowed = 0
+        self._peak_borrowed = 0
+        self._borrow_count = 0
+        self._borrow_time = 0.0
+
+    def close(self):
+        with self._lock:
+            sessions = list(self._thread_sessions.values())
+            self._thread_sessions.clear()
+        for session in sessions:
+            try:
+                session.close()
+            except Exception:
+                pass
+        self.driver.close()
+
+    def _discard_thread_session(self):
+        session = getattr(self._local, "session", None)
+        self._local.session = None
+        with self._lock:
+            self._thread_sessions.pop(threading.get_ident(), None)
+            self._sessions_discarded += 1
+        if session is not None:
+            try:
+                session.close()
+            except Exception:
+                pass
+
+    def invalidate_session(self, session):
+        # for callers that catch a failure and return instead of raising, the session is closed once they give it back
+        if session is getattr(self._local, "session", None):
+            self._local.invalid = True
+
+    @contextmanager
+    def session(self):
+        depth = getattr(self._local, "depth", 0)
+        if depth > 0:
+            # the thread session is already in use further up the stack, hand out a short-lived one
+            with self.driver.session() as nested_session:
+                yield nested_session
+            return
+
+        session = getattr(self._local, "session", None)
+        with self._lock:
+            if session is None:
+                session = self.driver.session()
+                self._local.session = session
+                self._thread_sessions[threading.get_ident()] = session
+                self._sessions_created += 1
+            else:
+                self._sessions_reused += 1
+            self._borrowed += 1
+            self._borrow_count += 1
+            self._peak_borrowed = max(self._peak_borrowed, self._borrowed)
+
+        self._local.depth = 1
+        self._local.invalid = False
+        start_time = time.time()
+        try:
+            yield session
+        except Exception:
+            # a failed session may hold a broken connection, never hand it out again
+            self._discard_thread_session()
+            raise
+        else:
+            if self._local.invalid:
+                self._discard_thread_session()
+        finally:
+            self._local.invalid = False
+            self._local.depth = 0
+            with self._lock:
+                self._borrowed -= 1
+                self._borrow_time += time.time() - start_time
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "max_pool_size": self.max_pool_size,
+                "thread_sessions": len(self._thread_sessions),
+                "sessions_created": self._sessions_created,
+                "sessions_reused": self._sessions_reused,
+                "sessions_discarded": self._sessions_discarded,
+                "borrowed": self._borrowed,
+                "peak_borrowed": self._peak_borrowed,
+                "peak_utilization": self._peak_borrowed / self.max_pool_size if self.max_pool_size else 0,
+                "avg_borrow_time": self._borrow_time / self._borrow_count if self._borrow_count else 0,
+            }
+
+    def log_metrics(self):
+        logger.info("Graph connection pool metrics", extra=logger_extra_data(**self.metrics()))
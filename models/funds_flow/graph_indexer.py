@@ -1,10 +1,84 @@
 import os
+import threading
 from setup_logger import setup_logger
 from setup_logger import logger_extra_data
-from neo4j import GraphDatabase
+from models.funds_flow.graph_connection_pool import GraphConnectionPool
+from metrics import db_commit_seconds
+from profiling import span
+from node.deal_encoding import iter_deal_transactions
+from models.reorg import get_max_reorg_depth
 
 logger = setup_logger("GraphIndexer")
 
+# blocks below a deleted one searched for the new last_seen_block_height of addresses written before
+# recent_seen_block_heights was kept
+LAST_SEEN_SCAN_BLOCKS = 6
+
+
+def attribute_address_flows(deal_data, max_flow_pairs: int = 10000):
+    # Every output is funded by the inputs pro rata to their share of the netted input total:
+    #   flow(a -> b) = out_amount(b) * in_amount(a) // in_total_amount
+    # Txs with more input x output pairs than max_flow_pairs are left out of the aggregate.
+    flows = {}
+    skipped_txs = 0
+    for _, inputs, outputs, in_total_amount, _, _, block_height, _ in iter_deal_transactions(deal_data):
+        if in_total_amount <= 0 or not inputs or not outputs:
+            continue
+        if len(inputs) * len(outputs) > max_flow_pairs:
+            skipped_txs += 1
+            continue
+
+        for from_address, in_amount in inputs:
+            for to_address, out_amount in outputs:
+                flow_value = out_amount * in_amount // in_total_amount
+                flow = flows.get((from_address, to_address))
+                if flow is None:
+                    flows[(from_address, to_address)] = {
+                        "from_address": from_address,
+                        "to_address": to_address,
+                        "value_satoshi": flow_value,
+                        "tx_count": 1,
+                        "first_block_height": block_height,
+                        "last_block_height": block_height,
+                    }
+                else:
+                    flow["value_satoshi"] += flow_value
+                    flow["tx_count"] += 1
+                    flow["first_block_height"] = min(flow["first_block_height"], block_height)
+                    flow["last_block_height"] = max(flow["last_block_height"], block_height)
+
+    return list(flows.values()), skipped_txs
+
+
+def aggregate_address_summaries(deal_data):
+    # one delta per address for the whole batch, so each Address node is written once
+    summaries = {}
+    for _, inputs, outputs, _, _, _, block_height, _ in iter_deal_transactions(deal_data):
+        tx_addresses = {address for address, _ in inputs}
+        tx_addresses.update(address for address, _ in outputs)
+        for address in tx_addresses:
+            summary = summaries.get(address)
+            if summary is None:
+                summary = summaries[address] = {
+                    "address": address,
+                    "received": 0,
+                    "sent": 0,
+                    "tx_count": 0,
+                    "first_block_height": block_height,
+                    "last_block_height": block_height,
+                }
+            else:
+                summary["first_block_height"] = min(summary["first_block_height"], block_height)
+                summary["last_block_height"] = max(summary["last_block_height"], block_height)
+            summary["tx_count"] += 1
+
+        for address, amount in inputs:
+            summaries[address]["sent"] += amount
+        for address, amount in outputs:
+            summaries[address]["received"] += amount
+
+    return list(summaries.values())
+
 
 class GraphIndexer:
     def __init__(
@@ -12,56 +86,106 @@ class GraphIndexer:
         graph_db_url: str = None,
         graph_db_user: str = None,
         graph_db_password: str = None,
+        graph_pool: GraphConnectionPool = None,
+        maintain_flows_to: bool = None,
     ):
-        if graph_db_url is None:
-            self.graph_db_url = (
-                os.environ.get("GRAPH_DB_URL") or "bolt://localhost:7687"
-            )
+        if graph_pool is None:
+            self.graph_pool = GraphConnectionPool(graph_db_url, graph_db_user, graph_db_password)
+            self.owns_graph_pool = True
         else:
-            self.graph_db_url = graph_db_url
+            self.graph_pool = graph_pool
+            self.owns_graph_pool = False
 
-        if graph_db_user is None:
-            self.graph_db_user = os.environ.get("GRAPH_DB_USER") or ""
-        else:
-            self.graph_db_user = graph_db_user
+        self.graph_db_url = self.graph_pool.graph_db_url
+        self.graph_db_user = self.graph_pool.graph_db_user
+        self.graph_db_password = self.graph_pool.graph_db_password
+        self.driver = self.graph_pool.driver
 
-        if graph_db_password is None:
-            self.graph_db_password = os.environ.get("GRAPH_DB_PASSWORD") or ""
+        if maintain_flows_to is None:
+            self.maintain_flows_to = (os.environ.get("GRAPH_DB_MAINTAIN_FLOWS_TO") or "0") == "1"
         else:
-            self.graph_db_password = graph_db_password
+            self.maintain_flows_to = maintain_flows_to
+        self.max_flow_pairs = int(os.environ.get("GRAPH_DB_FLOWS_TO_MAX_PAIRS") or 10000)
+        # a rollback removes at most max_reorg_depth heights, one more is left for the block below them
+        self.recent_heights_kept = get_max_reorg_depth() + 1
 
-        self.driver = GraphDatabase.driver(
-            self.graph_db_url,
-            auth=(self.graph_db_user, self.graph_db_password),
-        )
+        # in-memory copy of the Cache nodes, kept in step with every committed block
+        self.min_block_height_cache = None
+        self.max_block_height_cache = None
+        self._cache_lock = threading.Lock()
 
     def close(self):
-        self.driver.close()
+        if self.owns_graph_pool:
+            self.graph_pool.close()
+
+    @staticmethod
+    def _write_min_max_block_height_cache(tx, min_block_height, max_block_height):
+        tx.run(
+            """
+            MERGE (min:Cache {field: 'min_block_height'})
+            SET min.value = $min_block_height
+            WITH min
+            MERGE (max:Cache {field: 'max_block_height'})
+            SET max.value = $max_block_height
+            """,
+            {"min_block_height": min_block_height, "max_block_height": max_block_height}
+        )
 
-    def set_min_max_block_height_cache(self, min_block_height, max_block_height):
-        with self.driver.session() as session:
-            # update min block height
+    @staticmethod
+    def _extend_min_max_block_height_cache(tx, min_block_height, max_block_height):
+        # only ever widens the range, so concurrent writers cannot move it back
+        tx.run(
+            """
+            MERGE (min:Cache {field: 'min_block_height'})
+            SET min.value = CASE WHEN min.value IS NULL OR $min_block_height < min.value THEN $min_block_height ELSE min.value END
+            WITH min
+            MERGE (max:Cache {field: 'max_block_height'})
+            SET max.value = CASE WHEN max.value IS NULL OR $max_block_height > max.value THEN $max_block_height ELSE max.value END
+            """,
+            {"min_block_height": min_block_height, "max_block_height": max_block_height}
+        )
+
+    def set_cache_value(self, field: str, value):
+        with self.graph_pool.session() as session:
             session.run(
                 """
-                MERGE (n:Cache {field: 'min_block_height'})
-                SET n.value = $min_block_height
-                RETURN n
+                MERGE (n:Cache {field: $field})
+                SET n.value = $value
                 """,
-                {"min_block_height": min_block_height}
+                field=field,
+                value=value
             )
 
-            # update max block height
-            session.run(
+    def set_min_max_block_height_cache(self, min_block_height, max_block_height):
+        with self.graph_pool.session() as session:
+            self._write_min_max_block_height_cache(session, min_block_height, max_block_height)
+
+        self.min_block_height_cache = min_block_height
+        self.max_block_height_cache = max_block_height
+
+    def _next_min_max_block_height_cache(self, block_height):
+        min_block_height = self.min_block_height_cache
+        max_block_height = self.max_block_height_cache
+        if min_block_height is None or block_height < min_block_height:
+            min_block_height = block_height
+        if max_block_height is None or block_height > max_block_height:
+            max_block_height = block_height
+        return min_block_height, max_block_height
+
+    def get_indexed_block_hash(self, block_height: int):
+        with self.graph_pool.session() as session:
+            result = session.run(
                 """
-                MERGE (n:Cache {field: 'max_block_height'})
-                SET n.value = $max_block_height
-                RETURN n
+                MATCH (b:Block {block_height: $block_height})
+                RETURN b.block_hash AS block_hash
+                LIMIT 1;
                 """,
-                {"max_block_height": max_block_height}
-            )
+                block_height=block_height
+            ).single()
+            return result["block_hash"] if result else None
 
     def check_if_block_is_indexed(self, block_height: int) -> bool:
-        with self.driver.session() as session:
+        with self.graph_pool.session() as session:
             result = session.run(
                 """
                 MATCH (t: Transaction{block_height: $block_height})
@@ -74,7 +198,7 @@ class GraphIndexer:
             return single_result is not None
 
     def find_indexed_block_height_ranges(self):
-        with self.driver.session() as session:
+        with self.graph_pool.session() as session:
             result = session.run(
                 """
                 MATCH (t:Transaction)
@@ -113,7 +237,7 @@ class GraphIndexer:
     getcontext().prec = 28
 
     def create_indexes(self):
-        with self.driver.session() as session:
+        with self.graph_pool.session() as session:
             # Fetch existing indexes
             existing_indexes = session.run("SHOW INDEX INFO")
             existing_index_set = set()
@@ -126,6 +250,7 @@ class GraphIndexer:
 
             index_creation_statements = {
                 "Cache": "CREATE INDEX ON :Cache;",
+                "Block-block_height": "CREATE INDEX ON :Block(block_height);",
                 "Transaction": "CREATE INDEX ON :Transaction;",
                 "Transaction-tx_id": "CREATE INDEX ON :Transaction(tx_id);",
                 "Transaction-block_height": "CREATE INDEX ON :Transaction(block_height);",
@@ -142,38 +267,122 @@ class GraphIndexer:
                     except Exception as e:
                         logger.error(f"An exception occurred while creating index", extra = logger_extra_data(index_name = index_name, error = {'exception_type': e.__class__.__name__,'exception_message': str(e),'exception_args': e.args}))
 
-    def create_graph_focused_on_money_flow(self, deal_data):
-        # transactions = block_data.transactions
+    @span("create_graph_focused_on_money_flow")
+    def create_graph_focused_on_money_flow(self, deal_data, block_height=None, block_hash=None):
+        return self.write_money_flow_payload(self.prepare_money_flow_payload(deal_data), block_height, block_hash)
+
+    @span("prepare_money_flow_payload")
+    def prepare_money_flow_payload(self, deal_data):
+        # deal_data is a block's dict or its EncodedBlock, it is read once for all parts of the payload
+        transactions = list(iter_deal_transactions(deal_data))
 
         batch_txns = []
         batch_inputs = []
         batch_outputs = []
-        for tx_id, value in deal_data.items():
-            in_amount_by_address = value['in_amount_by_address']
-            out_amount_by_address = value['out_amount_by_address']
-            input_addresses = value['input_addresses']
-            output_addresses = value['output_addresses']
-            in_total_amount = value['in_total_amount']
-            out_total_amount = value['out_total_amount']
-            tx_info = value['tx_info']
-
-            inputs = [{"address": address, "amount": in_amount_by_address[address], "tx_id": tx_id} for address in
-                      input_addresses]
-            outputs = [{"address": address, "amount": out_amount_by_address[address], "tx_id": tx_id} for address in
-                       output_addresses]
+        for tx_id, tx_inputs, tx_outputs, in_total_amount, out_total_amount, timestamp, block_height, is_coinbase in transactions:
+            inputs = [{"address": address, "amount": amount, "tx_id": tx_id} for address, amount in tx_inputs]
+            outputs = [{"address": address, "amount": amount, "tx_id": tx_id} for address, amount in tx_outputs]
 
             batch_txns.append({
                 "tx_id": tx_id,
                 "in_total_amount": in_total_amount,
                 "out_total_amount": out_total_amount,
-                "timestamp": tx_info['timestamp'],
-                "block_height": tx_info['block_height'],
-                "is_coinbase": tx_info['is_coinbase'],
+                "timestamp": timestamp,
+                "block_height": block_height,
+                "is_coinbase": is_coinbase,
             })
             batch_inputs += inputs
             batch_outputs += outputs
 
-        with self.driver.session() as session:
+        payload = {
+            "transactions": batch_txns,
+            "inputs": batch_inputs,
+            "outputs": batch_outputs,
+            "addresses": aggregate_address_summaries(transactions),
+        }
+
+        if self.maintain_flows_to:
+            payload["flows"], skipped_txs = attribute_address_flows(transactions, self.max_flow_pairs)
+            if skipped_txs:
+                logger.info(f"Skipped FLOWS_TO attribution for large transactions", extra = logger_extra_data(skipped_txs = skipped_txs))
+
+        return payload
+
+    @staticmethod
+    def _write_address_summaries(tx, addresses, recent_heights_kept, start_recent_heights=False):
+        # recent_seen_block_heights holds an address's highest seen heights, sorted. It is started by the blocks
+        # within reorg depth of the tip, seeded with the last height seen before them, so delete_block can
+        # restore last_seen_block_height without walking the address's history
+        tx.run(
+            """
+            UNWIND $addresses AS delta
+            MATCH (a:Address {address: delta.address})
+            WHERE a.recent_seen_block_heights IS NOT NULL OR $start_recent_heights
+            WITH a, delta.last_block_height AS height,
+                 coalesce(a.recent_seen_block_heights, CASE WHEN a.last_seen_block_height IS NULL THEN [] ELSE [a.last_seen_block_height] END) AS heights
+            WITH a, [h IN heights WHERE h < height] + [height] + [h IN heights WHERE h > height] AS heights
+            SET a.recent_seen_block_heights = CASE WHEN size(heights) > $recent_heights_kept THEN heights[size(heights) - $recent_heights_kept..] ELSE heights END
+            """,
+            addresses=addresses,
+            recent_heights_kept=recent_heights_kept,
+            start_recent_heights=start_recent_heights
+        )
+        tx.run(
+            """
+            UNWIND $addresses AS delta
+            MERGE (a:Address {address: delta.address})
+            ON CREATE SET a.total_received = delta.received,
+                        a.total_sent = delta.sent,
+                        a.tx_count = delta.tx_count,
+                        a.first_seen_block_height = delta.first_block_height,
+                        a.last_seen_block_height = delta.last_block_height,
+                        a.recent_seen_block_heights = CASE WHEN $start_recent_heights THEN [delta.last_block_height] ELSE null END
+            ON MATCH SET a.total_received = coalesce(a.total_received, 0) + delta.received,
+                        a.total_sent = coalesce(a.total_sent, 0) + delta.sent,
+                        a.tx_count = coalesce(a.tx_count, 0) + delta.tx_count,
+                        a.first_seen_block_height = CASE WHEN a.first_seen_block_height IS NULL OR delta.first_block_height < a.first_seen_block_height THEN delta.first_block_height ELSE a.first_seen_block_height END,
+                        a.last_seen_block_height = CASE WHEN a.last_seen_block_height IS NULL OR delta.last_block_height > a.last_seen_block_height THEN delta.last_block_height ELSE a.last_seen_block_height END
+            """,
+            addresses=addresses,
+            start_recent_heights=start_recent_heights
+        )
+
+    @staticmethod
+    def _write_flows_to(tx, flows):
+        tx.run(
+            """
+            UNWIND $flows AS flow
+            MATCH (a:Address {address: flow.from_address})
+            MATCH (b:Address {address: flow.to_address})
+            MERGE (a)-[f:FLOWS_TO]->(b)
+            ON CREATE SET f.value_satoshi = flow.value_satoshi,
+                        f.tx_count = flow.tx_count,
+                        f.first_block_height = flow.first_block_height,
+                        f.last_block_height = flow.last_block_height
+            ON MATCH SET f.value_satoshi = f.value_satoshi + flow.value_satoshi,
+                        f.tx_count = f.tx_count + flow.tx_count,
+                        f.first_block_height = CASE WHEN flow.first_block_height < f.first_block_height THEN flow.first_block_height ELSE f.first_block_height END,
+                        f.last_block_height = CASE WHEN flow.last_block_height > f.last_block_height THEN flow.last_block_height ELSE f.last_block_height END
+            """,
+            flows=flows
+        )
+
+    @span("write_money_flow_payload")
+    def write_money_flow_payload(self, payload, block_height=None, block_hash=None):
+        batch_txns = payload["transactions"]
+        batch_inputs = payload["inputs"]
+        batch_outputs = payload["outputs"]
+
+        if block_height is None and batch_txns:
+            block_height = batch_txns[0]["block_height"]
+
+        cache_update = None
+        if block_height is not None:
+            cache_update = self._next_min_max_block_height_cache(block_height)
+            if cache_update == (self.min_block_height_cache, self.max_block_height_cache):
+                cache_update = None
+
+        with self.graph_pool.session() as session:
             # Start a transaction
             transaction = session.begin_transaction()
 
@@ -216,10 +425,13 @@ class GraphIndexer:
                     transactions=batch_txns,
                 )
 
+                # creates the block's Address nodes, so the edge statements below only MATCH them
+                self._write_address_summaries(transaction, payload["addresses"], self.recent_heights_kept, block_hash is not None)
+
                 transaction.run(
                     """
                     UNWIND $inputs AS input
-                    MERGE (a:Address {address: input.address})
+                    MATCH (a:Address {address: input.address})
                     MERGE (t:Transaction {tx_id: input.tx_id})
                     CREATE (a)-[:SENT { value_satoshi: input.amount }]->(t)
                     """,
@@ -229,17 +441,41 @@ class GraphIndexer:
                 transaction.run(
                     """
                     UNWIND $outputs AS output
-                    MERGE (a:Address {address: output.address})
+                    MATCH (a:Address {address: output.address})
                     MERGE (t:Transaction {tx_id: output.tx_id})
                     CREATE (t)-[:SENT { value_satoshi: output.amount }]->(a)
                     """,
                     outputs=batch_outputs
                 )
 
-                transaction.commit()
+                if payload.get("flows"):
+                    self._write_flows_to(transaction, payload["flows"])
+
+                # the recorded hash lets a later poll detect that this block left the node's chain
+                if block_hash is not None and block_height is not None:
+                    transaction.run(
+                        """
+                        MERGE (b:Block {block_height: $block_height})
+                        SET b.block_hash = $block_hash
+                        """,
+                        block_height=block_height,
+                        block_hash=block_hash
+                    )
+
+                # keep the min/max cache in the same transaction as the block it describes
+                if cache_update is not None:
+                    self._extend_min_max_block_height_cache(transaction, *cache_update)
+
+                with db_commit_seconds.time(db="graph"):
+                    transaction.commit()
+
+                if cache_update is not None:
+                    with self._cache_lock:
+                        self.min_block_height_cache, self.max_block_height_cache = self._next_min_max_block_height_cache(block_height)
                 return True
 
             except Exception as e:
+                self.graph_pool.invalidate_session(session)
                 transaction.rollback()
                 logger.error(f"An exception occurred", extra = logger_extra_data(error = {'exception_type': e.__class__.__name__,'exception_message': str(e),'exception_args': e.args}))
                 return False
@@ -247,3 +483,231 @@ class GraphIndexer:
             finally:
                 if transaction.closed() is False:
                     transaction.close()
+
+    def get_block_money_flow(self, block_height: int):
+        # rebuilds the deal data layout of an already indexed block from its SENT edges
+        with self.graph_pool.session() as session:
+            result = session.run(
+                """
+                MATCH (t:Transaction {block_height: $block_height})
+                OPTIONAL MATCH (a:Address)-[i:SENT]->(t)
+                WITH t, collect([a.address, i.value_satoshi]) AS inputs
+                OPTIONAL MATCH (t)-[o:SENT]->(b:Address)
+                RETURN t.tx_id AS tx_id, t.in_total_amount AS in_total_amount, t.out_total_amount AS out_total_amount,
+                       t.timestamp AS timestamp, t.is_coinbase AS is_coinbase,
+                       inputs, collect([b.address, o.value_satoshi]) AS outputs
+                """,
+                block_height=block_height
+            )
+
+            deal_data = {}
+            for record in result:
+                in_amount_by_address = {address: amount for address, amount in record["inputs"] if address is not None}
+                out_amount_by_address = {address: amount for address, amount in record["outputs"] if address is not None}
+                deal_data[record["tx_id"]] = {
+                    'in_amount_by_address': in_amount_by_address,
+                    'out_amount_by_address': out_amount_by_address,
+                    'input_addresses': list(in_amount_by_address),
+                    'output_addresses': list(out_amount_by_address),
+                    'in_total_amount': record["in_total_amount"],
+                    'out_total_amount': record["out_total_amount"],
+                    'tx_info': {
+                        "timestamp": record["timestamp"],
+                        "block_height": block_height,
+                        "is_coinbase": record["is_coinbase"],
+                    }
+                }
+            return deal_data
+
+    def delete_flows_to(self, batch_size: int = 100000):
+        deleted = 0
+        with self.graph_pool.session() as session:
+            while True:
+                result = session.run(
+                    """
+                    MATCH ()-[f:FLOWS_TO]->()
+                    WITH f LIMIT $batch_size
+                    DELETE f
+                    RETURN count(*) AS deleted
+                    """,
+                    batch_size=batch_size
+                ).single()
+                if not result or result["deleted"] == 0:
+                    return deleted
+                deleted += result["deleted"]
+
+    def rebuild_flows_to(self, start_height: int, end_height: int, blocks_per_transaction: int = 100):
+        for batch_start in range(start_height, end_height + 1, blocks_per_transaction):
+            batch_end = min(batch_start + blocks_per_transaction - 1, end_height)
+
+            deal_data = {}
+            for block_height in range(batch_start, batch_end + 1):
+                deal_data.update(self.get_block_money_flow(block_height))
+
+            flows, skipped_txs = attribute_address_flows(deal_data, self.max_flow_pairs)
+            with self.graph_pool.session() as session:
+                session.execute_write(self._write_flows_to, flows)
+
+            logger.info(f"Rebuilt FLOWS_TO edges", extra = logger_extra_data(start_height = batch_start, end_height = batch_end, num_flows = len(flows), skipped_txs = skipped_txs))
+
+    def delete_address_summaries(self, batch_size: int = 100000):
+        cleared = 0
+        with self.graph_pool.session() as session:
+            while True:
+                result = session.run(
+                    """
+                    MATCH (a:Address)
+                    WHERE a.tx_count IS NOT NULL
+                    WITH a LIMIT $batch_size
+                    REMOVE a.total_received, a.total_sent, a.tx_count, a.first_seen_block_height, a.last_seen_block_height,
+                           a.recent_seen_block_heights
+                    RETURN count(*) AS cleared
+                    """,
+                    batch_size=batch_size
+                ).single()
+                if not result or result["cleared"] == 0:
+                    return cleared
+                cleared += result["cleared"]
+
+    def rebuild_address_summaries(self, start_height: int, end_height: int, blocks_per_transaction: int = 100):
+        for batch_start in range(start_height, end_height + 1, blocks_per_transaction):
+            batch_end = min(batch_start + blocks_per_transaction - 1, end_height)
+
+            deal_data = {}
+            for block_height in range(batch_start, batch_end + 1):
+                deal_data.update(self.get_block_money_flow(block_height))
+
+            addresses = aggregate_address_summaries(deal_data)
+            with self.graph_pool.session() as session:
+                session.execute_write(self._write_address_summaries, addresses, self.recent_heights_kept)
+
+            logger.info(f"Rebuilt address summaries", extra = logger_extra_data(start_height = batch_start, end_height = batch_end, num_addresses = len(addresses)))
+
+    def delete_block(self, block_height: int):
+        # undo a single block: its deltas are read back from the SENT edges and subtracted before
+        # the block's Transactions are deleted through the block_height index
+        deal_data = self.get_block_money_flow(block_height)
+        addresses = aggregate_address_summaries(deal_data)
+        flows = attribute_address_flows(deal_data, self.max_flow_pairs)[0] if self.maintain_flows_to else []
+
+        cache_update = None
+        if self.max_block_height_cache == block_height:
+            cache_update = (self.min_block_height_cache, block_height - 1)
+
+        with self.graph_pool.session() as session:
+            transaction = session.begin_transaction()
+
+            try:
+                transaction.run(
+                    """
+                    UNWIND $addresses AS delta
+                    MATCH (a:Address {address: delta.address})
+                    SET a.total_received = a.total_received - delta.received,
+                        a.total_sent = a.total_sent - delta.sent,
+                        a.tx_count = a.tx_count - delta.tx_count
+                    """,
+                    addresses=addresses
+                )
+
+                # first/last block height of a surviving FLOWS_TO edge are left as they were
+                transaction.run(
+                    """
+                    UNWIND $flows AS flow
+                    MATCH (a:Address {address: flow.from_address})-[f:FLOWS_TO]->(b:Address {address: flow.to_address})
+                    SET f.value_satoshi = f.value_satoshi - flow.value_satoshi,
+                        f.tx_count = f.tx_count - flow.tx_count
+                    WITH f
+                    WHERE f.tx_count <= 0
+                    DELETE f
+                    """,
+                    flows=flows
+                )
+
+                transaction.run(
+                    """
+                    MATCH (t:Transaction {block_height: $block_height})
+                    DETACH DELETE t
+                    """,
+                    block_height=block_height
+                )
+
+                # addresses only this block touched are gone with it
+                transaction.run(
+                    """
+                    UNWIND $addresses AS delta
+                    MATCH (a:Address {address: delta.address})
+                    WHERE a.tx_count <= 0
+                    DETACH DELETE a
+                    """,
+                    addresses=addresses
+                )
+
+                # blocks are rolled back from the tip down, only a bound at this height is stale. Addresses written
+                # within reorg depth of the tip keep the heights below it
+                transaction.run(
+                    """
+                    UNWIND $addresses AS delta
+                    MATCH (a:Address {address: delta.address})
+                    WHERE a.recent_seen_block_heights IS NOT NULL
+                    WITH a, [h IN a.recent_seen_block_heights WHERE h < $block_height] AS heights
+                    SET a.recent_seen_block_heights = CASE WHEN size(heights) > 0 THEN heights ELSE null END,
+                        a.last_seen_block_height = CASE WHEN size(heights) > 0 THEN heights[size(heights) - 1] ELSE a.last_seen_block_height END
+                    """,
+                    addresses=addresses,
+                    block_height=block_height
+                )
+
+                # addresses written before the heights were kept are looked up in the blocks just below, read
+                # through the block_height index
+                transaction.run(
+                    """
+                    MATCH (t:Transaction)
+                    WHERE t.block_height >= $scan_start_height AND t.block_height < $block_height
+                    MATCH (t)-[:SENT]-(a:Address)
+                    WHERE a.last_seen_block_height >= $block_height
+                    WITH a, max(t.block_height) AS last_seen_block_height
+                    SET a.last_seen_block_height = last_seen_block_height
+                    """,
+                    scan_start_height=block_height - LAST_SEEN_SCAN_BLOCKS,
+                    block_height=block_height
+                )
+
+                stale_addresses = transaction.run(
+                    """
+                    UNWIND $addresses AS delta
+                    MATCH (a:Address {address: delta.address})
+                    WHERE a.first_seen_block_height >= $block_height OR a.last_seen_block_height >= $block_height
+                    RETURN count(a) AS stale_addresses
+                    """,
+                    addresses=addresses,
+                    block_height=block_height
+                ).single()["stale_addresses"]
+                if stale_addresses:
+                    logger.warning(f"Address bounds left above the deleted block, rebuild_address_summaries corrects them", extra = logger_extra_data(block_height = block_height, stale_addresses = stale_addresses))
+
+                transaction.run(
+                    """
+                    MATCH (b:Block {block_height: $block_height})
+                    DELETE b
+                    """,
+                    block_height=block_height
+                )
+
+                if cache_update is not None:
+                    self._write_min_max_block_height_cache(transaction, *cache_update)
+
+                transaction.commit()
+
+                if cache_update is not None:
+                    self.min_block_height_cache, self.max_block_height_cache = cache_update
+                return True
+
+            except Exception as e:
+                self.graph_pool.invalidate_session(session)
+                transaction.rollback()
+                logger.error(f"An exception occurred while deleting block", extra = logger_extra_data(block_height = block_height, error = {'exception_type': e.__class__.__name__,'exception_message': str(e),'exception_args': e.args}))
+                return False
+
+            finally:
+                if transaction.closed() is False:
+                    transaction.close()
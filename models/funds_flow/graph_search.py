@@ -1,5 +1,16 @@
+import base64
+import json
 import os
-from neo4j import GraphDatabase
+import threading
+import time
+from collections import OrderedDict
+
+from neo4j import Query
+from neo4j.exceptions import Neo4jError
+
+from models.funds_flow.graph_connection_pool import GraphConnectionPool
+
+MAX_TRACE_HOPS = 10
 
 
 class GraphSearch:
@@ -8,34 +19,39 @@ class GraphSearch:
         graph_db_url: str = None,
         graph_db_user: str = None,
         graph_db_password: str = None,
+        graph_pool: GraphConnectionPool = None,
     ):
-        if graph_db_url is None:
-            self.graph_db_url = (
-                os.environ.get("GRAPH_DB_URL") or "bolt://localhost:7687"
-            )
-        else:
-            self.graph_db_url = graph_db_url
-
-        if graph_db_user is None:
-            self.graph_db_user = os.environ.get("GRAPH_DB_USER") or ""
+        if graph_pool is None:
+            self.graph_pool = GraphConnectionPool(graph_db_url, graph_db_user, graph_db_password)
+            self.owns_graph_pool = True
         else:
-            self.graph_db_user = graph_db_user
+            self.graph_pool = graph_pool
+            self.owns_graph_pool = False
 
-        if graph_db_password is None:
-            self.graph_db_password = os.environ.get("GRAPH_DB_PASSWORD") or ""
-        else:
-            self.graph_db_password = graph_db_password
+        self.graph_db_url = self.graph_pool.graph_db_url
+        self.graph_db_user = self.graph_pool.graph_db_user
+        self.graph_db_password = self.graph_pool.graph_db_password
+        self.driver = self.graph_pool.driver
 
-        self.driver = GraphDatabase.driver(
-            self.graph_db_url,
-            auth=(self.graph_db_user, self.graph_db_password),
-        )
+        # trace_funds results keyed by (params, indexed max block height)
+        self.trace_cache_size = int(os.environ.get("GRAPH_SEARCH_TRACE_CACHE_SIZE") or 256)
+        self.trace_time_budget = float(os.environ.get("GRAPH_SEARCH_TRACE_TIME_BUDGET") or 10)
+        self._trace_cache = OrderedDict()
+        self._trace_cache_lock = threading.Lock()
 
     def close(self):
-        self.driver.close()
+        if self.owns_graph_pool:
+            self.graph_pool.close()
+
+    def get_min_max_block_height(self, use_cache: bool = True):
+        # the Cache nodes are looked up through the Cache index, only fall back
+        # to scanning every Transaction when they have never been written
+        if use_cache:
+            min_block_height, max_block_height = self.get_min_max_block_height_cache()
+            if min_block_height and max_block_height:
+                return min_block_height, max_block_height
 
-    def get_min_max_block_height(self):
-        with self.driver.session() as session:
+        with self.graph_pool.session() as session:
             result = session.run(
                 """
                 MATCH (t:Transaction)
@@ -46,26 +62,205 @@ class GraphSearch:
             if single_result is None:
                 return [0, 0]
             return single_result.get('min_block_height'), single_result.get('max_block_height')
-        
+
     def get_min_max_block_height_cache(self):
-        with self.driver.session() as session:
-            result_min = session.run(
+        with self.graph_pool.session() as session:
+            result = session.run(
                 """
-                MATCH (n:Cache {field: 'min_block_height'})
-                RETURN n.value
+                OPTIONAL MATCH (min:Cache {field: 'min_block_height'})
+                OPTIONAL MATCH (max:Cache {field: 'max_block_height'})
+                RETURN min IS NOT NULL AS has_min, min.value AS min_value,
+                       max IS NOT NULL AS has_max, max.value AS max_value
                 LIMIT 1;
                 """
             ).single()
-            
-            result_max = session.run(
+
+            min_block_height = result['min_value'] if result and result['has_min'] else 0
+            max_block_height = result['max_value'] if result and result['has_max'] else 0
+
+            return min_block_height, max_block_height
+
+    def get_flow(self, from_address: str, to_address: str):
+        # single hop over the aggregated FLOWS_TO layer, see GraphIndexer.maintain_flows_to
+        with self.graph_pool.session() as session:
+            result = session.run(
                 """
-                MATCH (n:Cache {field: 'max_block_height'})
-                RETURN n.value
+                MATCH (a:Address {address: $from_address})-[f:FLOWS_TO]->(b:Address {address: $to_address})
+                RETURN f.value_satoshi AS value_satoshi, f.tx_count AS tx_count,
+                       f.first_block_height AS first_block_height, f.last_block_height AS last_block_height
                 LIMIT 1;
+                """,
+                from_address=from_address,
+                to_address=to_address
+            ).single()
+
+            if result is None:
+                return None
+            return dict(result)
+
+    def get_address_flows(self, address: str, direction: str = "out", limit: int = 100):
+        if direction == "out":
+            pattern = "(a:Address {address: $address})-[f:FLOWS_TO]->(c:Address)"
+        elif direction == "in":
+            pattern = "(a:Address {address: $address})<-[f:FLOWS_TO]-(c:Address)"
+        else:
+            raise ValueError(f"Unknown flow direction: {direction}")
+
+        with self.graph_pool.session() as session:
+            result = session.run(
+                f"""
+                MATCH {pattern}
+                RETURN c.address AS address, f.value_satoshi AS value_satoshi, f.tx_count AS tx_count,
+                       f.first_block_height AS first_block_height, f.last_block_height AS last_block_height
+                ORDER BY value_satoshi DESC
+                LIMIT $limit;
+                """,
+                address=address,
+                limit=limit
+            )
+            return [dict(record) for record in result]
+
+    def get_cache_value(self, field: str):
+        with self.graph_pool.session() as session:
+            result = session.run(
                 """
+                MATCH (n:Cache {field: $field})
+                RETURN n.value AS value
+                LIMIT 1;
+                """,
+                field=field
             ).single()
-            
-            min_block_height = result_min[0] if result_min else 0
-            max_block_height = result_max[0] if result_max else 0
+            return result["value"] if result else None
+
+    def get_address_summary(self, address: str):
+        # aggregates maintained on the Address node by GraphIndexer, no SENT edge is touched
+        with self.graph_pool.session() as session:
+            result = session.run(
+                """
+                MATCH (a:Address {address: $address})
+                RETURN a.total_received AS total_received, a.total_sent AS total_sent, a.tx_count AS tx_count,
+                       a.first_seen_block_height AS first_seen_block_height, a.last_seen_block_height AS last_seen_block_height
+                LIMIT 1;
+                """,
+                address=address
+            ).single()
+
+            if result is None:
+                return None
+            summary = dict(result)
+            summary["address"] = address
+            if summary["total_received"] is not None and summary["total_sent"] is not None:
+                summary["balance"] = summary["total_received"] - summary["total_sent"]
+            return summary
+
+    @staticmethod
+    def _encode_trace_cursor(block_height, offset):
+        data = json.dumps({"h": block_height, "o": offset}).encode("utf-8")
+        return base64.urlsafe_b64encode(data).decode("utf-8")
+
+    @staticmethod
+    def _decode_trace_cursor(cursor):
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode("utf-8")))
+        return data["h"], data["o"]
+
+    def trace_funds(self, address: str, direction: str = "out", max_hops: int = 3, min_value: int = 0,
+                    block_range=None, limit: int = 100, cursor: str = None, time_budget: float = None):
+        if direction == "out":
+            arrow_start, arrow_end = "-", "->"
+        elif direction == "in":
+            arrow_start, arrow_end = "<-", "-"
+        else:
+            raise ValueError(f"Unknown trace direction: {direction}")
+        if not 1 <= int(max_hops) <= MAX_TRACE_HOPS:
+            raise ValueError(f"max_hops must be between 1 and {MAX_TRACE_HOPS}")
+        if time_budget is None:
+            time_budget = self.trace_time_budget
+
+        # a cursor pins the indexed height of its first page so later pages stay consistent
+        if cursor is None:
+            _, indexed_max_block_height = self.get_min_max_block_height_cache()
+            offset = 0
+        else:
+            indexed_max_block_height, offset = self._decode_trace_cursor(cursor)
+
+        min_block_height, max_block_height = block_range if block_range else (0, indexed_max_block_height or 2 ** 31 - 1)
+        if indexed_max_block_height:
+            max_block_height = min(max_block_height, indexed_max_block_height)
+
+        cache_key = (address, direction, int(max_hops), min_value, min_block_height, max_block_height, limit, offset, indexed_max_block_height)
+        with self._trace_cache_lock:
+            if cache_key in self._trace_cache:
+                self._trace_cache.move_to_end(cache_key)
+                return self._trace_cache[cache_key]
+
+        # the filter lambda prunes each expansion on edge value and transaction height,
+        # one address hop is two SENT edges (Address -> Transaction -> Address)
+        query = Query(
+            f"""
+            MATCH p = (a:Address {{address: $address}}){arrow_start}[:SENT *BFS ..{2 * int(max_hops)} (e, n |
+                e.value_satoshi >= $min_value AND
+                (NOT n:Transaction OR (n.block_height >= $min_block_height AND n.block_height <= $max_block_height))
+            )]{arrow_end}(b:Address)
+            WHERE b <> a
+            RETURN b.address AS address,
+                   size(relationships(p)) / 2 AS hops,
+                   [n IN nodes(p) WHERE n:Transaction | n.tx_id] AS tx_ids,
+                   [r IN relationships(p) | r.value_satoshi] AS values
+            ORDER BY hops, address
+            SKIP $offset
+            LIMIT $limit
+            """,
+            timeout=time_budget,
+        )
+
+        start_time = time.time()
+        results = []
+        truncated = False
+        try:
+            with self.graph_pool.session() as session:
+                records = session.run(
+                    query,
+                    address=address,
+                    min_value=min_value,
+                    min_block_height=min_block_height,
+                    max_block_height=max_block_height,
+                    offset=offset,
+                    limit=limit + 1,
+                )
+                for record in records:
+                    # guard the budget client side as well, the server may not enforce transaction timeouts;
+                    # the rest of the stream is discarded with the next query on this session
+                    if time.time() - start_time > time_budget:
+                        truncated = True
+                        break
+                    results.append({
+                        "address": record["address"],
+                        "hops": record["hops"],
+                        "tx_ids": record["tx_ids"],
+                        "value_satoshi": record["values"][-1] if record["values"] else 0,
+                    })
+        except Neo4jError:
+            # the server aborted the query on the transaction timeout, return what arrived in time
+            if time.time() - start_time < time_budget:
+                raise
+            truncated = True
+
+        next_cursor = None
+        if len(results) > limit:
+            results = results[:limit]
+            next_cursor = self._encode_trace_cursor(indexed_max_block_height, offset + limit)
+
+        trace = {
+            "results": results,
+            "next_cursor": next_cursor,
+            "indexed_max_block_height": indexed_max_block_height,
+            "truncated": truncated,
+        }
+
+        if not truncated:
+            with self._trace_cache_lock:
+                self._trace_cache[cache_key] = trace
+                while len(self._trace_cache) > self.trace_cache_size:
+                    self._trace_cache.popitem(last=False)
 
-            return min_block_height, max_block_height
\ No newline at end of file
+        return trace
@@ -1,16 +1,26 @@
 import os
+import json
 import signal
+import threading
 import time
+from contextlib import contextmanager, nullcontext
 
 from node.node import BitcoinNode
 from setup_logger import setup_logger
 from setup_logger import logger_extra_data
-from node.node_utils import parse_block_data
+from setup_logger import configure_logging
 from models.funds_flow.graph_indexer import GraphIndexer
 from models.funds_flow.graph_search import GraphSearch
+from models.funds_flow.graph_connection_pool import GraphConnectionPool
+from metrics import block_stage_seconds, blocks_indexed, report_block_heights, start_metrics_server
+from profiling import BlockProfiler, setup_profiling
+from node.pipeline import FLUSH, Pipeline, Stage, StopPipeline
+from models.reorg import RecentBlockHashes, get_confirmations, rollback_reorged_blocks
 
 # Global flag to signal shutdown
 shutdown_flag = False
+# replaced in __main__ once .env is loaded, SIGUSR1 starts a capture
+block_profiler = BlockProfiler("funds_flow")
 logger = setup_logger("Indexer")
 
 
@@ -22,17 +32,57 @@ def shutdown_handler(signum, frame):
     shutdown_flag = True
 
 
-def index_block(_bitcoin_node, _graph_indexer, _graph_search, block_height):
+class PriorityWriteGate:
+    # bounds concurrent graph writes, a waiting priority writer is let in before any other
+    def __init__(self, capacity: int = 1):
+        self.capacity = capacity
+        self._condition = threading.Condition()
+        self._active = 0
+        self._priority_waiting = 0
+
+    @contextmanager
+    def acquire(self, priority: bool = False):
+        with self._condition:
+            if priority:
+                self._priority_waiting += 1
+                while self._active >= self.capacity:
+                    self._condition.wait()
+                self._priority_waiting -= 1
+            else:
+                while self._active >= self.capacity or self._priority_waiting > 0:
+                    self._condition.wait()
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._active -= 1
+                self._condition.notify_all()
+
+
+def index_block(_bitcoin_node, _graph_indexer, _graph_search, block_height, block_hashes: RecentBlockHashes, write_gate: PriorityWriteGate = None, priority: bool = False):
+    # True once written, False when the write failed, None when there is no deal data for the block
     # block = _bitcoin_node.get_block_by_height(block_height)
     # num_transactions = len(block["tx"])
     start_time = time.time()
     # block_data = parse_block_data(block)
-    deal_data = _bitcoin_node.get_deal_data_by_block(block_height)
-    if deal_data is None:
-        shutdown_handler(None, None)
-        return False
+    with block_profiler.block():
+        with block_stage_seconds.time(indexer="funds_flow", stage="fetch"):
+            block_hash = block_hashes.get(block_height)
+            deal_data = _bitcoin_node.get_deal_data_by_block(block_height, block_hash)
+        if deal_data is None:
+            # only this caller gives up on the height, the other smart mode workers carry on
+            logger.error(f"No deal data for block.", extra = logger_extra_data(block_height = block_height))
+            return None
 
-    success = _graph_indexer.create_graph_focused_on_money_flow(deal_data)
+        with block_stage_seconds.time(indexer="funds_flow", stage="prepare"):
+            payload = _graph_indexer.prepare_money_flow_payload(deal_data)
+        with write_gate.acquire(priority) if write_gate else nullcontext():
+            with block_stage_seconds.time(indexer="funds_flow", stage="write"):
+                success = _graph_indexer.write_money_flow_payload(payload, block_height, block_hash)
+    if success:
+        blocks_indexed.inc(indexer="funds_flow")
+        report_block_heights("funds_flow", indexed_height=block_height)
     num_transactions = len(deal_data)
     end_time = time.time()
     time_taken = end_time - start_time
@@ -46,56 +96,188 @@ def index_block(_bitcoin_node, _graph_indexer, _graph_search, block_height):
         logger.info("Processing transactions", extra = logger_extra_data(block_height = f"{block_height:>6}",num_transactions = formatted_num_transactions,time_taken = formatted_time_taken,tps = formatted_tps))
     else:
         logger.info("Processed transactions in 0.00 seconds (  Inf TPS).", extra = logger_extra_data(block_height = f"{block_height:>6}",num_transactions = formatted_num_transactions))
-        
-    min_block_height_cache, max_block_height_cache = _graph_search.get_min_max_block_height_cache()
-    if min_block_height_cache is None:
-        min_block_height_cache = block_height
-    if max_block_height_cache is None:
-        max_block_height_cache = block_height
-        
-    _graph_indexer.set_min_max_block_height_cache(min(min_block_height_cache, block_height), max(max_block_height_cache, block_height))
 
     return success
 
 
-def iterate_range(_bitcoin_node, _graph_indexer, _graph_search, start_height: int, end_height: int, in_reverse_order: bool = False):
+def log_pipelined_block(block_height, num_transactions, fetch_time, prepare_time, queue_wait, write_time):
+    # the pipeline times its own stages, only the wait for the writer is added here
+    block_stage_seconds.observe(queue_wait, indexer="funds_flow", stage="queue_wait")
+    blocks_indexed.inc(indexer="funds_flow")
+    report_block_heights("funds_flow", indexed_height=block_height)
+    time_taken = fetch_time + prepare_time + write_time
+    formatted_num_transactions = "{:>4}".format(num_transactions)
+    formatted_time_taken = "{:6.2f}".format(time_taken)
+    formatted_tps = "{:8.2f}".format(
+        num_transactions / time_taken if time_taken > 0 else float("inf")
+    )
+    logger.info("Processing transactions", extra = logger_extra_data(
+        block_height = f"{block_height:>6}",
+        num_transactions = formatted_num_transactions,
+        time_taken = formatted_time_taken,
+        tps = formatted_tps,
+        fetch_time = "{:6.2f}".format(fetch_time),
+        prepare_time = "{:6.2f}".format(prepare_time),
+        queue_wait = "{:6.2f}".format(queue_wait),
+        write_time = "{:6.2f}".format(write_time),
+    ))
+
+
+def create_block_pipeline(_bitcoin_node, _graph_indexer, pipeline_depth: int):
+    # depth 0 fetches, prepares and writes each block in turn in the calling thread
+    if pipeline_depth > 0:
+        fetch_workers = int(os.getenv('BITCOIN_INDEXER_FETCH_WORKERS', '1') or '1')
+        prepare_workers = int(os.getenv('BITCOIN_INDEXER_PREPARE_WORKERS', '1') or '1')
+    else:
+        fetch_workers = prepare_workers = 0
+    block_hashes = RecentBlockHashes(_bitcoin_node)
+
+    def fetch(block_height):
+        if _graph_indexer.check_if_block_is_indexed(block_height):
+            logger.info(f"Skipping block. Already indexed.", extra = logger_extra_data(block_height = block_height))
+            return None
+
+        # the writer counts the block, this only adds the fetch's share to the capture
+        with block_profiler.block(count=False):
+            start_time = time.time()
+            block_hash = block_hashes.get(block_height)
+            deal_data = _bitcoin_node.get_deal_data_by_block(block_height, block_hash)
+        if deal_data is None:
+            raise StopPipeline("missing_deal_data")
+        return {
+            "block_height": block_height,
+            "block_hash": block_hash,
+            "deal_data": deal_data,
+            "fetch_time": time.time() - start_time,
+        }
+
+    def prepare(block):
+        with block_profiler.block(count=False):
+            start_time = time.time()
+            deal_data = block.pop("deal_data")
+            block["num_transactions"] = len(deal_data)
+            block["payload"] = _graph_indexer.prepare_money_flow_payload(deal_data)
+        block["prepare_time"] = time.time() - start_time
+        block["prepared_at"] = time.time()
+        return block
+
+    def write(block):
+        block_height, block_hash = block["block_height"], block["block_hash"]
+        queue_wait = time.time() - block["prepared_at"]
+
+        start_time = time.time()
+        with block_profiler.block():
+            success = _graph_indexer.write_money_flow_payload(block["payload"], block_height, block_hash)
+        while not success and not shutdown_flag:
+            logger.error(f"Failed to index block.", extra = logger_extra_data(block_height = block_height))
+            time.sleep(30)
+            start_time = time.time()
+            success = _graph_indexer.write_money_flow_payload(block["payload"], block_height, block_hash)
+        if not success:
+            raise StopPipeline("shutdown")
+        write_time = time.time() - start_time
+
+        log_pipelined_block(block_height, block["num_transactions"], block["fetch_time"], block["prepare_time"], queue_wait, write_time)
+
+    return Pipeline(
+        "funds_flow",
+        [Stage("fetch", fetch, workers=fetch_workers), Stage("prepare", prepare, workers=prepare_workers)],
+        write,
+        queue_size=pipeline_depth,
+        stop_condition=lambda: shutdown_flag,
+    )
+
+
+def run_pipelined(_bitcoin_node, _graph_indexer, block_heights, pipeline_depth: int):
+    # on shutdown the blocks already fetched are still written, nothing new is started
+    end_reason = create_block_pipeline(_bitcoin_node, _graph_indexer, pipeline_depth).run(block_heights)
+
+    if end_reason == "missing_deal_data":
+        shutdown_handler(None, None)
+
+    return end_reason in (None, "missing_deal_data", "shutdown")
+
+
+def range_block_heights(start_height: int, end_height: int, in_reverse_order: bool = False):
+    block_height = start_height
+    step = -1 if in_reverse_order else +1
+
+    while (block_height - end_height) * step <= 0 and not shutdown_flag:
+        yield block_height
+        block_height += step
+
+
+def forward_block_heights(_bitcoin_node, _graph_indexer, start_height: int):
+    skip_blocks = get_confirmations()
+    block_height = start_height
+    current_block_height = -1
+
+    # only poll the node again once the known tip has been handed out
+    while not shutdown_flag:
+        if block_height > current_block_height:
+            # wait for the writer to commit everything handed out, then compare it with the node's chain
+            yield FLUSH
+            if shutdown_flag:
+                return
+            block_height = rollback_reorged_blocks(_bitcoin_node, _graph_indexer.get_indexed_block_hash, _graph_indexer.delete_block, block_height)
+
+            current_block_height = _bitcoin_node.get_current_block_height() - skip_blocks
+            report_block_heights("funds_flow", node_height=current_block_height + skip_blocks)
+            if block_height > current_block_height:
+                logger.info(
+                    f"Waiting for new blocks.",
+                    extra = logger_extra_data(block_height = current_block_height)
+                )
+                time.sleep(10)
+                continue
+
+        yield block_height
+        block_height += 1
+
+
+def iterate_range(_bitcoin_node, _graph_indexer, _graph_search, start_height: int, end_height: int, in_reverse_order: bool = False, pipeline_depth: int = 0):
     if in_reverse_order and start_height < end_height:
         logger.error("start_height must equal or greater than end_height in reverse indexer")
         return False
     if not in_reverse_order and start_height > end_height:
         logger.error("start_height must equal or less than end_height in reverse indexer")
         return False
-    
-    global shutdown_flag
-    
-    block_height = start_height
-    step = -1 if in_reverse_order else +1
-    
-    while (block_height - end_height) * step <= 0 and not shutdown_flag:
-        if _graph_indexer.check_if_block_is_indexed(block_height):
-            logger.info(f"Skipping block. Already indexed.", extra = logger_extra_data(block_height = block_height))
-            block_height += step
-            continue
-        
-        success = index_block(_bitcoin_node, _graph_indexer, _graph_search, block_height)
-        
-        if success:
-            block_height += step
-        else:
-            logger.error(f"Failed to index block.", extra = logger_extra_data(block_height = block_height))
-            time.sleep(30)
-            
-    return True
 
+    return run_pipelined(_bitcoin_node, _graph_indexer, range_block_heights(start_height, end_height, in_reverse_order), pipeline_depth)
 
-def move_forward(_bitcoin_node, _graph_indexer, _graph_search, start_height: int):
-    global shutdown_flag
 
-    skip_blocks = 6
-    block_height = start_height
-    
+def move_forward(_bitcoin_node, _graph_indexer, _graph_search, start_height: int, pipeline_depth: int = 0):
+    run_pipelined(_bitcoin_node, _graph_indexer, forward_block_heights(_bitcoin_node, _graph_indexer, start_height), pipeline_depth)
+
+
+def split_backfill_ranges(start_height: int, num_workers: int):
+    # disjoint descending ranges covering start_height - 1 down to 1, one per worker
+    ranges = []
+    high = start_height - 1
+    size = max(high // max(num_workers, 1), 1)
+    while high >= 1 and len(ranges) < num_workers:
+        low = 1 if len(ranges) == num_workers - 1 else max(high - size + 1, 1)
+        ranges.append({"high": high, "low": low, "next": high})
+        high = low - 1
+    return ranges
+
+
+def follow_tip(_bitcoin_node, _graph_indexer, _graph_search, progress, progress_lock, write_gate, block_hashes):
+    skip_blocks = get_confirmations()
+    block_height = progress["forward"]
+    current_block_height = -1
+
+    def delete_block(height):
+        # rollbacks touch the same Address nodes as the backfill writes
+        with write_gate.acquire(priority=True):
+            return _graph_indexer.delete_block(height)
+
     while not shutdown_flag:
-        current_block_height = _bitcoin_node.get_current_block_height() - skip_blocks
+        # only poll the node and check for reorgs once the known tip has been indexed
+        if block_height > current_block_height:
+            block_height = rollback_reorged_blocks(_bitcoin_node, _graph_indexer.get_indexed_block_hash, delete_block, block_height)
+            current_block_height = _bitcoin_node.get_current_block_height() - skip_blocks
+            report_block_heights("funds_flow", node_height=current_block_height + skip_blocks)
         if block_height > current_block_height:
             logger.info(
                 f"Waiting for new blocks.",
@@ -103,68 +285,101 @@ def move_forward(_bitcoin_node, _graph_indexer, _graph_search, start_height: int
             )
             time.sleep(10)
             continue
-        
+
         if _graph_indexer.check_if_block_is_indexed(block_height):
             logger.info(f"Skipping block. Already indexed.", extra = logger_extra_data(block_height = block_height))
             block_height += 1
-            continue
-        
-        success = index_block(_bitcoin_node, _graph_indexer, _graph_search, block_height)
-        
-        if success:
+        elif index_block(_bitcoin_node, _graph_indexer, _graph_search, block_height, block_hashes, write_gate, priority=True):
             block_height += 1
         else:
             logger.error(f"Failed to index block.", extra = logger_extra_data(block_height = block_height))
             time.sleep(30)
-            
-            
-def do_smart_indexing(_bitcoin_node, _graph_indexer, _graph_search, start_height: int):
-    global shutdown_flag
+            continue
 
-    skip_blocks = 6
-    
-    forward_block_height = start_height
-    backward_block_height = start_height - 1
+        with progress_lock:
+            progress["forward"] = block_height
 
-    while not shutdown_flag:
-        current_block_height = _bitcoin_node.get_current_block_height() - skip_blocks
-        block_height = forward_block_height
-        is_indexing_reverse = False
-        
-        if block_height > current_block_height: # if forward indexer has reached the latest block
-            if backward_block_height == 0: # if finished reverse indexer, just wait for new blocks
-                logger.info(
-                    f"Waiting for new blocks.",
-                    extra = logger_extra_data(block_height = current_block_height)
-                )
-                time.sleep(10)
-                continue
-            else: # if has something to index in the reverser indexer, run reverse indexer
-                logger.info(
-                    f"Running reverse indexer while waiting for new blocks...",
-                    extra = logger_extra_data(block_height = current_block_height)
-                )
-                block_height = backward_block_height
-                is_indexing_reverse = True
-        
-        while _graph_indexer.check_if_block_is_indexed(block_height): # skip blocks already indexed
-            logger.info(f"Skipping block. Already indexed.", extra = logger_extra_data(block_height = block_height))
-            block_height += -1 if is_indexing_reverse else 1
 
-        if block_height == 0: # if backward indexer has reached the genesis, just continue
-            backward_block_height = 0
-            time.sleep(10)
-            continue
-        
-        success = index_block(_bitcoin_node, _graph_indexer, _graph_search, block_height)        
-        if success:
-            if is_indexing_reverse:
-                backward_block_height = block_height - 1
-            else:
-                forward_block_height = block_height + 1
+def backfill_range(_bitcoin_node, _graph_indexer, _graph_search, worker_progress, progress_lock, write_gate, block_hashes):
+    block_height = worker_progress["next"]
+    while block_height >= worker_progress["low"] and not shutdown_flag:
+        success = _graph_indexer.check_if_block_is_indexed(block_height) or index_block(
+            _bitcoin_node, _graph_indexer, _graph_search, block_height, block_hashes, write_gate)
+        if success is None:
+            # the pickles do not cover the rest of the range, a restart resumes from the checkpoint
+            break
+        elif success:
+            block_height -= 1
         else:
+            # concurrent writers can conflict on shared Address nodes, retry soon
             logger.error(f"Failed to index block.", extra = logger_extra_data(block_height = block_height))
-            time.sleep(30)
+            time.sleep(5)
+            continue
+
+        with progress_lock:
+            worker_progress["next"] = block_height
+
+    logger.info(f"Backfill worker finished.", extra = logger_extra_data(high = worker_progress["high"], low = worker_progress["low"], next = block_height))
+
+
+def do_smart_indexing(_bitcoin_node, _graph_indexer, _graph_search, start_height: int):
+    num_workers = int(os.getenv('BITCOIN_INDEXER_BACKFILL_WORKERS', '2') or '2')
+    max_concurrent_writes = int(os.getenv('BITCOIN_INDEXER_MAX_CONCURRENT_WRITES', '1') or '1')
+    checkpoint_interval = int(os.getenv('BITCOIN_INDEXER_CHECKPOINT_INTERVAL', '30') or '30')
+    progress_field = 'smart_indexing_progress'
+
+    # resume every worker from the last checkpoint of a run with the same start height
+    progress = None
+    checkpoint = _graph_search.get_cache_value(progress_field)
+    if checkpoint:
+        progress = json.loads(checkpoint)
+        if progress.get("start_height") != start_height:
+            progress = None
+    if progress is None:
+        progress = {
+            "start_height": start_height,
+            "forward": start_height,
+            "workers": split_backfill_ranges(start_height, num_workers),
+        }
+    logger.info(f"Smart indexing progress", extra = logger_extra_data(progress = progress))
+
+    progress_lock = threading.Lock()
+    write_gate = PriorityWriteGate(max_concurrent_writes)
+    block_hashes = RecentBlockHashes(_bitcoin_node)
+
+    threads = [threading.Thread(
+        target=follow_tip,
+        args=(_bitcoin_node, _graph_indexer, _graph_search, progress, progress_lock, write_gate, block_hashes),
+        name="tip-follower",
+    )]
+    for i, worker_progress in enumerate(progress["workers"]):
+        if worker_progress["next"] >= worker_progress["low"]:
+            threads.append(threading.Thread(
+                target=backfill_range,
+                args=(_bitcoin_node, _graph_indexer, _graph_search, worker_progress, progress_lock, write_gate, block_hashes),
+                name=f"backfill-{i}",
+            ))
+    for thread in threads:
+        thread.start()
+
+    def checkpoint_progress():
+        with progress_lock:
+            value = json.dumps(progress)
+        try:
+            _graph_indexer.set_cache_value(progress_field, value)
+        except Exception as e:
+            logger.error(f"Failed to checkpoint progress.", extra = logger_extra_data(error = {'exception_type': e.__class__.__name__,'exception_message': str(e),'exception_args': e.args}))
+
+    last_checkpoint = time.time()
+    while any(thread.is_alive() for thread in threads):
+        time.sleep(1)
+        if time.time() - last_checkpoint >= checkpoint_interval:
+            checkpoint_progress()
+            last_checkpoint = time.time()
+
+    for thread in threads:
+        thread.join()
+    checkpoint_progress()
 
 
 # Register the shutdown handler for SIGINT and SIGTERM
@@ -174,15 +389,20 @@ signal.signal(signal.SIGTERM, shutdown_handler)
 if __name__ == "__main__":
     from dotenv import load_dotenv
     load_dotenv()
+    configure_logging()
+    start_metrics_server()
+    block_profiler = setup_profiling("funds_flow")
 
     bitcoin_node = BitcoinNode()
-    graph_indexer = GraphIndexer()
-    graph_search = GraphSearch()
+    graph_pool = GraphConnectionPool()
+    graph_indexer = GraphIndexer(graph_pool=graph_pool)
+    graph_search = GraphSearch(graph_pool=graph_pool)
     
     smart_mode_str = os.getenv('BITCOIN_INDEXER_SMART_MODE', '0') or '0'
     start_height_str = os.getenv('BITCOIN_INDEXER_START_BLOCK_HEIGHT', None)
     end_height_str = os.getenv('BITCOIN_INDEXER_END_BLOCK_HEIGHT', '-1') or '-1'
     in_reverse_order_str = os.getenv('BITCOIN_INDEXER_IN_REVERSE_ORDER', '0') or '0'
+    pipeline_depth_str = os.getenv('BITCOIN_INDEXER_PIPELINE_DEPTH', '0') or '0'
     
     logger.info("BITCOIN_INDEXER_IN_REVERSE_ORDER", extra = logger_extra_data(in_reverse_order = in_reverse_order_str))
     
@@ -193,6 +413,7 @@ if __name__ == "__main__":
         start_height = int(start_height_str)
         end_height = int(end_height_str)
         in_reverse_order = int(in_reverse_order_str)
+        pipeline_depth = int(pipeline_depth_str)
 
         logger.info("Starting indexer")
         
@@ -203,16 +424,20 @@ if __name__ == "__main__":
         indexed_min_block_height, indexed_max_block_height = graph_search.get_min_max_block_height()
         graph_indexer.set_min_max_block_height_cache(indexed_min_block_height, indexed_max_block_height)
         logger.info(f"Indexed block height range", extra=logger_extra_data(indexed_min_block_height=indexed_min_block_height, indexed_max_block_height=indexed_max_block_height))
+        report_block_heights("funds_flow", indexed_height=indexed_max_block_height)
 
         if start_height > -1 and smart_mode: # if smart mode, run both forward and reverse indexer
             do_smart_indexing(bitcoin_node, graph_indexer, graph_search, start_height)
         elif start_height > -1 and end_height > -1: # if specifed both start and end, then iterate range
-            iterate_range(bitcoin_node, graph_indexer, graph_search, start_height, end_height, bool(in_reverse_order))
+            iterate_range(bitcoin_node, graph_indexer, graph_search, start_height, end_height, bool(in_reverse_order), pipeline_depth)
         elif in_reverse_order: # if end is not specifed but in reverse order, then set end_height 1 and iterate range
-            iterate_range(bitcoin_node, graph_indexer, graph_search, start_height, 1, bool(in_reverse_order))
+            iterate_range(bitcoin_node, graph_indexer, graph_search, start_height, 1, bool(in_reverse_order), pipeline_depth)
         else: # if end_height and in_reverse_order are both unset, then move forward in real-time
-            move_forward(bitcoin_node, graph_indexer, graph_search, start_height)
+            move_forward(bitcoin_node, graph_indexer, graph_search, start_height, pipeline_depth)
         
-        graph_indexer.close()
-        graph_search.close()
-        logger.info("Indexer stopped")
+        graph_pool.log_metrics()
+
+    graph_indexer.close()
+    graph_search.close()
+    graph_pool.close()
+    logger.info("Indexer stopped")
@@ -0,0 +1,29 @@
+from models.funds_flow.graph_indexer import GraphIndexer
+from models.funds_flow.graph_search import GraphSearch
+from models.funds_flow.graph_connection_pool import GraphConnectionPool
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    # the funds-flow indexer must be stopped while rebuilding, or its blocks are counted twice
+    graph_pool = GraphConnectionPool()
+    graph_indexer = GraphIndexer(graph_pool=graph_pool)
+    graph_search = GraphSearch(graph_pool=graph_pool)
+
+    indexed_min_block_height, indexed_max_block_height = graph_search.get_min_max_block_height()
+    print(f"Indexed block height range: ({indexed_min_block_height}, {indexed_max_block_height})")
+
+    print("Clearing address summaries...")
+    cleared = graph_indexer.delete_address_summaries()
+    print(f"Cleared {cleared} address summaries")
+
+    if indexed_min_block_height and indexed_max_block_height:
+        print("Rebuilding address summaries...")
+        graph_indexer.rebuild_address_summaries(indexed_min_block_height, indexed_max_block_height)
+        print("Rebuilt address summaries")
+
+    graph_search.close()
+    graph_indexer.close()
+    graph_pool.close()
@@ -0,0 +1,29 @@
+from models.funds_flow.graph_indexer import GraphIndexer
+from models.funds_flow.graph_search import GraphSearch
+from models.funds_flow.graph_connection_pool import GraphConnectionPool
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    # the funds-flow indexer must be stopped while rebuilding, or its blocks are counted twice
+    graph_pool = GraphConnectionPool()
+    graph_indexer = GraphIndexer(graph_pool=graph_pool)
+    graph_search = GraphSearch(graph_pool=graph_pool)
+
+    indexed_min_block_height, indexed_max_block_height = graph_search.get_min_max_block_height()
+    print(f"Indexed block height range: ({indexed_min_block_height}, {indexed_max_block_height})")
+
+    print("Deleting FLOWS_TO edges...")
+    deleted = graph_indexer.delete_flows_to()
+    print(f"Deleted {deleted} FLOWS_TO edges")
+
+    if indexed_min_block_height and indexed_max_block_height:
+        print("Rebuilding FLOWS_TO edges...")
+        graph_indexer.rebuild_flows_to(indexed_min_block_height, indexed_max_block_height)
+        print("Rebuilt FLOWS_TO edges")
+
+    graph_search.close()
+    graph_indexer.close()
+    graph_pool.close()
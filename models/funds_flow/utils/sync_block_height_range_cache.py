@@ -1,13 +1,15 @@
 from models.funds_flow.graph_indexer import GraphIndexer
 from models.funds_flow.graph_search import GraphSearch
+from models.funds_flow.graph_connection_pool import GraphConnectionPool
 
 
 if __name__ == '__main__':
     from dotenv import load_dotenv
     load_dotenv()
 
-    graph_indexer = GraphIndexer()
-    graph_search = GraphSearch()
+    graph_pool = GraphConnectionPool()
+    graph_indexer = GraphIndexer(graph_pool=graph_pool)
+    graph_search = GraphSearch(graph_pool=graph_pool)
     
     print("Creating indexes...")
     
@@ -15,10 +17,11 @@ if __name__ == '__main__':
     
     print("Executing cypher query...")
     
-    indexed_min_block_height, indexed_max_block_height = graph_search.get_min_max_block_height()
+    indexed_min_block_height, indexed_max_block_height = graph_search.get_min_max_block_height(use_cache=False)
     graph_indexer.set_min_max_block_height_cache(indexed_min_block_height, indexed_max_block_height)
 
     print(f"Updated min/max cache: ({indexed_min_block_height}, {indexed_max_block_height})")
 
     graph_search.close()
-    graph_indexer.close()
\ No newline at end of file
+    graph_indexer.close()
+    graph_pool.close()
\ No newline at end of file
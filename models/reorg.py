@@ -0,0 +1,65 @@
+import os
+import threading
+import time
+
+from setup_logger import setup_logger
+from setup_logger import logger_extra_data
+
+logger = setup_logger("Indexer")
+
+
+def get_confirmations():
+    # 0 follows the tip itself, reorged blocks are rolled back by rollback_reorged_blocks
+    return int(os.getenv('BITCOIN_INDEXER_CONFIRMATIONS', '6') or '6')
+
+
+def get_max_reorg_depth():
+    return int(os.getenv('BITCOIN_INDEXER_MAX_REORG_DEPTH', '100') or '100')
+
+
+def rollback_reorged_blocks(_bitcoin_node, get_indexed_block_hash, delete_block, block_height):
+    # block_height is the next height to index, returns the height to continue from. The store is
+    # given by its get_indexed_block_hash and delete_block
+    reorg_height = _bitcoin_node.find_reorg_height(get_indexed_block_hash, block_height - 1, get_max_reorg_depth())
+    if reorg_height is None:
+        return block_height
+
+    logger.info(f"Chain reorganization detected. Rolling back blocks.", extra = logger_extra_data(reorg_height = reorg_height, block_height = block_height - 1))
+    for height in range(block_height - 1, reorg_height - 1, -1):
+        while not delete_block(height):
+            logger.error(f"Failed to roll back block.", extra = logger_extra_data(block_height = height))
+            time.sleep(30)
+    return reorg_height
+
+
+class RecentBlockHashes:
+    """Block hashes for the heights a reorg can reach, deeper blocks are written without one.
+
+    Saves a getblockhash round trip per block while backfilling from the deal pickles. A height without a
+    recorded hash stops find_reorg_height's walk, so it only needs hashes within max_reorg_depth of the tip.
+    """
+
+    def __init__(self, bitcoin_node, max_reorg_depth: int = None, refresh_interval: float = 60):
+        self.bitcoin_node = bitcoin_node
+        self.max_reorg_depth = get_max_reorg_depth() if max_reorg_depth is None else max_reorg_depth
+        self.refresh_interval = refresh_interval
+        self._tip_height = None
+        self._refreshed_at = 0
+        self._lock = threading.Lock()
+
+    def is_recent(self, block_height):
+        with self._lock:
+            # the tip only moves up, a block deep below a stale tip is deep below the current one as well
+            if self._tip_height is not None and block_height <= self._tip_height - self.max_reorg_depth:
+                return False
+            if time.time() - self._refreshed_at >= self.refresh_interval:
+                tip_height = self.bitcoin_node.get_current_block_height()
+                if tip_height is not None:
+                    self._tip_height = tip_height
+                self._refreshed_at = time.time()
+            return self._tip_height is None or block_height > self._tip_height - self.max_reorg_depth
+
+    def get(self, block_height):
+        if not self.is_recent(block_height):
+            return None
+        return self.bitcoin_node.get_block_hash(block_height)
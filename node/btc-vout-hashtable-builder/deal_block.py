@@ -1,17 +1,41 @@
 import os
+import signal
 from node.node import BitcoinNode
 from node.node_utils import parse_block_data
 from utils import save_hash_table
-import concurrent.futures
-from threading import Lock
-from setup_logger import setup_logger
+from setup_logger import setup_logger, configure_logging
+from metrics import blocks_indexed, report_block_heights, start_metrics_server
+from node.pipeline import Pipeline, Stage, StopPipeline
+from node.deal_encoding import encode_deal_data
 from dotenv import load_dotenv
 import time
 
 
 load_dotenv()
+configure_logging()
 logger = setup_logger("Indexer")
 
+# DEAL_ENCODING=compact writes each block as an EncodedBlock instead of the per-tx dicts
+compact_encoding = (os.getenv('DEAL_ENCODING') or 'dict') == 'compact'
+
+shutdown_flag = False
+
+
+def shutdown_handler(signum, frame):
+    global shutdown_flag
+    logger.info("Shutdown signal received. Finishing the blocks in flight, the range is not saved.")
+    shutdown_flag = True
+
+
+def encode_block_table(block_height, block_table):
+    if not compact_encoding:
+        return block_table
+    try:
+        return encode_deal_data(block_table)
+    except ValueError as e:
+        logger.error(f"Keeping dict layout for block {block_height}: {e}")
+        return block_table
+
 
 def get_block_with_retry(bitcoin_node, block_height, retries=30, delay=2):
     for attempt in range(retries):
@@ -22,41 +46,14 @@ def get_block_with_retry(bitcoin_node, block_height, retries=30, delay=2):
         time.sleep(delay)
 
 
-def deal_one_block_multithreaded(_bitcoin_node, block_data):
-    block_table = {}
-    transactions = block_data.transactions
-    lock = Lock()  # 用于保护共享资源block_table的线程锁
-
-    def process_transaction(tx):
-        nonlocal block_table
-        try:
-            in_amount_by_address, out_amount_by_address, input_addresses, output_addresses, in_total_amount, out_total_amount = _bitcoin_node.process_in_memory_txn_for_indexing(tx)
-            with lock:
-                block_table[tx.tx_id] = {
-                    'in_amount_by_address': in_amount_by_address,
-                    'out_amount_by_address': out_amount_by_address,
-                    'input_addresses': input_addresses,
-                    'output_addresses': output_addresses,
-                    'in_total_amount': in_total_amount,
-                    'out_total_amount': out_total_amount,
-                    'tx_info': {
-                        "timestamp": tx.timestamp,
-                        "block_height": tx.block_height,
-                        "is_coinbase": tx.is_coinbase,
-                    }
-                }
-        except Exception as e:
-            logger.error(f"Error processing {block_data.block_height} transaction {tx}: {e}")
-
-    # 设置内层线程池的大小，根据具体情况调整，避免过度使用CPU资源
-    num_inner_threads = 64  # 假设一个区块内最多32个交易并行处理
-    with concurrent.futures.ThreadPoolExecutor(max_workers=num_inner_threads) as executor:
-        futures = {executor.submit(process_transaction, tx) for tx in transactions}
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                future.result()
-            except Exception as e:
-                logger.error(f"Exception in {block_data.block_height} transaction processing: {e}")
+def deal_one_block(_bitcoin_node, block_data):
+    # the block is resolved and netted in one call, threads per tx only contended for the GIL
+    try:
+        block_table = _bitcoin_node.create_deal_data(block_data)
+    except Exception as e:
+        # ends the pipeline, a range missing a block's transactions is not saved
+        logger.error(f"Error processing block {block_data.block_height}: {e}")
+        raise
 
     if block_data.block_height % 100 == 0:
         logger.info(f"success deal block: {block_data.block_height}")
@@ -73,20 +70,41 @@ def deal(bitcoin_node, start_block, end_block):
         logger.info(f"target_path already exist: {target_path}")
         return
 
+    def fetch(block_height):
+        block = get_block_with_retry(bitcoin_node, block_height)
+        if block is None:
+            raise StopPipeline("missing_block")
+        return block
+
+    def resolve(block_data):
+        return block_data.block_height, deal_one_block(bitcoin_node, block_data)
+
+    def collect(result):
+        block_height, block_table = result
+        deal_table[block_height] = encode_block_table(block_height, block_table)
+        blocks_indexed.inc(indexer="deal_block")
+        report_block_heights("deal_block", indexed_height=block_height)
+
     # 设置外层线程池的大小，合理分配CPU核心
     num_outer_threads = 16  # 假设最多同时处理16个区块
-    with concurrent.futures.ThreadPoolExecutor(max_workers=num_outer_threads) as executor:
-        future_to_block = {
-            executor.submit(lambda block_height: (
-                block_height,
-                deal_one_block_multithreaded(bitcoin_node, parse_block_data(get_block_with_retry(bitcoin_node, block_height)))
-            ), block_height): block_height
-            for block_height in range(start_block, end_block + 1)
-        }
-
-        for future in concurrent.futures.as_completed(future_to_block):
-            block_height, block_table = future.result()
-            deal_table[block_height] = block_table
+    pipeline = Pipeline(
+        "deal_block",
+        [
+            Stage("fetch", fetch, workers=num_outer_threads),
+            Stage("parse", parse_block_data, workers=4),
+            Stage("resolve", resolve, workers=num_outer_threads),
+        ],
+        collect,
+        ordered=False,
+        queue_size=num_outer_threads * 2,
+        stop_condition=lambda: shutdown_flag,
+        sink_name="collect",
+    )
+    end_reason = pipeline.run(range(start_block, end_block + 1))
+
+    if end_reason is not None or len(deal_table) != end_block - start_block + 1:
+        logger.error(f"incomplete range, not saving target_path: {target_path}, end_reason: {end_reason}, blocks: {len(deal_table)}")
+        return
 
     save_hash_table(deal_table, target_path)  # 假设save_hash_table是保存字典的函数
     logger.info(f"success save target_path: {target_path}")
@@ -99,11 +117,14 @@ if __name__ == "__main__":
     end_height = int(end_height_str)
 
     interval = 10000
+    start_metrics_server()
+    signal.signal(signal.SIGINT, shutdown_handler)
+    signal.signal(signal.SIGTERM, shutdown_handler)
     bitcoin_node = BitcoinNode()
 
     # 确保起始块在间隔范围内
     current_block = start_height
-    while current_block <= end_height:
+    while current_block <= end_height and not shutdown_flag:
         deal(bitcoin_node, current_block, min(current_block + interval, end_height))  # 确保不超过end_block
         current_block += interval
 
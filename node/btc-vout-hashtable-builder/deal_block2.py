@@ -1,16 +1,44 @@
+import gc
 import os
+import signal
 from node.node import BitcoinNode
 from utils import save_hash_table
-from setup_logger import setup_logger
+from setup_logger import setup_logger, configure_logging
+from metrics import (NODE_METRICS, blocks_indexed, merge_metric_deltas, metric_deltas, report_block_heights, snapshot_metrics,
+                     start_metrics_server)
+from node.pipeline import Pipeline, Stage, StopPipeline
+from node.deal_encoding import encode_deal_data
 from node.node_utils import parse_block_data
 from dotenv import load_dotenv
 import time
-import multiprocessing
-from functools import partial
 
 load_dotenv()
+configure_logging()
 logger = setup_logger("Indexer")
 
+# DEAL_ENCODING=compact writes each block as an EncodedBlock instead of the per-tx dicts
+compact_encoding = (os.getenv('DEAL_ENCODING') or 'dict') == 'compact'
+
+shutdown_flag = False
+# set before the pipeline forks its deal workers, they inherit it instead of unpickling a node per block
+bitcoin_node = None
+
+
+def shutdown_handler(signum, frame):
+    global shutdown_flag
+    logger.info("Shutdown signal received. Finishing the blocks in flight, the range is not saved.")
+    shutdown_flag = True
+
+
+def encode_block_table(block_height, block_table):
+    if not compact_encoding:
+        return block_table
+    try:
+        return encode_deal_data(block_table)
+    except ValueError as e:
+        logger.error(f"Keeping dict layout for block {block_height}: {e}")
+        return block_table
+
 
 def get_block_with_retry(bitcoin_node, block_height, retries=30, delay=2):
     for attempt in range(retries):
@@ -21,38 +49,34 @@ def get_block_with_retry(bitcoin_node, block_height, retries=30, delay=2):
         time.sleep(delay)
 
 
-def deal_one_block(bitcoin_node, block_height):
-    block_table = {}
+def init_resolve_worker():
+    # the parent coordinates shutdown and drains the blocks in flight
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def deal_one_block(block_height):
+    # fetched in the worker too, only the height and the finished table cross the process boundary
     logger.info(f"start deal block: {block_height}")
+    # the RPC and vout counters move in this process, the parent's /metrics only sees what is sent back
+    metric_snapshots = snapshot_metrics(NODE_METRICS)
+    block = get_block_with_retry(bitcoin_node, block_height)
+    if block is None:
+        raise StopPipeline("missing_block")
     try:
-        block = get_block_with_retry(bitcoin_node, block_height)
-        block_data = parse_block_data(block)
-        transactions = block_data.transactions
-
-        for tx in transactions:
-            in_amount_by_address, out_amount_by_address, input_addresses, output_addresses, in_total_amount, out_total_amount = _bitcoin_node.process_in_memory_txn_for_indexing(tx)
-            block_table[tx.tx_id] = {
-                'in_amount_by_address': in_amount_by_address,
-                'out_amount_by_address': out_amount_by_address,
-                'input_addresses': input_addresses,
-                'output_addresses': output_addresses,
-                'in_total_amount': in_total_amount,
-                'out_total_amount': out_total_amount,
-                'tx_info': {
-                    "timestamp": tx.timestamp,
-                    "block_height": tx.block_height,
-                    "is_coinbase": tx.is_coinbase,
-                }
-            }
+        block_table = bitcoin_node.create_deal_data(parse_block_data(block))
         if block_height % 100 == 0:
             logger.info(f"success deal block: {block_height}")
     except Exception as e:
+        # ends the pipeline, a range missing a block's transactions is not saved
         logger.error(f"Error deal_one_block2 {block_height} : {e}")
+        raise
 
-    return block_height, block_table
+    # encoded in the worker, the compact block is also cheaper to send back to the parent
+    return block_height, encode_block_table(block_height, block_table), metric_deltas(NODE_METRICS, metric_snapshots)
 
 
-def deal(bitcoin_node, start_block, end_block):
+def deal(start_block, end_block):
 
     deal_table = {}
     target_path = f"/deal_block/{start_block}-{end_block}.pkl"
@@ -62,10 +86,28 @@ def deal(bitcoin_node, start_block, end_block):
         logger.info(f"target_path2 already exist: {target_path}")
         return
 
-    with multiprocessing.Pool(64) as p:
-        results = p.map(partial(deal_one_block, bitcoin_node), range(start_block, end_block + 1))
-        for block_height, block_table in results:
-            deal_table[block_height] = block_table
+    def collect(result):
+        block_height, block_table, node_metric_deltas = result
+        deal_table[block_height] = block_table
+        merge_metric_deltas(NODE_METRICS, node_metric_deltas)
+        blocks_indexed.inc(indexer="deal_block")
+        report_block_heights("deal_block", indexed_height=block_height)
+
+    # fetching, parsing and resolving all run in 64 forked processes, as the Pool.map did
+    pipeline = Pipeline(
+        "deal_block",
+        [Stage("deal", deal_one_block, workers=64, mode="process", initializer=init_resolve_worker)],
+        collect,
+        ordered=False,
+        queue_size=64,
+        stop_condition=lambda: shutdown_flag,
+        sink_name="collect",
+    )
+    end_reason = pipeline.run(range(start_block, end_block + 1))
+
+    if end_reason is not None or len(deal_table) != end_block - start_block + 1:
+        logger.error(f"incomplete range, not saving target_path2: {target_path}, end_reason: {end_reason}, blocks: {len(deal_table)}")
+        return
 
     save_hash_table(deal_table, target_path)  # 假设save_hash_table是保存字典的函数
     logger.info(f"success save target_path2: {target_path}")
@@ -78,11 +120,17 @@ if __name__ == "__main__":
     end_height = int(end_height_str)
 
     interval = 10000
+    start_metrics_server()
+    signal.signal(signal.SIGINT, shutdown_handler)
+    signal.signal(signal.SIGTERM, shutdown_handler)
     bitcoin_node = BitcoinNode()
+    # the pickled tables are kept for the life of the process, later collections and the forked deal workers
+    # leave them untouched
+    gc.freeze()
 
     # 确保起始块在间隔范围内
     current_block = start_height
-    while current_block <= end_height:
-        deal(bitcoin_node, current_block, min(current_block + interval, end_height))  # 确保不超过end_block
+    while current_block <= end_height and not shutdown_flag:
+        deal(current_block, min(current_block + interval, end_height))  # 确保不超过end_block
         current_block += interval
 
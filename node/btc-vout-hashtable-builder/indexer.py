@@ -2,6 +2,7 @@ import os
 
 from node.node_utils import initialize_tx_out_hash_table
 from utils import index_hash_table, save_hash_table
+from metrics import start_metrics_server
 import argparse
 
 def parse_args():
@@ -25,6 +26,7 @@ if __name__ == '__main__':
     if os.path.exists(target_path):
         os.remove(target_path)
 
+    start_metrics_server()
     hash_table = initialize_tx_out_hash_table()
     n_threads = int(os.environ.get("INDEXING_THREADS", 64))
     index_hash_table(hash_table, csv_file, n_threads=n_threads)
@@ -0,0 +1,176 @@
+import array
+import re
+
+# the transactions of deal data are iterated as plain tuples, a namedtuple costs more to build than the rest of a tx:
+#   (tx_id, inputs, outputs, in_total_amount, out_total_amount, timestamp, block_height, is_coinbase)
+# with inputs and outputs as lists of (address, amount) pairs after netting
+
+_TX_ID_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+
+class EncodedBlock:
+    """One block's deal data as header fields, an address string table and flat integer arrays.
+
+    The inputs of transaction i are in_address_ids[in_offsets[i]:in_offsets[i + 1]] with the amounts at the same
+    positions of in_amounts, outputs likewise. Only the addresses left with a non-zero amount after netting are kept,
+    the per-tx totals are their sums. tx_ids packs the 32 byte ids of a block whose ids are all hex, else it is a
+    tuple of the id strings.
+    """
+
+    __slots__ = (
+        "block_height", "timestamp", "tx_ids", "coinbase_flags", "addresses",
+        "in_offsets", "in_address_ids", "in_amounts", "out_offsets", "out_address_ids", "out_amounts",
+    )
+
+    def __init__(self, block_height, timestamp, tx_ids, coinbase_flags, addresses,
+                 in_offsets, in_address_ids, in_amounts, out_offsets, out_address_ids, out_amounts):
+        self.block_height = block_height
+        self.timestamp = timestamp
+        self.tx_ids = tx_ids
+        self.coinbase_flags = coinbase_flags
+        self.addresses = addresses
+        self.in_offsets = in_offsets
+        self.in_address_ids = in_address_ids
+        self.in_amounts = in_amounts
+        self.out_offsets = out_offsets
+        self.out_address_ids = out_address_ids
+        self.out_amounts = out_amounts
+
+    def __getstate__(self):
+        # a plain tuple, pickles without the slot names
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def __len__(self):
+        return len(self.coinbase_flags)
+
+    def iter_tx_ids(self):
+        tx_ids = self.tx_ids
+        if isinstance(tx_ids, bytes):
+            # one hex() over the block, slicing the string is cheaper than a hex() per id
+            hex_ids = tx_ids.hex()
+            return (hex_ids[i:i + 64] for i in range(0, len(hex_ids), 64))
+        return iter(tx_ids)
+
+    def iter_transactions(self):
+        addresses = self.addresses
+        in_offsets, in_amounts = self.in_offsets, self.in_amounts.tolist()
+        out_offsets, out_amounts = self.out_offsets, self.out_amounts.tolist()
+        # the (address, amount) pairs of the whole block are built once, every tx gets a slice of them
+        in_pairs = list(zip([addresses[address_id] for address_id in self.in_address_ids], in_amounts))
+        out_pairs = list(zip([addresses[address_id] for address_id in self.out_address_ids], out_amounts))
+        timestamp, block_height = self.timestamp, self.block_height
+
+        for i, (tx_id, is_coinbase) in enumerate(zip(self.iter_tx_ids(), self.coinbase_flags)):
+            in_start, in_end = in_offsets[i], in_offsets[i + 1]
+            out_start, out_end = out_offsets[i], out_offsets[i + 1]
+            yield (
+                tx_id,
+                in_pairs[in_start:in_end],
+                out_pairs[out_start:out_end],
+                sum(in_amounts[in_start:in_end]),
+                sum(out_amounts[out_start:out_end]),
+                timestamp,
+                block_height,
+                is_coinbase == 1,
+            )
+
+    def balance_changes(self):
+        # netted per address id first, address strings are only looked up once per changed address
+        deltas = [0] * len(self.addresses)
+        for address_id, amount in zip(self.in_address_ids, self.in_amounts):
+            deltas[address_id] -= amount
+        for address_id, amount in zip(self.out_address_ids, self.out_amounts):
+            deltas[address_id] += amount
+        return dict(zip(self.addresses, deltas))
+
+    def to_deal_data(self):
+        return {
+            tx_id: {
+                'in_amount_by_address': dict(inputs),
+                'out_amount_by_address': dict(outputs),
+                'input_addresses': [address for address, _ in inputs],
+                'output_addresses': [address for address, _ in outputs],
+                'in_total_amount': in_total_amount,
+                'out_total_amount': out_total_amount,
+                'tx_info': {
+                    "timestamp": timestamp,
+                    "block_height": block_height,
+                    "is_coinbase": is_coinbase,
+                }
+            }
+            for tx_id, inputs, outputs, in_total_amount, out_total_amount, timestamp, block_height, is_coinbase in self.iter_transactions()
+        }
+
+
+def encode_deal_data(deal_data):
+    """Encodes one block's deal data dict, raises ValueError for data the encoding cannot hold."""
+    block_height = timestamp = None
+    address_ids = {}
+    coinbase_flags = bytearray()
+    in_offsets, in_address_ids, in_amounts = array.array('I', [0]), array.array('I'), array.array('q')
+    out_offsets, out_address_ids, out_amounts = array.array('I', [0]), array.array('I'), array.array('q')
+
+    for tx_id, value in deal_data.items():
+        tx_info = value['tx_info']
+        if not coinbase_flags:
+            block_height, timestamp = tx_info['block_height'], tx_info['timestamp']
+        elif tx_info['block_height'] != block_height or tx_info['timestamp'] != timestamp:
+            raise ValueError(f"Deal data of {tx_id} is not from the block of the other transactions")
+        coinbase_flags.append(1 if tx_info['is_coinbase'] else 0)
+
+        for addresses, amount_by_address, total_amount, offsets, tx_address_ids, amounts in (
+                (value['input_addresses'], value['in_amount_by_address'], value['in_total_amount'], in_offsets, in_address_ids, in_amounts),
+                (value['output_addresses'], value['out_amount_by_address'], value['out_total_amount'], out_offsets, out_address_ids, out_amounts)):
+            tx_total_amount = 0
+            for address in addresses:
+                address_id = address_ids.get(address)
+                if address_id is None:
+                    address_id = address_ids[address] = len(address_ids)
+                amount = amount_by_address[address]
+                tx_address_ids.append(address_id)
+                amounts.append(amount)
+                tx_total_amount += amount
+            if tx_total_amount != total_amount:
+                raise ValueError(f"Deal data of {tx_id} has a total that is not the sum of its non-zero amounts")
+            offsets.append(len(tx_address_ids))
+
+    tx_ids = list(deal_data)
+    if all(isinstance(tx_id, str) and _TX_ID_PATTERN.fullmatch(tx_id) for tx_id in tx_ids):
+        tx_ids = bytes.fromhex("".join(tx_ids))
+    else:
+        tx_ids = tuple(tx_ids)
+
+    return EncodedBlock(
+        block_height, timestamp, tx_ids, bytes(coinbase_flags), tuple(address_ids),
+        in_offsets, in_address_ids, in_amounts, out_offsets, out_address_ids, out_amounts,
+    )
+
+
+def iter_deal_transactions(deal_data):
+    """The transaction tuples of deal data in either layout, a list of them is passed through as it is."""
+    if isinstance(deal_data, EncodedBlock):
+        return deal_data.iter_transactions()
+    if isinstance(deal_data, list):
+        return deal_data
+    return _iter_dict_transactions(deal_data)
+
+
+def _iter_dict_transactions(deal_data):
+    for tx_id, value in deal_data.items():
+        in_amount_by_address = value['in_amount_by_address']
+        out_amount_by_address = value['out_amount_by_address']
+        tx_info = value['tx_info']
+        yield (
+            tx_id,
+            [(address, in_amount_by_address[address]) for address in value['input_addresses']],
+            [(address, out_amount_by_address[address]) for address in value['output_addresses']],
+            value['in_total_amount'],
+            value['out_total_amount'],
+            tx_info['timestamp'],
+            tx_info['block_height'],
+            tx_info['is_coinbase'],
+        )
@@ -1,6 +1,5 @@
 from decimal import Decimal
 from bitcoinrpc.authproxy import AuthServiceProxy
-from loguru import logger
 
 from .abstract_node import Node
 from .node_utils import (
@@ -8,15 +7,25 @@ from .node_utils import (
     construct_redeem_script,
     hash_redeem_script,
     create_p2sh_address,
+    parse_block_data,
     Transaction, SATOSHI, VOUT, VIN
 )
+from setup_logger import setup_logger
 from setup_logger import logger_extra_data
+from setup_logger import AggregatedLog
+from metrics import time_rpc, vout_rpc_fallbacks, vout_table_hits
+from profiling import span
 
-from .node_utils import initialize_tx_out_hash_table, get_tx_out_hash_table_sub_keys
+from .node_utils import initialize_tx_out_hash_table
+from .table_loader import load_pickles, chain_tables, chain_tx_out_hash_tables
 
-import pickle
 import time
 import os
+import concurrent.futures
+
+logger = setup_logger("BitcoinNode")
+# table misses come in bursts past the pickles' height, one line per interval instead of one per input
+tx_out_miss_log = AggregatedLog(logger, "No entry is found in tx_out hash table")
 
 
 class BitcoinNode(Node):
@@ -29,18 +38,16 @@ class BitcoinNode(Node):
         pickle_files2 = []
         if pickle_files_env2:
             pickle_files_env = None
-            pickle_files2 = pickle_files_env2.split(',')
+            pickle_files2 = [pickle_file for pickle_file in pickle_files_env2.split(',') if pickle_file]
 
-        for pickle_file in pickle_files2:
-            if pickle_file:
-                self.load_tx_out_hash_table2(pickle_file)
+        if pickle_files2:
+            self.load_tx_deal_tables(pickle_files2)
 
         if pickle_files_env:
-            pickle_files = pickle_files_env.split(',')
+            pickle_files = [pickle_file for pickle_file in pickle_files_env.split(',') if pickle_file]
 
-        for pickle_file in pickle_files:
-            if pickle_file:
-                self.load_tx_out_hash_table(pickle_file)
+        if pickle_files:
+            self.load_tx_out_hash_tables(pickle_files)
 
 
         if node_rpc_url is None:
@@ -51,63 +58,105 @@ class BitcoinNode(Node):
         else:
             self.node_rpc_url = node_rpc_url
 
+        # concurrent getrawtransaction calls for the inputs of a block the tx_out tables do not cover
+        self.rpc_fallback_workers = int(os.environ.get("BITCOIN_RPC_FALLBACK_WORKERS") or 16)
+
+        # build deal data from the node for blocks the deal pickles do not cover (e.g. near the tip)
+        self.deal_data_fallback_to_rpc = (os.environ.get("BITCOIN_DEAL_DATA_FALLBACK_TO_RPC") or "0") == "1"
+
+    def load_tx_out_hash_tables(self, pickle_paths, reset: bool = False):
+        # the files stay separate behind chained lookups instead of being merged into one copy
+        tables = load_pickles(pickle_paths, "tx_out hash table")
+        if not reset:
+            tables.insert(0, self.tx_out_hash_table)
+        self.tx_out_hash_table = chain_tx_out_hash_tables(tables)
+
     def load_tx_out_hash_table(self, pickle_path: str, reset: bool = False):
-        # logger.info(f"Loading tx_out hash table", extra=logger_extra_data(pickle_path=pickle_path))
-        logger.info(f"Loading tx_out hash table {pickle_path}")
-        with open(pickle_path, 'rb') as file:
-            start_time = time.time()
-            hash_table = pickle.load(file)
-            if reset:
-                self.tx_out_hash_table = hash_table
-            else:
-                sub_keys = get_tx_out_hash_table_sub_keys()
-                for sub_key in sub_keys:
-                    self.tx_out_hash_table[sub_key].update(hash_table[sub_key])
-            end_time = time.time()
-            logger.info(f"Successfully loaded tx_out hash table {pickle_path}, cost: {end_time - start_time}")
-            # logger.info(f"Successfully loaded tx_out hash table",
-            #             extra=logger_extra_data(pickle_path=pickle_path, duration=f"{end_time - start_time}"))
+        self.load_tx_out_hash_tables([pickle_path], reset)
+
+    def load_tx_deal_tables(self, pickle_paths):
+        tables = load_pickles(pickle_paths, "tx deal table")
+        self.tx_deal_table = chain_tables([self.tx_deal_table] + tables)
+        logger.info(f"Loaded tx deal tables", extra=logger_extra_data(num_blocks=len(self.tx_deal_table)))
 
     def load_tx_out_hash_table2(self, pickle_path: str):
-        logger.info(f"Loading tx_out hash table2 {pickle_path}")
-        with open(pickle_path, 'rb') as file:
-            start_time = time.time()
-            hash_table = pickle.load(file)
-            self.tx_deal_table.update(hash_table)
-            end_time = time.time()
-            deal_len = len(self.tx_deal_table)
-            logger.info(f"Successfully load2 {pickle_path}, now len {deal_len} cost: {end_time - start_time}")
+        self.load_tx_deal_tables([pickle_path])
 
     def get_current_block_height(self):
         rpc_connection = AuthServiceProxy(self.node_rpc_url)
         try:
-            return rpc_connection.getblockcount()
+            with time_rpc("getblockcount"):
+                return rpc_connection.getblockcount()
         except Exception as e:
-            logger.error(f"RPC Provider with Error",
-                         error={'exception_type': e.__class__.__name__, 'exception_message': str(e),
-                                'exception_args': e.args})
+            logger.error(f"RPC Provider with Error", extra=logger_extra_data(
+                error={'exception_type': e.__class__.__name__, 'exception_message': str(e),
+                       'exception_args': e.args}))
         finally:
             rpc_connection._AuthServiceProxy__conn.close()  # Close the connection
 
     def get_block_by_height(self, block_height):
         rpc_connection = AuthServiceProxy(self.node_rpc_url)
         try:
-            block_hash = rpc_connection.getblockhash(block_height)
-            return rpc_connection.getblock(block_hash, 2)
+            with time_rpc("getblockhash"):
+                block_hash = rpc_connection.getblockhash(block_height)
+            with time_rpc("getblock"):
+                return rpc_connection.getblock(block_hash, 2)
         except Exception as e:
-            logger.error(f"RPC Provider with Error",
-                         error={'exception_type': e.__class__.__name__, 'exception_message': str(e),
-                                'exception_args': e.args})
+            logger.error(f"RPC Provider with Error", extra=logger_extra_data(
+                error={'exception_type': e.__class__.__name__, 'exception_message': str(e),
+                       'exception_args': e.args}))
         finally:
             rpc_connection._AuthServiceProxy__conn.close()  # Close the connection
 
+    def get_block_hash(self, block_height):
+        rpc_connection = AuthServiceProxy(self.node_rpc_url)
+        try:
+            with time_rpc("getblockhash"):
+                return rpc_connection.getblockhash(block_height)
+        except Exception as e:
+            logger.error(f"RPC Provider with Error", extra=logger_extra_data(
+                error={'exception_type': e.__class__.__name__, 'exception_message': str(e),
+                       'exception_args': e.args}))
+        finally:
+            rpc_connection._AuthServiceProxy__conn.close()  # Close the connection
+
+    def get_block_by_hash(self, block_hash):
+        rpc_connection = AuthServiceProxy(self.node_rpc_url)
+        try:
+            with time_rpc("getblock"):
+                return rpc_connection.getblock(block_hash, 2)
+        except Exception as e:
+            logger.error(f"RPC Provider with Error", extra=logger_extra_data(
+                error={'exception_type': e.__class__.__name__, 'exception_message': str(e),
+                       'exception_args': e.args}))
+        finally:
+            rpc_connection._AuthServiceProxy__conn.close()  # Close the connection
+
+    def find_reorg_height(self, get_indexed_block_hash, block_height, max_depth=100):
+        # Walks down from block_height while the recorded hash differs from the node's chain and
+        # returns the lowest diverged height, or None when block_height is still on the chain.
+        # Heights indexed without a recorded hash stop the walk.
+        reorg_height = None
+        for height in range(block_height, max(block_height - max_depth, 0), -1):
+            indexed_block_hash = get_indexed_block_hash(height)
+            if indexed_block_hash is None:
+                break
+            block_hash = self.get_block_hash(height)
+            if block_hash is None or block_hash == indexed_block_hash:
+                break
+            reorg_height = height
+        return reorg_height
+
     def get_address_and_amount_by_txn_id_and_vout_id(self, txn_id: str, vout_id: str):
-        # call rpc if not in hash table
-        if (txn_id, vout_id) not in self.tx_out_hash_table[txn_id[:3]]:
-            logger.info(f"No entry is found in tx_out hash table: (tx_id, vout_id): ({txn_id}, {vout_id})")
+        # call rpc if not in hash table, a single lookup even where the sub-table chains several files
+        entry = self.tx_out_hash_table[txn_id[:3]].get((txn_id, vout_id))
+        if entry is None:
+            tx_out_miss_log.record(tx_id=txn_id, vout_id=vout_id)
+            vout_rpc_fallbacks.inc()
             rpc_connection = AuthServiceProxy(self.node_rpc_url)
             try:
-                txn_data = rpc_connection.getrawtransaction(str(txn_id), 1)
+                with time_rpc("getrawtransaction"):
+                    txn_data = rpc_connection.getrawtransaction(str(txn_id), 1)
                 vout = next((x for x in txn_data['vout'] if str(x['n']) == vout_id), None)
                 amount = int(vout['value'] * 100000000)
                 address = vout["scriptPubKey"].get("address", "")
@@ -134,13 +183,31 @@ class BitcoinNode(Node):
             finally:
                 rpc_connection._AuthServiceProxy__conn.close()  # Close the connection
         else:  # get from hash table if exists
-            address, amount = self.tx_out_hash_table[txn_id[:3]][(txn_id, vout_id)]
+            vout_table_hits.inc()
+            address, amount = entry
             return address, int(amount)
 
+    def get_addresses_and_amounts_by_outpoints(self, outpoints):
+        # one pass over the table for a whole block, only the misses go through the rpc fallback one by one
+        tx_out_hash_table = self.tx_out_hash_table
+        entries = [tx_out_hash_table[txn_id[:3]].get((txn_id, vout_id)) for txn_id, vout_id in outpoints]
+        misses = [i for i, entry in enumerate(entries) if entry is None] if None in entries else []
+        if len(misses) == 1:
+            entries[misses[0]] = self.get_address_and_amount_by_txn_id_and_vout_id(*outpoints[misses[0]])
+        elif misses:
+            # past the table's height every input is a miss, their rpc calls wait on the node side by side
+            with concurrent.futures.ThreadPoolExecutor(min(len(misses), self.rpc_fallback_workers)) as executor:
+                resolved = executor.map(lambda i: self.get_address_and_amount_by_txn_id_and_vout_id(*outpoints[i]), misses)
+                for i, entry in zip(misses, resolved):
+                    entries[i] = entry
+        vout_table_hits.inc(len(entries) - len(misses))
+        return [(address, int(amount)) for address, amount in entries]
+
     def get_txn_data_by_id(self, txn_id: str):
         try:
             rpc_connection = AuthServiceProxy(self.node_rpc_url)
-            return rpc_connection.getrawtransaction(txn_id, 1)
+            with time_rpc("getrawtransaction"):
+                return rpc_connection.getrawtransaction(txn_id, 1)
         except Exception as e:
             return None
 
@@ -203,6 +270,7 @@ class BitcoinNode(Node):
 
         return tx
 
+    @span("process_in_memory_txn_for_indexing")
     def process_in_memory_txn_for_indexing(self, tx):
         input_amounts = {}  # input amounts by address in satoshi
         output_amounts = {}  # output amounts by address in satoshi
@@ -239,8 +307,105 @@ class BitcoinNode(Node):
 
         return input_amounts, output_amounts, input_addresses, output_addresses, in_total_amount, out_total_amount
 
-    def get_deal_data_by_block(self, block_height):
-        if block_height not in self.tx_deal_table:
-            logger.error(f"get_deal_data_by_block fail by {block_height}")
-            return None
-        return self.tx_deal_table[block_height]
+    @span("process_in_memory_block_for_indexing")
+    def process_in_memory_block_for_indexing(self, block_data):
+        """process_in_memory_txn_for_indexing of every tx of a parsed block, in block order.
+
+        The vins and vouts of the block are flattened into (address, amount) columns with per-tx offsets, the
+        prevouts are resolved in one batch and each tx's slice is grouped by address. Only a tx with an address
+        repeated on one side is summed up address by address.
+        """
+        transactions = block_data.transactions
+        outpoints = []
+        in_offsets = [0]
+        out_pairs = []
+        out_offsets = [0]
+        for tx in transactions:
+            outpoints += [(vin.tx_id, str(vin.vout_id)) for vin in tx.vins if vin.tx_id != 0]
+            in_offsets.append(len(outpoints))
+            unknown_address = f"unknown-{tx.tx_id}"
+            out_pairs += [(vout.address or unknown_address, vout.value_satoshi) for vout in tx.vouts]
+            out_offsets.append(len(out_pairs))
+
+        resolved = self.get_addresses_and_amounts_by_outpoints(outpoints)
+
+        results = []
+        for in_start, in_end, out_start, out_end in zip(in_offsets, in_offsets[1:], out_offsets, out_offsets[1:]):
+            # a tx without a repeated address on a side is grouped by building its dict, the rest is summed up
+            in_pairs = resolved[in_start:in_end]
+            input_amounts = dict(in_pairs)
+            if len(input_amounts) != in_end - in_start:
+                input_amounts = _group_amounts(in_pairs)
+            out_pairs_of_tx = out_pairs[out_start:out_end]
+            output_amounts = dict(out_pairs_of_tx)
+            if len(output_amounts) != out_end - out_start:
+                output_amounts = _group_amounts(out_pairs_of_tx)
+
+            if not input_amounts.keys().isdisjoint(output_amounts.keys()):
+                for address in input_amounts:
+                    if address in output_amounts:
+                        diff = input_amounts[address] - output_amounts[address]
+                        if diff > 0:
+                            input_amounts[address] = diff
+                            output_amounts[address] = 0
+                        elif diff < 0:
+                            output_amounts[address] = -diff
+                            input_amounts[address] = 0
+                        else:
+                            input_amounts[address] = 0
+                            output_amounts[address] = 0
+
+            input_values = input_amounts.values()
+            output_values = output_amounts.values()
+            results.append((
+                input_amounts,
+                output_amounts,
+                [address for address, amount in input_amounts.items() if amount != 0] if 0 in input_values else list(input_amounts),
+                [address for address, amount in output_amounts.items() if amount != 0] if 0 in output_values else list(output_amounts),
+                sum(input_values),
+                sum(output_values),
+            ))
+        return results
+
+    def create_deal_data(self, block_data):
+        deal_data = {}
+        for tx, (in_amount_by_address, out_amount_by_address, input_addresses, output_addresses, in_total_amount, out_total_amount) in zip(
+                block_data.transactions, self.process_in_memory_block_for_indexing(block_data)):
+            deal_data[tx.tx_id] = {
+                'in_amount_by_address': in_amount_by_address,
+                'out_amount_by_address': out_amount_by_address,
+                'input_addresses': input_addresses,
+                'output_addresses': output_addresses,
+                'in_total_amount': in_total_amount,
+                'out_total_amount': out_total_amount,
+                'tx_info': {
+                    "timestamp": tx.timestamp,
+                    "block_height": tx.block_height,
+                    "is_coinbase": tx.is_coinbase,
+                }
+            }
+        return deal_data
+
+    def get_deal_data_by_block(self, block_height, block_hash=None):
+        deal_data = self.tx_deal_table.get(block_height)
+        if deal_data is not None:
+            return deal_data
+
+        if self.deal_data_fallback_to_rpc:
+            if block_hash is None:
+                block = self.get_block_by_height(block_height)
+            else:
+                block = self.get_block_by_hash(block_hash)
+            if block is not None:
+                return self.create_deal_data(parse_block_data(block))
+
+        logger.error(f"get_deal_data_by_block failed", extra=logger_extra_data(block_height=block_height))
+        return None
+
+
+def _group_amounts(pairs):
+    # amounts by address in first-seen order, as summing them one by one would give
+    amounts = dict.fromkeys([address for address, _ in pairs], 0)
+    for address, amount in pairs:
+        amounts[address] += amount
+    return amounts
@@ -4,6 +4,8 @@ from dataclasses import dataclass, field
 from typing import List, Optional
 from decimal import Decimal, getcontext
 
+from profiling import span
+
 
 def pubkey_to_address(pubkey: str) -> str:
     # Step 1: SHA-256 hashing on the public key
@@ -101,6 +103,7 @@ getcontext().prec = 28
 SATOSHI = Decimal("100000000")
 
 
+@span("parse_block_data")
 def parse_block_data(block_data):
     block_height = block_data["height"]
     block_hash = block_data["hash"]
@@ -0,0 +1,303 @@
+import concurrent.futures
+import multiprocessing
+import queue
+import threading
+import time
+from collections import deque
+
+from setup_logger import setup_logger
+from setup_logger import logger_extra_data
+from metrics import block_stage_seconds, queue_depth
+
+logger = setup_logger("Pipeline")
+
+# yielded by a source to wait until everything handed out so far is committed
+FLUSH = object()
+_END = object()
+
+
+class StopPipeline(Exception):
+    """Raised by a stage or the sink to end the run at this item, items before it are still committed."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class Stage:
+    # workers=0 runs the stage inline in the sink's thread, mode="process" runs it in a forked process pool
+    def __init__(self, name: str, fn, workers: int = 1, mode: str = "thread", initializer=None):
+        if mode not in ("thread", "process"):
+            raise ValueError(f"Unknown stage mode: {mode}")
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.mode = mode
+        # called once in every forked process of a process stage
+        self.initializer = initializer
+
+
+class _Item:
+    __slots__ = ("seq", "value", "dropped")
+
+    def __init__(self, seq, value):
+        self.seq = seq
+        self.value = value
+        self.dropped = False
+
+
+class Pipeline:
+    """Source -> stages -> sink over bounded queues.
+
+    A stage returning None drops the item. The sink runs in the thread calling run(), in source
+    order when ordered=True. stop() or stop_condition ends the run; with drain=True the items
+    already in flight are still committed, otherwise they are dropped. At most queue_size plus the
+    stages' workers items are between the source and the sink at a time.
+    """
+
+    def __init__(self, name: str, stages, sink, ordered: bool = True, queue_size: int = 4, drain: bool = True,
+                 stop_condition=None, sink_name: str = "write"):
+        self.name = name
+        self.stages = list(stages)
+        self.sink = sink
+        self.sink_name = sink_name
+        self.ordered = ordered
+        self.queue_size = max(queue_size, 1)
+        self.drain = drain
+        self.stop_condition = stop_condition
+
+        self._stop_event = threading.Event()
+        self._lock = threading.Condition()
+        self._stop_seq = None
+        self._end_reason = None
+        self._submitted = 0
+        self._finished = 0
+        # set in run() from the stages' workers, bounds the items between the source and the sink
+        self._in_flight = None
+
+    def stop(self):
+        # safe to call from a signal handler, it only sets an event
+        self._stop_event.set()
+
+    def is_stopping(self):
+        if not self._stop_event.is_set() and self.stop_condition is not None and self.stop_condition():
+            self._stop_event.set()
+        return self._stop_event.is_set()
+
+    def _end_at(self, seq, reason):
+        with self._lock:
+            if self._stop_seq is None or seq < self._stop_seq:
+                self._stop_seq = seq
+                self._end_reason = reason
+        self._stop_event.set()
+
+    def _skip(self, item):
+        # items past an end point or abandoned on a stop without drain are passed on without work
+        if item.dropped:
+            return True
+        stop_seq = self._stop_seq
+        if stop_seq is not None and item.seq >= stop_seq:
+            return True
+        return self._stop_event.is_set() and not self.drain
+
+    def _apply(self, stage, item):
+        if self._skip(item):
+            item.dropped = True
+            return item
+        start_time = time.perf_counter()
+        try:
+            item.value = stage.fn(item.value)
+        except StopPipeline as e:
+            self._end_at(item.seq, e.reason)
+            item.dropped = True
+            return item
+        except Exception as e:
+            logger.error(f"Pipeline stage failed", extra=logger_extra_data(
+                pipeline=self.name, stage=stage.name, error={'exception_type': e.__class__.__name__, 'exception_message': str(e), 'exception_args': e.args}))
+            self._end_at(item.seq, f"{stage.name}_error")
+            item.dropped = True
+            return item
+        block_stage_seconds.observe(time.perf_counter() - start_time, indexer=self.name, stage=stage.name)
+        if item.value is None:
+            item.dropped = True
+        return item
+
+    def _put(self, output_queue, item):
+        # a full queue never keeps a worker from seeing a stop without drain, the sink keeps consuming either way
+        while True:
+            try:
+                output_queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def _feed(self, source, output_queue):
+        seq = 0
+        try:
+            for value in source:
+                if self.is_stopping():
+                    break
+                if value is FLUSH:
+                    with self._lock:
+                        while self._finished < self._submitted and not self.is_stopping():
+                            self._lock.wait(timeout=1)
+                    continue
+                # an ordered sink holds later items until a slow one arrives, the source waits instead of reading ahead
+                while not self._in_flight.acquire(timeout=1):
+                    if self.is_stopping():
+                        return
+                with self._lock:
+                    self._submitted += 1
+                self._put(output_queue, _Item(seq, value))
+                seq += 1
+        except Exception as e:
+            logger.error(f"Pipeline source failed", extra=logger_extra_data(
+                pipeline=self.name, error={'exception_type': e.__class__.__name__, 'exception_message': str(e), 'exception_args': e.args}))
+            self._end_at(seq, "source_error")
+        finally:
+            self._put(output_queue, _END)
+
+    def _run_thread_stage(self, stage, input_queue, output_queue, remaining_workers):
+        while True:
+            item = input_queue.get()
+            if item is _END:
+                # hand the end marker on to sibling workers, the last one passes it downstream
+                with self._lock:
+                    remaining_workers[0] -= 1
+                    last_worker = remaining_workers[0] == 0
+                if last_worker:
+                    self._put(output_queue, _END)
+                else:
+                    input_queue.put(_END)
+                return
+            queue_depth.set(input_queue.qsize(), indexer=self.name, queue=stage.name)
+            self._put(output_queue, self._apply(stage, item))
+
+    def _run_process_stage(self, stage, input_queue, output_queue):
+        executor = concurrent.futures.ProcessPoolExecutor(
+            stage.workers, mp_context=multiprocessing.get_context("fork"), initializer=stage.initializer)
+        in_flight = deque()
+        try:
+            end = False
+            while not end or in_flight:
+                # keep every process busy with one queued item each, the rest waits in the bounded queue
+                while not end and len(in_flight) < stage.workers * 2:
+                    # only wait for input when nothing is in flight, finished items must not be held back
+                    try:
+                        item = input_queue.get(block=not in_flight)
+                    except queue.Empty:
+                        break
+                    if item is _END:
+                        end = True
+                        break
+                    queue_depth.set(input_queue.qsize(), indexer=self.name, queue=stage.name)
+                    if self._skip(item):
+                        item.dropped = True
+                        in_flight.append((item, None, None))
+                    else:
+                        in_flight.append((item, executor.submit(stage.fn, item.value), time.perf_counter()))
+
+                # results are handed on in submission order, unordered sinks lose nothing by it
+                if in_flight:
+                    item, future, start_time = in_flight.popleft()
+                    if future is not None:
+                        try:
+                            item.value = future.result()
+                            block_stage_seconds.observe(time.perf_counter() - start_time, indexer=self.name, stage=stage.name)
+                            if item.value is None:
+                                item.dropped = True
+                        except StopPipeline as e:
+                            self._end_at(item.seq, e.reason)
+                            item.dropped = True
+                        except Exception as e:
+                            logger.error(f"Pipeline stage failed", extra=logger_extra_data(
+                                pipeline=self.name, stage=stage.name, error={'exception_type': e.__class__.__name__, 'exception_message': str(e), 'exception_args': e.args}))
+                            self._end_at(item.seq, f"{stage.name}_error")
+                            item.dropped = True
+                    self._put(output_queue, item)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            self._put(output_queue, _END)
+
+    def _finish(self, item):
+        with self._lock:
+            self._finished += 1
+            self._lock.notify_all()
+        self._in_flight.release()
+
+    def _commit(self, item, inline_stages):
+        for stage in inline_stages:
+            item = self._apply(stage, item)
+        if not self._skip(item):
+            start_time = time.perf_counter()
+            try:
+                self.sink(item.value)
+            except StopPipeline as e:
+                self._end_at(item.seq, e.reason)
+            except Exception as e:
+                logger.error(f"Pipeline sink failed", extra=logger_extra_data(
+                    pipeline=self.name, error={'exception_type': e.__class__.__name__, 'exception_message': str(e), 'exception_args': e.args}))
+                self._end_at(item.seq, "sink_error")
+            else:
+                block_stage_seconds.observe(time.perf_counter() - start_time, indexer=self.name, stage=self.sink_name)
+        self._finish(item)
+
+    def run(self, source):
+        """Runs until the source is exhausted or the pipeline stops, returns the end reason or None."""
+        # stages from the first inline one on run in the sink's thread
+        threaded_stages = []
+        for stage in self.stages:
+            if stage.workers <= 0:
+                break
+            threaded_stages.append(stage)
+        inline_stages = self.stages[len(threaded_stages):]
+
+        # one queue's worth plus what the workers hold, a process stage keeps two items per process
+        max_in_flight = self.queue_size + sum(
+            stage.workers * 2 if stage.mode == "process" else stage.workers for stage in threaded_stages)
+        self._in_flight = threading.Semaphore(max_in_flight)
+
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(threaded_stages) + 1)]
+        threads = [threading.Thread(target=self._feed, args=(source, queues[0]), name=f"{self.name}-source", daemon=True)]
+        for i, stage in enumerate(threaded_stages):
+            if stage.mode == "process":
+                threads.append(threading.Thread(
+                    target=self._run_process_stage, args=(stage, queues[i], queues[i + 1]),
+                    name=f"{self.name}-{stage.name}", daemon=True))
+                continue
+            remaining_workers = [stage.workers]
+            for worker in range(stage.workers):
+                threads.append(threading.Thread(
+                    target=self._run_thread_stage, args=(stage, queues[i], queues[i + 1], remaining_workers),
+                    name=f"{self.name}-{stage.name}-{worker}", daemon=True))
+        for thread in threads:
+            thread.start()
+
+        sink_queue = queues[-1]
+        pending = {}
+        next_seq = 0
+        while True:
+            try:
+                item = sink_queue.get(timeout=1)
+            except queue.Empty:
+                # polls the stop condition, the source may be waiting on a flush or on the node
+                self.is_stopping()
+                continue
+            if item is _END:
+                break
+            queue_depth.set(sink_queue.qsize(), indexer=self.name, queue="sink")
+            if not self.ordered:
+                self._commit(item, inline_stages)
+                continue
+            pending[item.seq] = item
+            while next_seq in pending:
+                self._commit(pending.pop(next_seq), inline_stages)
+                next_seq += 1
+
+        for thread in threads:
+            thread.join()
+
+        if self._stop_event.is_set() and self._end_reason is None and self._finished < self._submitted:
+            logger.info(f"Pipeline stopped", extra=logger_extra_data(
+                pipeline=self.name, submitted=self._submitted, finished=self._finished))
+        return self._end_reason
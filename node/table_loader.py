@@ -0,0 +1,111 @@
+import gc
+import os
+import pickle
+import time
+import concurrent.futures
+from collections import ChainMap
+
+from setup_logger import setup_logger
+from setup_logger import logger_extra_data
+from .node_utils import get_tx_out_hash_table_sub_keys
+
+logger = setup_logger("TableLoader")
+
+PREFETCH_CHUNK_BYTES = 16 * 1024 * 1024
+
+_MISSING = object()
+
+
+class ChainedTable(ChainMap):
+    """Read-only lookups over per-file tables, the first map holding a key wins.
+
+    ChainMap looks a key up twice for get() and builds the union of all keys for len(), this does neither.
+    """
+
+    def __getitem__(self, key):
+        for mapping in self.maps:
+            value = mapping.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        for mapping in self.maps:
+            value = mapping.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+        return default
+
+    def __contains__(self, key):
+        for mapping in self.maps:
+            if key in mapping:
+                return True
+        return False
+
+    def __len__(self):
+        # the pickles cover disjoint heights, keys are not counted twice
+        return sum(len(mapping) for mapping in self.maps)
+
+
+def chain_tables(tables):
+    # later tables win, as they did when merged with update
+    tables = [table for table in reversed(tables) if table]
+    if not tables:
+        return {}
+    if len(tables) == 1:
+        return tables[0]
+    return ChainedTable(*tables)
+
+
+def chain_tx_out_hash_tables(tables):
+    # a sub-table only becomes a chain where more than one file has entries for it
+    return {
+        sub_key: chain_tables([table.get(sub_key) for table in tables])
+        for sub_key in get_tx_out_hash_table_sub_keys()
+    }
+
+
+def _prefetch(pickle_path):
+    # reading ahead into the page cache releases the GIL, unpickling the file later no longer waits on the disk
+    buffer = bytearray(PREFETCH_CHUNK_BYTES)
+    with open(pickle_path, 'rb', buffering=0) as file:
+        while file.readinto(buffer):
+            pass
+
+
+def load_pickles(pickle_paths, name: str, prefetch_workers: int = None):
+    """Unpickles the files one after another while threads read the next ones ahead, returns them in order."""
+    if prefetch_workers is None:
+        prefetch_workers = int(os.environ.get("BITCOIN_PICKLE_PREFETCH_WORKERS") or 4)
+
+    executor = None
+    prefetches = {}
+    if prefetch_workers > 0 and len(pickle_paths) > 1:
+        executor = concurrent.futures.ThreadPoolExecutor(prefetch_workers, thread_name_prefix="pickle-prefetch")
+        prefetches = {pickle_path: executor.submit(_prefetch, pickle_path) for pickle_path in pickle_paths[1:]}
+
+    tables = []
+    start_time = time.time()
+    # the tables are millions of containers, collections triggered while they are built only rescan them
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for pickle_path in pickle_paths:
+            prefetch = prefetches.get(pickle_path)
+            logger.info(f"Loading {name}", extra=logger_extra_data(
+                pickle_path=pickle_path, prefetched=prefetch.done() if prefetch is not None else False))
+            file_start_time = time.time()
+            with open(pickle_path, 'rb') as file:
+                tables.append(pickle.load(file))
+            logger.info(f"Successfully loaded {name}", extra=logger_extra_data(
+                pickle_path=pickle_path, size_bytes=os.path.getsize(pickle_path),
+                duration=f"{time.time() - file_start_time}"))
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    logger.info(f"Loaded {name} files", extra=logger_extra_data(
+        num_files=len(pickle_paths), duration=f"{time.time() - start_time}"))
+    return tables
@@ -0,0 +1,177 @@
+import cProfile
+import functools
+import io
+import os
+import pstats
+import signal
+import threading
+import time
+from contextlib import contextmanager
+
+from setup_logger import setup_logger
+from setup_logger import logger_extra_data
+from metrics import REGISTRY, Histogram
+
+logger = setup_logger("Profiling")
+
+function_seconds = REGISTRY.register(Histogram(
+    "function_seconds", "Time spent in instrumented hot functions, recorded while spans are enabled.", ("function",)))
+
+# checked on every call of a spanned function, flipped by SIGUSR2
+spans_enabled = (os.environ.get("PROFILE_SPANS") or "0") == "1"
+
+
+def set_spans_enabled(enabled: bool):
+    global spans_enabled
+    spans_enabled = enabled
+
+
+def span(name):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not spans_enabled:
+                return fn(*args, **kwargs)
+            start_time = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                function_seconds.observe(time.perf_counter() - start_time, function=name)
+        return wrapper
+    return decorator
+
+
+class BlockProfiler:
+    """cProfile capture of the next N blocks, stats of every thread that processed them merged into one dump."""
+
+    def __init__(self, name: str, output_dir: str = None, num_blocks: int = None, top_functions: int = None):
+        self.name = name
+
+        if output_dir is None:
+            self.output_dir = os.environ.get("PROFILE_OUTPUT_DIR") or "/tmp"
+        else:
+            self.output_dir = output_dir
+
+        if num_blocks is None:
+            self.num_blocks = int(os.environ.get("PROFILE_BLOCKS") or 100)
+        else:
+            self.num_blocks = num_blocks
+
+        if top_functions is None:
+            self.top_functions = int(os.environ.get("PROFILE_TOP_FUNCTIONS") or 50)
+        else:
+            self.top_functions = top_functions
+
+        self._lock = threading.Lock()
+        # set from signal handlers, which must not take the lock, and picked up by the next block
+        self._requested_blocks = 0
+        self._remaining_blocks = 0
+        self._profiles = {}
+        self._running = set()
+        self._start_time = None
+
+        start_blocks = int(os.environ.get("PROFILE_BLOCKS_ON_START") or 0)
+        if start_blocks > 0:
+            self.request_capture(start_blocks)
+
+    @property
+    def capturing(self):
+        return self._remaining_blocks > 0
+
+    def request_capture(self, num_blocks: int = None):
+        self._requested_blocks = num_blocks or self.num_blocks
+
+    def _start_requested_capture(self):
+        with self._lock:
+            num_blocks, self._requested_blocks = self._requested_blocks, 0
+            if not num_blocks:
+                return
+            if self._remaining_blocks > 0:
+                logger.info("Profile capture already running", extra=logger_extra_data(remaining_blocks=self._remaining_blocks))
+                return
+            self._remaining_blocks = num_blocks
+            self._profiles = {}
+            self._running = set()
+            self._start_time = time.time()
+        logger.info("Starting profile capture", extra=logger_extra_data(num_blocks=num_blocks))
+
+    @contextmanager
+    def block(self, count: bool = True):
+        # wraps the work of one block in the calling thread, count=False for stages that another thread counts
+        if self._requested_blocks:
+            self._start_requested_capture()
+        if not self._remaining_blocks:
+            yield
+            return
+
+        thread_id = threading.get_ident()
+        with self._lock:
+            nested = thread_id in self._running
+            if nested:
+                profile = None
+            else:
+                profile = self._profiles.get(thread_id)
+                if profile is None:
+                    profile = self._profiles[thread_id] = cProfile.Profile()
+                self._running.add(thread_id)
+
+        if profile is not None:
+            try:
+                profile.enable()
+            except ValueError:
+                # python 3.12+ allows a single active profiler per interpreter, one thread's covers the others
+                profile = None
+
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            finished_profiles = None
+            with self._lock:
+                if not nested:
+                    self._running.discard(thread_id)
+                if count and self._remaining_blocks > 0:
+                    self._remaining_blocks -= 1
+                    if self._remaining_blocks == 0:
+                        # profiles still inside a block are left out, their numbers are incomplete
+                        finished_profiles = [
+                            profile for profile_thread_id, profile in self._profiles.items()
+                            if profile_thread_id not in self._running
+                        ]
+                        self._profiles = {}
+            if finished_profiles:
+                self.dump(finished_profiles)
+
+    def dump(self, profiles):
+        base_path = os.path.join(self.output_dir, f"{self.name}-{os.getpid()}-{int(time.time())}")
+        try:
+            stats = pstats.Stats(*profiles)
+            stats.dump_stats(base_path + ".prof")
+
+            stats.stream = io.StringIO()
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top_functions)
+            with open(base_path + ".txt", "w") as file:
+                file.write(stats.stream.getvalue())
+        except Exception as e:
+            logger.error("Failed to write profile", extra=logger_extra_data(
+                path=base_path, error={'exception_type': e.__class__.__name__, 'exception_message': str(e), 'exception_args': e.args}))
+            return
+
+        logger.info("Profile capture written", extra=logger_extra_data(
+            path=base_path + ".prof", stats_path=base_path + ".txt", num_threads=len(profiles),
+            duration="{:.2f}".format(time.time() - self._start_time)))
+
+
+def install_signal_handlers(block_profiler: BlockProfiler):
+    # SIGUSR1 captures the next PROFILE_BLOCKS blocks, SIGUSR2 toggles the timing spans
+    signal.signal(signal.SIGUSR1, lambda signum, frame: block_profiler.request_capture())
+    signal.signal(signal.SIGUSR2, lambda signum, frame: set_spans_enabled(not spans_enabled))
+
+
+def setup_profiling(name: str):
+    # call after load_dotenv, so PROFILE_* settings from .env apply
+    set_spans_enabled((os.environ.get("PROFILE_SPANS") or "0") == "1")
+    block_profiler = BlockProfiler(name)
+    install_signal_handlers(block_profiler)
+    return block_profiler
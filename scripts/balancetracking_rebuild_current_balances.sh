@@ -0,0 +1,4 @@
+#!/bin/bash
+cd "$(dirname "$0")/../"
+export PYTHONPATH=$(pwd)
+python3 models/balance_tracking/utils/rebuild_current_balances.py
@@ -0,0 +1,4 @@
+#!/bin/bash
+cd "$(dirname "$0")/../"
+export PYTHONPATH=$(pwd)
+python3 models/funds_flow/utils/rebuild_address_summaries.py
@@ -1,36 +1,232 @@
+import atexit
 import logging
+import logging.handlers
 import json
+import os
+import queue
+import threading
 import time
+import weakref
+
+
+# built once, json.dumps with keyword arguments creates a new encoder per call
+_json_encoder = json.JSONEncoder(default=str)
+_encode_string = json.encoder.encode_basestring_ascii
 
 
 class CustomFormatter(logging.Formatter):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the timestamp prefix only changes once a second, the level part never
+        self._second = None
+        self._second_prefix = None
+        self._level_parts = {}
+
+    def _timestamp_prefix(self, record):
+        second = int(record.created)
+        if second != self._second:
+            ct = self.converter(record.created)
+            self._second_prefix = time.strftime(self.default_time_format, ct)
+            self._second = second
+        return self._second_prefix
+
     def format(self, record):
-        ct = self.converter(record.created)
-        s = time.strftime(self.default_time_format, ct)
+        s = self._timestamp_prefix(record)
         if self.default_msec_format:
             s = self.default_msec_format % (s, record.msecs)
-        config = {
-            'timestamp' : s,
-            'level' : record.levelname,
-            'message' : record.msg
-        }
-        if record.__dict__.get('extra_content'):
-            config.update(record.__dict__["extra_content"])
-        return json.dumps(config)
+
+        level_part = self._level_parts.get(record.levelname)
+        if level_part is None:
+            level_part = self._level_parts[record.levelname] = ', "level": ' + _encode_string(record.levelname)
+
+        # messages with args are only interpolated here, after the level check and off the caller's thread
+        message = record.getMessage() if record.args else record.msg
+        message = _encode_string(message) if isinstance(message, str) else _json_encoder.encode(message)
+        line = '{"timestamp": "' + s + '"' + level_part + ', "message": ' + message
+
+        extra_content = record.__dict__.get('extra_content')
+        if extra_content:
+            line += ', ' + _json_encoder.encode(extra_content)[1:-1]
+        if record.exc_info:
+            line += ', "exception": ' + _encode_string(self.formatException(record.exc_info))
+        return line + '}'
+
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    # hands the record over untouched, formatting happens on the listener thread
+    def prepare(self, record):
+        return record
+
+
+_stream_handler = None
+_queue_handler = None
+_queue_listener = None
+_handler_lock = threading.Lock()
+
+
+def _start_queue_listener():
+    global _queue_handler, _queue_listener
+    log_queue = queue.SimpleQueue()
+    _queue_listener = logging.handlers.QueueListener(log_queue, _stream_handler)
+    _queue_listener.start()
+    if _queue_handler is None:
+        _queue_handler = RecordQueueHandler(log_queue)
+        atexit.register(stop_queue_listener)
+        os.register_at_fork(after_in_child=_restart_queue_listener_in_child)
+    else:
+        _queue_handler.queue = log_queue
+
+
+def _restart_queue_listener_in_child():
+    # the listener thread does not survive a fork, records of forked workers would pile up unwritten
+    global _queue_listener
+    if _queue_listener is not None:
+        _queue_listener = None
+        _start_queue_listener()
+
+
+def stop_queue_listener():
+    # writes out the records still queued, after the counts aggregated logs still hold back
+    global _queue_listener
+    flush_aggregated_logs()
+    if _queue_listener is not None:
+        _queue_listener.stop()
+        _queue_listener = None
+
+
+def _get_handler():
+    global _stream_handler
+    with _handler_lock:
+        if _stream_handler is None:
+            _stream_handler = logging.StreamHandler()
+            _stream_handler.setFormatter(CustomFormatter())
+        if (os.environ.get("LOG_QUEUE") or "0") == "1" and _queue_listener is None:
+            _start_queue_listener()
+        return _queue_handler if _queue_listener is not None else _stream_handler
+
+
+_loggers = []
+_invalid_log_levels = set()
+
+
+def _get_log_level():
+    # LOG_LEVEL=info works as well as INFO, an unknown level falls back to DEBUG
+    level = (os.environ.get("LOG_LEVEL") or "").strip().upper()
+    if not level:
+        return logging.DEBUG, None
+    if level.isdigit():
+        return int(level), None
+    if isinstance(logging.getLevelName(level), int):
+        return level, None
+    return logging.DEBUG, level
 
 
 def setup_logger(name):
-    formatter = CustomFormatter()
-    handler = logging.StreamHandler()
-    handler.setFormatter(formatter)
+    # LOG_QUEUE=1 writes from a background thread, LOG_LEVEL gates records before any formatting
     logger = logging.getLogger(name)
-    logger.setLevel(logging.DEBUG)
-    logger.addHandler(handler)
+    level, invalid_level = _get_log_level()
+    logger.setLevel(level)
+    handler = _get_handler()
+    for other_handler in (_stream_handler, _queue_handler):
+        if other_handler is not handler and other_handler in logger.handlers:
+            logger.removeHandler(other_handler)
+    if handler not in logger.handlers:
+        logger.addHandler(handler)
+    if logger not in _loggers:
+        _loggers.append(logger)
+    if invalid_level is not None and invalid_level not in _invalid_log_levels:
+        _invalid_log_levels.add(invalid_level)
+        logger.warning(f"Invalid LOG_LEVEL {invalid_level!r}, using DEBUG")
     return logger
 
 
+def configure_logging():
+    # loggers are set up at import time, call this after load_dotenv to apply LOG_QUEUE and LOG_LEVEL from .env
+    for logger in list(_loggers):
+        setup_logger(logger.name)
+
+
 def logger_extra_data(**kwargs):
     extra = {}
     for key in kwargs:
         extra[key] = kwargs[key]
-    return {"extra_content" : extra}
\ No newline at end of file
+    return {"extra_content" : extra}
+
+
+_aggregated_logs = weakref.WeakSet()
+
+
+def flush_aggregated_logs():
+    for aggregated_log in list(_aggregated_logs):
+        aggregated_log.flush()
+
+
+def _reset_aggregated_logs_in_child():
+    # the flush timers do not survive a fork and the locks may have been held by another thread
+    for aggregated_log in list(_aggregated_logs):
+        aggregated_log._lock = threading.Lock()
+        aggregated_log._timer = None
+
+
+atexit.register(flush_aggregated_logs)
+os.register_at_fork(after_in_child=_reset_aggregated_logs_in_child)
+
+
+class AggregatedLog:
+    """Logs the first of a stream of repeated events at once, then at most one summary per interval.
+
+    A count still held back when the stream stops is logged once its interval closes, or at exit.
+    """
+
+    def __init__(self, logger, message: str, interval: float = None, level: int = logging.INFO):
+        self.logger = logger
+        self.message = message
+        self.level = level
+        # None reads LOG_AGGREGATE_INTERVAL when logging, instances are usually created at import time
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._count = 0
+        self._last_logged = None
+        # the latest suppressed event, logged with the held back count when the interval closes
+        self._sample = None
+        self._interval = None
+        self._timer = None
+        _aggregated_logs.add(self)
+
+    def record(self, **sample):
+        if not self.logger.isEnabledFor(self.level):
+            return
+        interval = self.interval if self.interval is not None else float(os.environ.get("LOG_AGGREGATE_INTERVAL") or 10)
+        now = time.monotonic()
+        with self._lock:
+            self._count += 1
+            if self._last_logged is not None and now - self._last_logged < interval:
+                self._sample = sample
+                self._interval = interval
+                if self._timer is None:
+                    # the tail of a burst is written when the interval closes, not only once another event arrives
+                    self._timer = threading.Timer(self._last_logged + interval - now, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+            count, self._count = self._count, 0
+            self._last_logged = now
+            self._cancel_timer()
+        self.logger.log(self.level, self.message, extra=logger_extra_data(count=count, interval=interval, **sample))
+
+    def flush(self):
+        # logs the count held back since the last line, called by the timer and at exit
+        with self._lock:
+            self._cancel_timer()
+            if not self._count:
+                return
+            count, self._count = self._count, 0
+            sample, self._sample = self._sample, None
+            interval = self._interval
+            self._last_logged = time.monotonic()
+        self.logger.log(self.level, self.message, extra=logger_extra_data(count=count, interval=interval, **sample))
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
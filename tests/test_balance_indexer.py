@@ -0,0 +1,102 @@
+import os
+import re
+import tempfile
+import unittest
+from datetime import datetime
+from unittest import mock
+
+from sqlalchemy import text
+
+from models.balance_tracking.balance_indexer import BalanceIndexer, copy_rows
+
+_COPY_ESCAPES = {"\\\\": "\\", "\\t": "\t", "\\n": "\n", "\\r": "\r"}
+
+
+class RecordingCursor:
+    def copy_expert(self, sql, file):
+        self.sql = sql
+        self.data = file.read()
+
+
+def parse_copy_text(data):
+    # PostgreSQL's text format: a raw newline ends a row, a raw tab ends a column
+    rows = []
+    for line in data.split("\n")[:-1]:
+        rows.append(tuple(
+            None if column == "\\N" else re.sub(r"\\.", lambda match: _COPY_ESCAPES[match.group()], column)
+            for column in line.split("\t")
+        ))
+    return rows
+
+
+class TestCopyRows(unittest.TestCase):
+    def test_escapes_control_characters(self):
+        rows = [
+            ("1abc", 1, -5, None),
+            ("tab\there", 2, 0, "2024-01-01 00:00:00"),
+            ("new\nline", 3, 7, None),
+            ("carriage\rreturn", 4, 8, None),
+            ("windows\r\nline", 5, 9, None),
+            ("back\\slash\\N", 6, 10, None),
+        ]
+        cursor = RecordingCursor()
+        copy_rows(cursor, "balance_changes", ["address", "block", "d_balance", "block_timestamp"], rows)
+        self.assertEqual(cursor.sql, "COPY balance_changes (address, block, d_balance, block_timestamp) FROM STDIN")
+        self.assertNotIn("\r", cursor.data)
+        self.assertEqual(cursor.data.count("\n"), len(rows))
+        self.assertEqual(
+            parse_copy_text(cursor.data),
+            [tuple(None if value is None else str(value) for value in row) for row in rows],
+        )
+
+    def test_no_rows(self):
+        cursor = RecordingCursor()
+        copy_rows(cursor, "blocks", ["block_height"], [])
+        self.assertEqual(cursor.data, "")
+
+
+def insert_rows_on_cursor(cursor, balance_rows, block_rows):
+    # stands in for the PostgreSQL statements, written on the DBAPI cursor like them
+    cursor.executemany(
+        "INSERT INTO balance_changes (address_id, block, d_balance, block_timestamp) VALUES (?, ?, ?, ?)",
+        [(address_id, block, d_balance, block_timestamp) for address_id, _, block, d_balance, block_timestamp in balance_rows],
+    )
+    cursor.executemany("INSERT INTO blocks (block_height, timestamp, block_hash) VALUES (?, ?, ?)", block_rows)
+    return []
+
+
+class TestWriteRowsWithCopy(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        with mock.patch.dict(os.environ, {"BALANCE_INDEXER_TOP_HOLDERS": "0"}):
+            self.balance_indexer = BalanceIndexer(f"sqlite:///{directory.name}/balances.db")
+        self.addCleanup(self.balance_indexer.close)
+
+    def count_rows(self):
+        with self.balance_indexer.engine.connect() as conn:
+            return (conn.execute(text("SELECT COUNT(*) FROM balance_changes")).scalar(),
+                    conn.execute(text("SELECT COUNT(*) FROM blocks")).scalar())
+
+    def test_commits_without_top_holders(self):
+        self.assertEqual(self.balance_indexer.top_holders_size, 0)
+        timestamp = datetime(2009, 1, 3)
+        with mock.patch.object(BalanceIndexer, "_copy_balance_rows", staticmethod(insert_rows_on_cursor)):
+            self.balance_indexer._write_rows_with_copy(
+                [(1, "addr1", 1, 50, timestamp), (2, "addr2", 1, -50, timestamp)], [(1, timestamp, "hash1")])
+        self.assertEqual(self.count_rows(), (2, 1))
+
+    def test_rolls_back_on_error(self):
+        def fail_after_insert(cursor, balance_rows, block_rows):
+            insert_rows_on_cursor(cursor, balance_rows, block_rows)
+            raise RuntimeError("upsert failed")
+
+        timestamp = datetime(2009, 1, 3)
+        with mock.patch.object(BalanceIndexer, "_copy_balance_rows", staticmethod(fail_after_insert)):
+            with self.assertRaises(RuntimeError):
+                self.balance_indexer._write_rows_with_copy([(1, "addr1", 1, 50, timestamp)], [(1, timestamp, "hash1")])
+        self.assertEqual(self.count_rows(), (0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import unittest
+from unittest import mock
+
+from models.balance_tracking import indexer
+from models.balance_tracking.indexer import find_block_height_gaps, gap_block_heights
+
+
+class TestFindBlockHeightGaps(unittest.TestCase):
+    def test_gaps_between_ranges(self):
+        ranges = [(1, 100), (102, 200), (250, 250), (300, 400)]
+        self.assertEqual(find_block_height_gaps(ranges), [(101, 101), (201, 249), (251, 299)])
+
+    def test_no_gaps(self):
+        self.assertEqual(find_block_height_gaps([]), [])
+        self.assertEqual(find_block_height_gaps([(1, 840000)]), [])
+
+    def test_only_between_ranges(self):
+        # heights below the first and above the last range are left to catch up and move forward
+        self.assertEqual(find_block_height_gaps([(10, 20), (30, 40)]), [(21, 29)])
+
+    def test_gap_block_heights(self):
+        self.assertEqual(list(gap_block_heights([(101, 101), (201, 203)])), [101, 201, 202, 203])
+
+    def test_gap_block_heights_stops_on_shutdown(self):
+        heights = gap_block_heights([(1, 10)])
+        self.assertEqual(next(heights), 1)
+        with mock.patch.object(indexer, "shutdown_flag", True):
+            self.assertEqual(list(heights), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
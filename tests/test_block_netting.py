@@ -0,0 +1,74 @@
+import random
+import unittest
+from unittest import mock
+
+from benchmarks.run_benchmarks import create_offline_node
+from benchmarks.synthetic_chain import SyntheticChain
+from node.node_utils import parse_block_data
+
+
+def mutate_block(block, bitcoin_node, rng):
+    # self transfers, repeated addresses, unknown addresses and zero amounts, which the chain alone rarely has
+    for tx in block.transactions:
+        input_addresses = [
+            bitcoin_node.tx_out_hash_table[vin.tx_id[:3]][(vin.tx_id, str(vin.vout_id))][0]
+            for vin in tx.vins if vin.tx_id != 0
+        ]
+        for vout in tx.vouts:
+            roll = rng.random()
+            if input_addresses and roll < 0.3:
+                vout.address = rng.choice(input_addresses)
+            elif roll < 0.4 and tx.vouts[0] is not vout:
+                vout.address = tx.vouts[0].address
+            elif roll < 0.45:
+                vout.address = ""
+            if rng.random() < 0.05:
+                vout.value_satoshi = 0
+        if tx.vins and tx.vins[0].tx_id != 0 and rng.random() < 0.2:
+            tx.vins.append(tx.vins[0])
+
+
+class TestBlockNetting(unittest.TestCase):
+    def assert_same_as_per_tx(self, bitcoin_node, block):
+        expected = [bitcoin_node.process_in_memory_txn_for_indexing(tx) for tx in block.transactions]
+        result = bitcoin_node.process_in_memory_block_for_indexing(block)
+        self.assertEqual(result, expected)
+        # the dicts keep the order the per-tx netting inserts the addresses in
+        for (in_amounts, out_amounts, *_), (expected_in_amounts, expected_out_amounts, *_) in zip(result, expected):
+            self.assertEqual(list(in_amounts), list(expected_in_amounts))
+            self.assertEqual(list(out_amounts), list(expected_out_amounts))
+
+    def test_matches_per_tx_netting(self):
+        for profile in ("early", "modern", "consolidation"):
+            for seed in range(3):
+                chain = SyntheticChain(3, profile=profile, seed=seed)
+                bitcoin_node = create_offline_node(chain)
+                for raw_block in chain.iter_blocks():
+                    self.assert_same_as_per_tx(bitcoin_node, parse_block_data(raw_block))
+
+    def test_matches_per_tx_netting_of_mutated_blocks(self):
+        rng = random.Random(0)
+        for profile in ("early", "modern", "consolidation"):
+            chain = SyntheticChain(3, profile=profile, seed=1)
+            bitcoin_node = create_offline_node(chain)
+            for raw_block in chain.iter_blocks():
+                block = parse_block_data(raw_block)
+                mutate_block(block, bitcoin_node, rng)
+                self.assert_same_as_per_tx(bitcoin_node, block)
+
+    def test_matches_per_tx_netting_with_table_misses(self):
+        chain = SyntheticChain(3, profile="modern", seed=2)
+        bitcoin_node = create_offline_node(chain)
+        rng = random.Random(1)
+        for sub_table in bitcoin_node.tx_out_hash_table.values():
+            for key in [key for key in sub_table if rng.random() < 0.2]:
+                del sub_table[key]
+        # the misses go to a node that fails every call, they resolve to an unknown address either way
+        with mock.patch("node.node.AuthServiceProxy") as rpc_connection:
+            rpc_connection.return_value.getrawtransaction.side_effect = ConnectionRefusedError
+            for raw_block in chain.iter_blocks():
+                self.assert_same_as_per_tx(bitcoin_node, parse_block_data(raw_block))
+
+
+if __name__ == '__main__':
+    unittest.main()
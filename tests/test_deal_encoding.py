@@ -0,0 +1,78 @@
+import copy
+import pickle
+import unittest
+
+from benchmarks.run_benchmarks import create_offline_node
+from benchmarks.synthetic_chain import SyntheticChain
+from models.balance_tracking.balance_indexer import aggregate_balance_changes
+from node.deal_encoding import encode_deal_data, iter_deal_transactions
+from node.node_utils import parse_block_data
+
+
+def iter_block_deal_data():
+    for profile in ("early", "modern", "consolidation"):
+        chain = SyntheticChain(3, profile=profile, seed=0)
+        bitcoin_node = create_offline_node(chain)
+        for raw_block in chain.iter_blocks():
+            block = parse_block_data(raw_block)
+            yield block.block_height, bitcoin_node.create_deal_data(block)
+
+
+def without_netted_zeros(deal_data):
+    # the encoding keeps the listed addresses only, netting leaves the others in the dicts with a zero amount
+    deal_data = copy.deepcopy(deal_data)
+    for value in deal_data.values():
+        for addresses, amount_by_address in ((value['input_addresses'], value['in_amount_by_address']),
+                                             (value['output_addresses'], value['out_amount_by_address'])):
+            for address in set(amount_by_address) - set(addresses):
+                assert amount_by_address.pop(address) == 0
+    return deal_data
+
+
+class TestDealEncoding(unittest.TestCase):
+    def test_round_trip(self):
+        for block_height, deal_data in iter_block_deal_data():
+            encoded = encode_deal_data(deal_data)
+            self.assertEqual(len(encoded), len(deal_data))
+            self.assertEqual(list(iter_deal_transactions(encoded)), list(iter_deal_transactions(deal_data)))
+            self.assertEqual(encoded.to_deal_data(), without_netted_zeros(deal_data))
+            self.assertEqual(pickle.loads(pickle.dumps(encoded)).to_deal_data(), without_netted_zeros(deal_data))
+
+    def test_non_hex_tx_ids(self):
+        for block_height, deal_data in iter_block_deal_data():
+            deal_data = {f"tx-{i}": value for i, value in enumerate(deal_data.values())}
+            encoded = encode_deal_data(deal_data)
+            self.assertIsInstance(encoded.tx_ids, tuple)
+            self.assertEqual(encoded.to_deal_data(), without_netted_zeros(deal_data))
+
+    def test_balance_rows_match_for_both_layouts(self):
+        for block_height, deal_data in iter_block_deal_data():
+            self.assertEqual(
+                aggregate_balance_changes(encode_deal_data(deal_data), block_height),
+                aggregate_balance_changes(deal_data, block_height),
+            )
+
+    def test_empty_block(self):
+        encoded = encode_deal_data({})
+        self.assertEqual(len(encoded), 0)
+        self.assertEqual(encoded.to_deal_data(), {})
+        self.assertEqual(aggregate_balance_changes(encoded, 1), ([], None))
+
+    def test_rejects_transactions_of_another_block(self):
+        block_height, deal_data = next(
+            (block_height, deal_data) for block_height, deal_data in iter_block_deal_data() if len(deal_data) > 1)
+        deal_data = copy.deepcopy(deal_data)
+        list(deal_data.values())[-1]['tx_info']['block_height'] += 1
+        with self.assertRaises(ValueError):
+            encode_deal_data(deal_data)
+
+    def test_rejects_total_that_is_not_the_sum(self):
+        block_height, deal_data = next(iter_block_deal_data())
+        deal_data = copy.deepcopy(deal_data)
+        list(deal_data.values())[0]['out_total_amount'] += 1
+        with self.assertRaises(ValueError):
+            encode_deal_data(deal_data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import threading
+import time
+import unittest
+
+from models.funds_flow.indexer import PriorityWriteGate, split_backfill_ranges
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError("condition not reached")
+        time.sleep(0.01)
+
+
+class TestSplitBackfillRanges(unittest.TestCase):
+    def assert_covers_down_to_1(self, start_height, num_workers):
+        ranges = split_backfill_ranges(start_height, num_workers)
+        self.assertLessEqual(len(ranges), num_workers)
+        heights = []
+        for backfill_range in ranges:
+            self.assertEqual(backfill_range["next"], backfill_range["high"])
+            self.assertLessEqual(backfill_range["low"], backfill_range["high"])
+            heights += range(backfill_range["high"], backfill_range["low"] - 1, -1)
+        # descending and disjoint, every height below the start exactly once
+        self.assertEqual(heights, list(range(start_height - 1, 0, -1)))
+
+    def test_disjoint_coverage(self):
+        for start_height in (2, 3, 10, 11, 100, 1001, 840000):
+            for num_workers in (1, 2, 3, 4, 7, 16):
+                with self.subTest(start_height=start_height, num_workers=num_workers):
+                    self.assert_covers_down_to_1(start_height, num_workers)
+
+    def test_more_workers_than_heights(self):
+        for start_height in (2, 3, 5):
+            with self.subTest(start_height=start_height):
+                self.assert_covers_down_to_1(start_height, 8)
+                self.assertEqual(len(split_backfill_ranges(start_height, 8)), start_height - 1)
+
+    def test_nothing_below_the_start(self):
+        self.assertEqual(split_backfill_ranges(1, 4), [])
+        self.assertEqual(split_backfill_ranges(0, 4), [])
+
+
+class TestPriorityWriteGate(unittest.TestCase):
+    def test_priority_waiter_goes_first(self):
+        gate = PriorityWriteGate()
+        order = []
+
+        def write(name, priority):
+            with gate.acquire(priority=priority):
+                order.append(name)
+
+        with gate.acquire():
+            waiters = [threading.Thread(target=write, args=(f"backfill-{i}", False)) for i in range(3)]
+            for waiter in waiters:
+                waiter.start()
+            priority_waiter = threading.Thread(target=write, args=("rollback", True))
+            priority_waiter.start()
+            wait_until(lambda: gate._priority_waiting == 1)
+        for thread in waiters + [priority_waiter]:
+            thread.join(5)
+        self.assertEqual(order[0], "rollback")
+        self.assertEqual(sorted(order[1:]), ["backfill-0", "backfill-1", "backfill-2"])
+
+    def test_capacity(self):
+        gate = PriorityWriteGate(capacity=2)
+        lock = threading.Lock()
+        active = [0, 0]
+
+        def write(priority):
+            with gate.acquire(priority=priority):
+                with lock:
+                    active[0] += 1
+                    active[1] = max(active[1], active[0])
+                time.sleep(0.01)
+                with lock:
+                    active[0] -= 1
+
+        threads = [threading.Thread(target=write, args=(i % 3 == 0,)) for i in range(12)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(active, [0, 2])
+
+    def test_released_on_exception(self):
+        gate = PriorityWriteGate()
+        with self.assertRaises(RuntimeError):
+            with gate.acquire(priority=True):
+                raise RuntimeError("write failed")
+        acquired = threading.Event()
+
+        def write():
+            with gate.acquire():
+                acquired.set()
+
+        threading.Thread(target=write).start()
+        self.assertTrue(acquired.wait(5))
+
+
+if __name__ == '__main__':
+    unittest.main()
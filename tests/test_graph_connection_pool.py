@@ -0,0 +1,60 @@
+import unittest
+from unittest import mock
+
+from models.funds_flow.graph_connection_pool import GraphConnectionPool
+
+
+class TestGraphConnectionPool(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch("models.funds_flow.graph_connection_pool.GraphDatabase")
+        self.graph_database = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.graph_database.driver.return_value.session.side_effect = self.new_session
+        self.pool = GraphConnectionPool("bolt://localhost:7687", "", "")
+
+    @staticmethod
+    def new_session():
+        session = mock.MagicMock()
+        session.__enter__.return_value = session
+        return session
+
+    def test_reuses_thread_session(self):
+        with self.pool.session() as first:
+            pass
+        with self.pool.session() as second:
+            pass
+        self.assertIs(first, second)
+        first.close.assert_not_called()
+
+    def test_discards_session_after_exception(self):
+        with self.assertRaises(RuntimeError):
+            with self.pool.session() as first:
+                raise RuntimeError("broken connection")
+        with self.pool.session() as second:
+            pass
+        self.assertIsNot(first, second)
+        first.close.assert_called_once()
+
+    def test_discards_invalidated_session(self):
+        with self.pool.session() as first:
+            # a caller that logs the failure and returns False
+            self.pool.invalidate_session(first)
+        with self.pool.session() as second:
+            pass
+        self.assertIsNot(first, second)
+        first.close.assert_called_once()
+        with self.pool.session() as third:
+            pass
+        self.assertIs(second, third)
+
+    def test_invalidating_nested_session_keeps_thread_session(self):
+        with self.pool.session() as outer:
+            with self.pool.session() as nested:
+                self.pool.invalidate_session(nested)
+        with self.pool.session() as again:
+            pass
+        self.assertIs(outer, again)
+
+
+if __name__ == '__main__':
+    unittest.main()
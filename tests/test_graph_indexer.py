@@ -1,6 +1,94 @@
 import unittest
 import os
-from models.funds_flow.graph_indexer import GraphIndexer
+from models.funds_flow.graph_indexer import GraphIndexer, aggregate_address_summaries, attribute_address_flows
+
+
+def tx(tx_id, inputs, outputs, block_height, is_coinbase=False):
+    # the transaction tuple iter_deal_transactions yields, a list of them is valid deal data
+    return (tx_id, inputs, outputs, sum(amount for _, amount in inputs), sum(amount for _, amount in outputs),
+            1231006505, block_height, is_coinbase)
+
+
+class TestAttributeAddressFlows(unittest.TestCase):
+    def test_pro_rata_integer_split(self):
+        deal_data = [
+            tx("coinbase", [], [("A", 50)], 10, is_coinbase=True),
+            # 1 satoshi of fee, each output is funded 3:7 and rounded down
+            tx("t1", [("A", 3), ("B", 7)], [("C", 5), ("D", 4)], 10),
+            tx("t2", [("A", 1)], [("C", 1)], 12),
+        ]
+        flows, skipped_txs = attribute_address_flows(deal_data)
+        self.assertEqual(skipped_txs, 0)
+        flows = {(flow["from_address"], flow["to_address"]): flow for flow in flows}
+        self.assertEqual(
+            {pair: flow["value_satoshi"] for pair, flow in flows.items()},
+            {("A", "C"): 1 + 1, ("A", "D"): 1, ("B", "C"): 3, ("B", "D"): 2},
+        )
+        self.assertEqual(flows[("A", "C")]["tx_count"], 2)
+        self.assertEqual((flows[("A", "C")]["first_block_height"], flows[("A", "C")]["last_block_height"]), (10, 12))
+        self.assertEqual((flows[("B", "D")]["first_block_height"], flows[("B", "D")]["last_block_height"]), (10, 10))
+
+    def test_flows_never_exceed_outputs(self):
+        deal_data = [tx("t1", [("A", 1), ("B", 1), ("C", 1)], [("D", 1), ("E", 1)], 1)]
+        flows, _ = attribute_address_flows(deal_data)
+        self.assertEqual(sum(flow["value_satoshi"] for flow in flows), 0)
+        self.assertEqual(len(flows), 6)
+
+    def test_skips_txs_with_too_many_pairs(self):
+        deal_data = [
+            tx("wide", [("A", 1), ("B", 1), ("C", 1)], [("D", 1), ("E", 1), ("F", 1), ("G", 1)], 1),
+            tx("narrow", [("A", 2)], [("D", 2)], 1),
+        ]
+        flows, skipped_txs = attribute_address_flows(deal_data, max_flow_pairs=10)
+        self.assertEqual(skipped_txs, 1)
+        self.assertEqual([(flow["from_address"], flow["to_address"], flow["value_satoshi"]) for flow in flows], [("A", "D", 2)])
+        flows, skipped_txs = attribute_address_flows(deal_data, max_flow_pairs=12)
+        self.assertEqual(skipped_txs, 0)
+        self.assertEqual(len(flows), 12)
+
+    def test_dict_layout(self):
+        deal_data = {
+            "t1": {
+                'in_amount_by_address': {"A": 3, "B": 7},
+                'out_amount_by_address': {"C": 10},
+                'input_addresses': ["A", "B"],
+                'output_addresses': ["C"],
+                'in_total_amount': 10,
+                'out_total_amount': 10,
+                'tx_info': {"timestamp": 1231006505, "block_height": 5, "is_coinbase": False},
+            }
+        }
+        flows, _ = attribute_address_flows(deal_data)
+        self.assertEqual({(flow["from_address"], flow["to_address"]): flow["value_satoshi"] for flow in flows},
+                         {("A", "C"): 3, ("B", "C"): 7})
+
+
+class TestAggregateAddressSummaries(unittest.TestCase):
+    def test_one_summary_per_address(self):
+        deal_data = [
+            tx("coinbase", [], [("A", 50)], 10, is_coinbase=True),
+            tx("t1", [("A", 50)], [("B", 30), ("C", 19)], 11),
+            tx("t2", [("B", 30)], [("A", 5), ("C", 25)], 13),
+            tx("t3", [("C", 44)], [("D", 44)], 12),
+        ]
+        summaries = {summary["address"]: summary for summary in aggregate_address_summaries(deal_data)}
+        self.assertEqual(summaries, {
+            "A": {"address": "A", "received": 55, "sent": 50, "tx_count": 3, "first_block_height": 10, "last_block_height": 13},
+            "B": {"address": "B", "received": 30, "sent": 30, "tx_count": 2, "first_block_height": 11, "last_block_height": 13},
+            "C": {"address": "C", "received": 44, "sent": 44, "tx_count": 3, "first_block_height": 11, "last_block_height": 13},
+            "D": {"address": "D", "received": 44, "sent": 0, "tx_count": 1, "first_block_height": 12, "last_block_height": 12},
+        })
+
+    def test_address_on_both_sides_counts_one_tx(self):
+        # netting leaves an address on one side, a hand built tx may still list it on both
+        summaries = aggregate_address_summaries([tx("t1", [("A", 10)], [("A", 4), ("B", 6)], 7)])
+        summaries = {summary["address"]: summary for summary in summaries}
+        self.assertEqual((summaries["A"]["tx_count"], summaries["A"]["sent"], summaries["A"]["received"]), (1, 10, 4))
+        self.assertEqual(summaries["B"]["tx_count"], 1)
+
+    def test_empty(self):
+        self.assertEqual(aggregate_address_summaries([]), [])
+        self.assertEqual(aggregate_address_summaries({}), [])
 
 
 class TestGraphIndexer(unittest.TestCase):
@@ -0,0 +1,51 @@
+import multiprocessing
+import unittest
+
+from metrics import Counter, Histogram, merge_metric_deltas, metric_deltas, snapshot_metrics
+
+
+def count_in_child(metrics, connection):
+    # stands in for a forked deal worker, its increments only reach the parent as deltas
+    counter, histogram = metrics
+    snapshots = snapshot_metrics(metrics)
+    counter.inc(method="getblock", status="ok")
+    counter.labels(method="getrawtransaction", status="ok").inc(3)
+    histogram.observe(0.02, method="getblock")
+    connection.send(metric_deltas(metrics, snapshots))
+    connection.close()
+
+
+class TestMetricDeltas(unittest.TestCase):
+    def setUp(self):
+        self.counter = Counter("rpc_calls_total", "RPC calls.", ("method", "status"))
+        self.histogram = Histogram("rpc_latency_seconds", "RPC latency.", ("method",), buckets=(0.01, 0.1))
+        self.metrics = (self.counter, self.histogram)
+
+    def test_only_increments_since_the_snapshot(self):
+        self.counter.inc(5, method="getblock", status="ok")
+        self.histogram.observe(0.5, method="getblock")
+        snapshots = snapshot_metrics(self.metrics)
+        self.counter.inc(method="getblock", status="ok")
+        self.counter.inc(method="getblock", status="error")
+        self.histogram.observe(0.0625, method="getblock")
+        counter_delta, histogram_delta = metric_deltas(self.metrics, snapshots)
+        self.assertEqual(counter_delta, {("getblock", "ok"): 1, ("getblock", "error"): 1})
+        self.assertEqual(histogram_delta, {("getblock",): [[0, 1, 0], 0.0625, 1]})
+        self.assertEqual(metric_deltas(self.metrics, snapshot_metrics(self.metrics)), [{}, {}])
+
+    def test_forked_worker_increments_reach_the_parent(self):
+        self.counter.inc(2, method="getblock", status="ok")
+        context = multiprocessing.get_context("fork")
+        parent_connection, child_connection = context.Pipe()
+        process = context.Process(target=count_in_child, args=(self.metrics, child_connection))
+        process.start()
+        deltas = parent_connection.recv()
+        process.join(5)
+        merge_metric_deltas(self.metrics, deltas)
+        self.assertEqual(self.counter.snapshot(), {("getblock", "ok"): 3, ("getrawtransaction", "ok"): 3})
+        self.assertEqual(self.histogram.snapshot(), {("getblock",): [[0, 1, 0], 0.02, 1]})
+        self.assertIn('rpc_calls_total{method="getrawtransaction",status="ok"} 3', self.counter.render())
+
+
+if __name__ == '__main__':
+    unittest.main()
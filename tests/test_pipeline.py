@@ -0,0 +1,142 @@
+import time
+import unittest
+
+from node.pipeline import FLUSH, Pipeline, Stage, StopPipeline
+
+
+def square(value):
+    return value * value
+
+
+class TestPipeline(unittest.TestCase):
+    def test_commits_in_source_order_with_several_workers(self):
+        committed = []
+
+        def jitter(value):
+            time.sleep(0.001 * (value % 3))
+            return value
+
+        pipeline = Pipeline("test", [Stage("jitter", jitter, workers=4)], committed.append, queue_size=2)
+        self.assertIsNone(pipeline.run(range(50)))
+        self.assertEqual(committed, list(range(50)))
+
+    def test_ordered_sink_bounds_items_behind_a_slow_one(self):
+        started = []
+        started_before_first_commit = []
+
+        def fetch(value):
+            started.append(value)
+            if value == 0:
+                time.sleep(0.5)
+            return value
+
+        def write(value):
+            if value == 0:
+                started_before_first_commit.append(len(started))
+
+        pipeline = Pipeline("test", [Stage("fetch", fetch, workers=4)], write, queue_size=2)
+        self.assertIsNone(pipeline.run(range(2000)))
+        self.assertEqual(len(started), 2000)
+        # queue_size plus one item per worker
+        self.assertLessEqual(started_before_first_commit[0], 6)
+
+    def test_stop_pipeline_commits_only_earlier_items(self):
+        committed = []
+
+        def fetch(value):
+            if value == 5:
+                raise StopPipeline("missing")
+            return value
+
+        pipeline = Pipeline("test", [Stage("fetch", fetch, workers=3)], committed.append, queue_size=2)
+        self.assertEqual(pipeline.run(range(20)), "missing")
+        self.assertEqual(committed, [0, 1, 2, 3, 4])
+
+    def test_stop_pipeline_from_sink_does_not_commit_the_item(self):
+        committed = []
+
+        def write(value):
+            if value == 3:
+                raise StopPipeline("shutdown")
+            committed.append(value)
+
+        pipeline = Pipeline("test", [Stage("fetch", lambda value: value, workers=2)], write)
+        self.assertEqual(pipeline.run(range(10)), "shutdown")
+        self.assertEqual(committed, [0, 1, 2])
+
+    def test_stage_error_ends_the_run(self):
+        def fetch(value):
+            if value == 2:
+                raise RuntimeError("boom")
+            return value
+
+        committed = []
+        pipeline = Pipeline("test", [Stage("fetch", fetch)], committed.append)
+        self.assertEqual(pipeline.run(range(5)), "fetch_error")
+        self.assertEqual(committed, [0, 1])
+
+    def test_none_drops_the_item(self):
+        committed = []
+        pipeline = Pipeline("test", [Stage("odd", lambda value: value if value % 2 else None, workers=0)], committed.append)
+        self.assertIsNone(pipeline.run(range(6)))
+        self.assertEqual(committed, [1, 3, 5])
+
+    def test_flush_waits_for_everything_handed_out(self):
+        committed = []
+        seen_at_flush = []
+
+        def source():
+            yield from range(10)
+            yield FLUSH
+            seen_at_flush.append(list(committed))
+            yield 10
+
+        pipeline = Pipeline("test", [Stage("fetch", lambda value: value, workers=3)], committed.append)
+        self.assertIsNone(pipeline.run(source()))
+        self.assertEqual(seen_at_flush, [list(range(10))])
+        self.assertEqual(committed, list(range(11)))
+
+    def test_stop_drains_items_in_flight(self):
+        committed = []
+        handed_out = []
+
+        def source():
+            for value in range(1000):
+                handed_out.append(value)
+                yield value
+
+        def write(value):
+            committed.append(value)
+            if value == 3:
+                pipeline.stop()
+            time.sleep(0.01)
+
+        pipeline = Pipeline("test", [Stage("fetch", lambda value: value, workers=2)], write, queue_size=2)
+        self.assertIsNone(pipeline.run(source()))
+        # the items queued behind the one that stopped it are still written, the source reads at most one more
+        self.assertGreater(len(committed), 4)
+        self.assertLess(len(committed), 1000)
+        self.assertEqual(committed, list(range(len(committed))))
+        self.assertIn(len(handed_out) - len(committed), (0, 1))
+
+    def test_stop_without_drain_drops_items_in_flight(self):
+        committed = []
+
+        def write(value):
+            committed.append(value)
+            if value == 0:
+                pipeline.stop()
+
+        pipeline = Pipeline("test", [Stage("fetch", lambda value: value, workers=2)], write, queue_size=4, drain=False)
+        self.assertIsNone(pipeline.run(range(1000)))
+        self.assertEqual(committed, [0])
+
+    def test_process_stage(self):
+        committed = []
+        pipeline = Pipeline("test", [Stage("square", square, workers=2, mode="process")], committed.append, queue_size=2)
+        self.assertIsNone(pipeline.run(range(20)))
+        self.assertEqual(committed, [value * value for value in range(20)])
+
+
+if __name__ == '__main__':
+    unittest.main()
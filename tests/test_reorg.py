@@ -0,0 +1,42 @@
+import unittest
+
+from models.reorg import RecentBlockHashes
+
+
+class FakeNode:
+    def __init__(self, tip_height):
+        self.tip_height = tip_height
+        self.block_hash_calls = []
+
+    def get_current_block_height(self):
+        return self.tip_height
+
+    def get_block_hash(self, block_height):
+        self.block_hash_calls.append(block_height)
+        return f"hash-{block_height}"
+
+
+class TestRecentBlockHashes(unittest.TestCase):
+    def test_only_fetches_hashes_within_reorg_depth_of_the_tip(self):
+        node = FakeNode(1000)
+        block_hashes = RecentBlockHashes(node, max_reorg_depth=100)
+        self.assertIsNone(block_hashes.get(900))
+        self.assertEqual(block_hashes.get(901), "hash-901")
+        self.assertEqual(block_hashes.get(1000), "hash-1000")
+        self.assertEqual(node.block_hash_calls, [901, 1000])
+
+    def test_rechecks_the_tip_before_fetching(self):
+        node = FakeNode(1000)
+        block_hashes = RecentBlockHashes(node, max_reorg_depth=100, refresh_interval=0)
+        self.assertEqual(block_hashes.get(950), "hash-950")
+        node.tip_height = 1100
+        self.assertIsNone(block_hashes.get(960))
+        self.assertEqual(node.block_hash_calls, [950])
+
+    def test_fetches_the_hash_when_the_tip_is_unknown(self):
+        node = FakeNode(None)
+        self.assertEqual(RecentBlockHashes(node, max_reorg_depth=100).get(5), "hash-5")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import logging
+import time
+import unittest
+
+from setup_logger import AggregatedLog, flush_aggregated_logs
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.counts = []
+
+    def emit(self, record):
+        self.counts.append((record.extra_content["count"], record.extra_content.get("txid")))
+
+
+class TestAggregatedLog(unittest.TestCase):
+    def setUp(self):
+        self.handler = RecordingHandler()
+        self.logger = logging.getLogger("TestAggregatedLog")
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.logger.addHandler(self.handler)
+        self.addCleanup(self.logger.removeHandler, self.handler)
+
+    def wait_for_counts(self, num_counts, timeout=5):
+        deadline = time.time() + timeout
+        while len(self.handler.counts) < num_counts and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_final_burst_is_logged_when_the_interval_closes(self):
+        aggregated_log = AggregatedLog(self.logger, "miss", interval=0.2)
+        for i in range(5):
+            aggregated_log.record(txid=f"tx{i}")
+        self.assertEqual(self.handler.counts, [(1, "tx0")])
+        self.wait_for_counts(2)
+        # the remaining four, with the latest sample, without another event arriving
+        self.assertEqual(self.handler.counts, [(1, "tx0"), (4, "tx4")])
+
+    def test_flush_at_exit(self):
+        aggregated_log = AggregatedLog(self.logger, "miss", interval=60)
+        for i in range(3):
+            aggregated_log.record(txid=f"tx{i}")
+        flush_aggregated_logs()
+        self.assertEqual(self.handler.counts, [(1, "tx0"), (2, "tx2")])
+        self.assertIsNone(aggregated_log._timer)
+        flush_aggregated_logs()
+        self.assertEqual(len(self.handler.counts), 2)
+
+    def test_flush_starts_a_new_interval(self):
+        aggregated_log = AggregatedLog(self.logger, "miss", interval=0.05)
+        aggregated_log.record(txid="tx0")
+        aggregated_log.record(txid="tx1")
+        self.wait_for_counts(2)
+        aggregated_log.record(txid="tx2")
+        self.wait_for_counts(3)
+        self.assertEqual(self.handler.counts, [(1, "tx0"), (1, "tx1"), (1, "tx2")])
+
+
+if __name__ == '__main__':
+    unittest.main()
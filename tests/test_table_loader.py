@@ -0,0 +1,67 @@
+import gc
+import os
+import pickle
+import tempfile
+import unittest
+
+from node.node_utils import get_tx_out_hash_table_sub_keys
+from node.table_loader import ChainedTable, chain_tables, chain_tx_out_hash_tables, load_pickles
+
+
+class TestChainTables(unittest.TestCase):
+    def test_later_tables_win(self):
+        table = chain_tables([{"a": 1, "b": 1}, {"b": 2, "c": 2}, {"c": 3}])
+        self.assertIsInstance(table, ChainedTable)
+        self.assertEqual(table["a"], 1)
+        self.assertEqual(table["b"], 2)
+        self.assertEqual(table["c"], 3)
+        with self.assertRaises(KeyError):
+            table["d"]
+
+    def test_get_contains_and_len(self):
+        table = chain_tables([{"a": 1}, {"b": None}, {"c": 0}])
+        self.assertEqual(table.get("a"), 1)
+        self.assertIsNone(table.get("b", "default"))
+        self.assertEqual(table.get("c", "default"), 0)
+        self.assertEqual(table.get("d", "default"), "default")
+        self.assertIn("b", table)
+        self.assertNotIn("d", table)
+        self.assertEqual(len(table), 3)
+
+    def test_single_and_empty_tables_are_not_chained(self):
+        only = {"a": 1}
+        self.assertIs(chain_tables([None, only, {}]), only)
+        self.assertEqual(chain_tables([None, {}]), {})
+
+    def test_chain_tx_out_hash_tables(self):
+        sub_keys = get_tx_out_hash_table_sub_keys()
+        first = {sub_keys[0]: {("a", "0"): ("addr1", 1)}, sub_keys[1]: {("b", "0"): ("addr2", 2)}}
+        second = {sub_keys[0]: {("a", "0"): ("addr3", 3), ("c", "0"): ("addr4", 4)}}
+        table = chain_tx_out_hash_tables([first, second])
+        self.assertEqual(set(table), set(sub_keys))
+        self.assertEqual(table[sub_keys[0]][("a", "0")], ("addr3", 3))
+        self.assertEqual(len(table[sub_keys[0]]), 3)
+        self.assertIs(table[sub_keys[1]], first[sub_keys[1]])
+        self.assertEqual(table[sub_keys[2]], {})
+
+
+class TestLoadPickles(unittest.TestCase):
+    def test_loads_in_order(self):
+        tables = [{"file": i} for i in range(5)]
+        with tempfile.TemporaryDirectory() as directory:
+            pickle_paths = []
+            for i, table in enumerate(tables):
+                pickle_path = os.path.join(directory, f"{i}.pkl")
+                with open(pickle_path, 'wb') as file:
+                    pickle.dump(table, file)
+                pickle_paths.append(pickle_path)
+            freeze_count = gc.get_freeze_count()
+            for prefetch_workers in (0, 2):
+                self.assertEqual(load_pickles(pickle_paths, "test tables", prefetch_workers), tables)
+            self.assertTrue(gc.isenabled())
+            # freezing is left to the entry points that fork workers
+            self.assertEqual(gc.get_freeze_count(), freeze_count)
+
+
+if __name__ == '__main__':
+    unittest.main()